@@ -2,12 +2,15 @@
 # 兩層過濾：L1 正則規則 + L2 模板相似度（不依賴外部模型）
 
 import re
+import time
 import unicodedata
 from typing import Tuple
 import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 from ad_templates import AD_TEMPLATES
+from metrics import counter, histogram
+from tracing import record, span
 try:
     from ad_samples import load_ad_samples, load_whitelist_samples
 except Exception:
@@ -577,6 +580,12 @@ def _build_vectorizers():
 
 _v1, _m1, _v2, _m2, _wm1, _wm2 = _build_vectorizers()
 
+
+def rebuild_vectorizers() -> None:
+    """動態樣本增刪後重建向量器（不重新載入模組）。"""
+    global _v1, _m1, _v2, _m2, _wm1, _wm2
+    _v1, _m1, _v2, _m2, _wm1, _wm2 = _build_vectorizers()
+
 def _whitelist_score(t: str) -> float:
     """回傳輸入與最相似白樣本的分數（無白樣本時為 0）。"""
     if _wm1 is None and _wm2 is None:
@@ -639,37 +648,71 @@ def _looks_like_ad_discussion(text: str) -> bool:
     )
     return sum(term in text for term in meta_terms) >= 2
 
+# 指標以名稱註冊在 metrics 模組，熱重載本模組時沿用同一份計數
+_STAGE_LATENCY = histogram(
+    "detect_ad_stage_seconds", "detect_ad latency per stage",
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5),
+    labelnames=("stage",),
+)
+_VERDICTS = counter("detect_ad_verdicts_total", "detect_ad verdicts by reason", labelnames=("verdict", "reason"))
+
+
+def _stage_done(stage: str, since: float) -> float:
+    now = time.perf_counter()
+    _STAGE_LATENCY.labels(stage=stage).observe(now - since)
+    record(stage, since, now)
+    return now
+
+
+def _verdict(reason: str, result: Tuple[bool, float, str]) -> Tuple[bool, float, str]:
+    _VERDICTS.inc(verdict="ad" if result[0] else "ok", reason=reason)
+    return result
+
+
 def detect_ad(raw_text: str) -> Tuple[bool, float, str]:
     """
     輸入：原始訊息文字
     輸出：(是否廣告, 置信度 0~1, 匹配說明)
     """
+    with span("detect_ad", chars=len(raw_text or "")) as current:
+        result = _detect_ad(raw_text)
+        if current is not None:
+            current.attrs["ad"] = result[0]
+        return result
+
+
+def _detect_ad(raw_text: str) -> Tuple[bool, float, str]:
+    started = time.perf_counter()
     text = clean_text(raw_text)
+    mark = _stage_done("clean", started)
     if _looks_like_ad_discussion(text):
-        return False, 0.0, "疑似黑產內容討論/引用，放行"
+        return _verdict("discussion", (False, 0.0, "疑似黑產內容討論/引用，放行"))
 
     # 純連結跳過，避免誤殺
     if _is_pure_url(text):
-        return False, 0.0, "純連結，跳過偵測"
+        return _verdict("pure_url", (False, 0.0, "純連結，跳過偵測"))
 
     # L1：正則
     hit_rule, labels = check_rules(text)
+    mark = _stage_done("rules", mark)
     if hit_rule:
         confidence = min(0.6 + 0.1 * len(labels), 0.99)
-        return True, confidence, "規則命中: " + ", ".join(labels)
+        return _verdict("rules", (True, confidence, "規則命中: " + ", ".join(labels)))
 
     # L2：模板相似度
     hit_sim, score = check_similarity(text)
+    mark = _stage_done("similarity", mark)
     if hit_sim:
         # 品牌詞沒有訂閱／金融卡等推廣上下文時，不使用模板相似度封鎖。
         if not _has_brand_ad_context(text):
-            return False, 0.0, "品牌詞但無廣告語境，正常訊息"
+            return _verdict("brand_without_context", (False, 0.0, "品牌詞但無廣告語境，正常訊息"))
         # 白樣本救援：僅作用於 L2（L1 明確廣告詞不救援）
         # 若最相似白樣本分數 ≥ 廣告分數，判定為誤封並放行
         t = clean_text(text).lower()
         wl = _whitelist_score(t)
+        _stage_done("whitelist", mark)
         if wl >= score - WHITELIST_RESCUE_MARGIN:
-            return False, round(wl, 3), f"白樣本救援放行（廣告{score:.2f} ≤ 白{wl:.2f}）"
-        return True, score, f"模板相似度: {score:.2f}"
+            return _verdict("whitelist_rescue", (False, round(wl, 3), f"白樣本救援放行（廣告{score:.2f} ≤ 白{wl:.2f}）"))
+        return _verdict("similarity", (True, score, f"模板相似度: {score:.2f}"))
 
-    return False, round(score if 'score' in dir() else 0.0, 3), "正常訊息"
+    return _verdict("clean", (False, round(score, 3), "正常訊息"))
@@ -1,16 +1,19 @@
 # ================== 動態樣本庫 ==================
 # 在不改動 ad_templates.py（基礎大庫）的前提下，
 # 讓管理員可於執行時「入庫」新廣告樣本、或把誤封訊息加入白樣本。
-# 資料持久化到 JSON，重啟後保留；被 ad_detector 熱重載時合併。
+# 資料持久化為 JSON 快照 + 追加式日誌，重啟後保留；記憶體中的 SampleStore 為讀寫入口，被 ad_detector 重建向量器時合併。
 
+import asyncio
+import hashlib
 import json
+import logging
 import os
 import re
 import threading
 import unicodedata
-from typing import List
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
 
-from ad_templates import AD_TEMPLATES
+import ad_templates
 
 _DIR = os.path.dirname(os.path.abspath(__file__))
 _DATA_DIR = os.getenv("BOT_DATA_DIR", os.path.join(_DIR, "runtime"))
@@ -18,7 +21,19 @@ os.makedirs(_DATA_DIR, exist_ok=True)
 AD_SAMPLES_FILE = os.path.join(_DATA_DIR, "custom_ad_samples.json")
 WHITELIST_FILE = os.path.join(_DATA_DIR, "whitelist_samples.json")
 
-_lock = threading.Lock()
+SAMPLE_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+PREVIEW_CHARS = 500
+SIMILARITY_THRESHOLD = 0.3
+JOURNAL_SUFFIX = ".journal.jsonl"
+COMPACT_MIN_OPS = 1000
+logger = logging.getLogger(__name__)
+
+# path -> SampleStore；整個程序共用，檔案被外部改動時依 mtime 自動重讀
+_stores: Dict[str, "SampleStore"] = {}
+_stores_lock = threading.Lock()
+# (id(AD_TEMPLATES), 正規化鍵集合)；ad_templates 熱重載後換成新 list，自動重算
+_official_keys: Tuple[int, FrozenSet[str]] = (0, frozenset())
 
 
 def normalize_key(text: str) -> str:
@@ -29,9 +44,15 @@ def normalize_key(text: str) -> str:
     return re.sub(r"[\s\W_]+", "", text, flags=re.UNICODE)
 
 
-def official_template_keys() -> set:
-    """回傳原生模板庫（ad_templates.py）正規化後的去重鍵集合。"""
-    return {k for t in AD_TEMPLATES if (k := normalize_key(t))}
+def official_template_keys() -> FrozenSet[str]:
+    """回傳原生模板庫（ad_templates.py）正規化後的去重鍵集合（快取，模板熱重載後重算）。"""
+    global _official_keys
+    templates = ad_templates.AD_TEMPLATES
+    cached_id, keys = _official_keys
+    if cached_id != id(templates):
+        keys = frozenset(k for t in templates if (k := normalize_key(t)))
+        _official_keys = (id(templates), keys)
+    return keys
 
 
 def _load(path: str) -> List[str]:
@@ -63,77 +84,520 @@ def _save(path: str, items: List[str]) -> None:
     os.replace(tmp, path)  # 原子寫入，避免半截檔案
 
 
+class _Library:
+    """Hash maps over one library: exact text, normalized key counts and sample IDs."""
+
+    __slots__ = ("items", "key_counts", "ids")
+
+    def __init__(self):
+        # text -> normalize_key(text)；dict 保序，兼作有序集合
+        self.items: Dict[str, str] = {}
+        self.key_counts: Dict[str, int] = {}
+        self.ids: Dict[str, str] = {}
+
+    def insert(self, text: str) -> None:
+        key = normalize_key(text)
+        self.items[text] = key
+        if key:
+            self.key_counts[key] = self.key_counts.get(key, 0) + 1
+        self.ids[sample_id(text)] = text
+
+    def discard(self, text: str) -> None:
+        key = self.items.pop(text)
+        if key:
+            remaining = self.key_counts[key] - 1
+            if remaining:
+                self.key_counts[key] = remaining
+            else:
+                del self.key_counts[key]
+        self.ids.pop(sample_id(text), None)
+
+
+def _replay(journal_path: str, library: _Library) -> Tuple[int, bool]:
+    """Apply the journal to ``library``; returns (ops applied, whether the last line is unterminated)."""
+    ops = 0
+    torn = False
+    try:
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                torn = not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                    op, text = entry["op"], entry["text"].strip()
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    # 寫到一半中斷的最後一行，略過
+                    continue
+                if op == "add" and text and text not in library.items:
+                    library.insert(text)
+                elif op == "remove" and text in library.items:
+                    library.discard(text)
+                ops += 1
+    except OSError:
+        return 0, False
+    return ops, torn
+
+
+class SampleStore:
+    """One sample library held in memory, persisted as a snapshot plus an append-only journal.
+
+    The snapshot is the original JSON list file; every add or remove since the
+    last compaction is one line in ``<file>.journal.jsonl``, so a write costs a
+    single append regardless of library size. Loading replays the journal over
+    the snapshot. Once the journal holds more than ``COMPACT_MIN_OPS`` ops (or
+    more than half the library), a background thread folds it into a fresh
+    snapshot and truncates it. Replaying an add or remove twice is harmless, so
+    a crash between the two steps loses nothing.
+
+    Both files are parsed once; later reads only ``stat`` them. When either
+    changed on disk (another process, or a ``git pull``) a reader starts a
+    reload on a background thread and keeps serving the previous maps; the
+    thread parses into fresh maps and swaps them in under the memory lock, so
+    readers (including handlers on the event loop) never parse or wait on disk
+    I/O once the first load is done. Exact texts, normalized keys and sample IDs
+    are kept in hash maps, so duplicate checks, adds and removals are O(1).
+    Writers are serialised by a separate lock, reload synchronously before
+    changing anything, and the ``*_async`` helpers run them on a worker thread.
+    """
+
+    def __init__(self, path: str, compact_min_ops: int = COMPACT_MIN_OPS):
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.compact_min_ops = compact_min_ops
+        self._lib = _Library()
+        self._stamp: Optional[Tuple[Any, Any]] = None
+        self._loaded = False
+        # 每次記憶體內容被寫入改動就加一；重新載入期間若有寫入，讀到的舊資料不換上
+        self._generation = 0
+        self._index: Optional["SampleIndex"] = None
+        self._journal_ops = 0
+        # 日誌最後一行沒有換行（寫到一半當機），下次追加前要先補換行
+        self._journal_torn = False
+        self._compactor: Optional[threading.Thread] = None
+        self._reloader: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._async_lock: Optional[asyncio.Lock] = None
+        self.loads = 0
+        self.compactions = 0
+
+    @staticmethod
+    def _stat_file(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _stat(self) -> Tuple[Any, Any]:
+        return self._stat_file(self.path), self._stat_file(self.journal_path)
+
+    def _refresh(self, wait: bool = False) -> None:
+        """Reload snapshot + journal if either changed on disk; never called with ``_lock`` held.
+
+        Once something is loaded, a reader only starts a background reload and
+        serves the current maps; ``wait=True`` (writers) reloads in place.
+        """
+        stamp = self._stat()
+        with self._lock:
+            if self._loaded and stamp == self._stamp:
+                return
+            loaded = self._loaded
+        if wait or not loaded:
+            self._reload()
+        else:
+            self._reload_in_background()
+
+    def _reload_in_background(self) -> None:
+        with self._lock:
+            if self._reloader is not None and self._reloader.is_alive():
+                return
+            self._reloader = threading.Thread(target=self._reload, name="sample-reload", daemon=True)
+            self._reloader.start()
+
+    def wait_reload(self, timeout: Optional[float] = None) -> None:
+        reloader = self._reloader
+        if reloader is not None:
+            reloader.join(timeout)
+
+    def _reload(self) -> None:
+        """Parse snapshot + journal into fresh maps and swap them in, unless a write raced the parse."""
+        with self._reload_lock:
+            with self._lock:
+                generation = self._generation
+            stamp = self._stat()
+            with self._lock:
+                if self._loaded and stamp == self._stamp:
+                    return
+            library = _Library()
+            for text in _load(self.path):
+                library.insert(text)
+            ops, torn = _replay(self.journal_path, library)
+            with self._lock:
+                if generation != self._generation:
+                    # 載入期間已有寫入，磁碟上的新狀態會在下次檢查時再讀
+                    return
+                self._lib = library
+                self._journal_ops = ops
+                self._journal_torn = torn
+                self._stamp = stamp
+                self._loaded = True
+                self._index = None
+                self.loads += 1
+
+    def _compaction_due(self) -> bool:
+        return self._journal_ops >= max(self.compact_min_ops, len(self._lib.items) // 2)
+
+    def _mutate(self, change: Callable[[_Library], Tuple[Any, List[Tuple[str, str]]]]) -> Any:
+        """Apply ``change`` in memory, then append the ``(op, text)`` entries it returns to the journal."""
+        with self._write_lock:
+            self._refresh(wait=True)
+            with self._lock:
+                result, ops = change(self._lib)
+                if not ops:
+                    return result
+                self._generation += 1
+                self._index = None
+                torn = self._journal_torn
+            lines = "".join(json.dumps({"op": op, "text": text}, ensure_ascii=False) + "\n" for op, text in ops)
+            if torn:
+                # 不補換行的話，新紀錄會接在殘缺行後面，整行在下次載入時一起被丟掉
+                lines = "\n" + lines
+            try:
+                with open(self.journal_path, "a", encoding="utf-8") as f:
+                    f.write(lines)
+            except OSError:
+                with self._lock:
+                    # 記憶體已改但沒寫進檔案，下次讀取時以磁碟為準重新載入
+                    self._loaded = False
+                raise
+            stamp = self._stat()
+            with self._lock:
+                self._journal_torn = False
+                self._journal_ops += len(ops)
+                self._stamp = stamp
+                due = self._compaction_due()
+        if due:
+            self._compact_in_background()
+        return result
+
+    def _write_snapshot(self) -> None:
+        """Fold the journal into a new snapshot (caller holds ``_write_lock``)."""
+        self._refresh(wait=True)
+        with self._lock:
+            snapshot = list(self._lib.items)
+        _save(self.path, snapshot)
+        # 先寫快照再清日誌：中間當機時重放日誌也只是重複套用同樣的新增／刪除
+        with open(self.journal_path, "w", encoding="utf-8"):
+            pass
+        stamp = self._stat()
+        with self._lock:
+            self._generation += 1
+            self._journal_torn = False
+            self._journal_ops = 0
+            self._stamp = stamp
+            self.compactions += 1
+
+    def compact(self) -> None:
+        with self._write_lock:
+            self._write_snapshot()
+
+    def _compact_in_background(self) -> None:
+        with self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            self._compactor = threading.Thread(target=self._compact_quietly, name="sample-compact", daemon=True)
+            self._compactor.start()
+
+    def _compact_quietly(self) -> None:
+        try:
+            self.compact()
+        except OSError as exc:
+            logger.warning("樣本庫日誌壓縮失敗 %s: %s", self.path, exc)
+
+    def wait_compaction(self, timeout: Optional[float] = None) -> None:
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join(timeout)
+
+    def __len__(self) -> int:
+        self._refresh()
+        with self._lock:
+            return len(self._lib.items)
+
+    def items(self) -> List[str]:
+        self._refresh()
+        with self._lock:
+            return list(self._lib.items)
+
+    def journal_ops(self) -> int:
+        self._refresh()
+        with self._lock:
+            return self._journal_ops
+
+    def index(self) -> "SampleIndex":
+        self._refresh()
+        with self._lock:
+            if self._index is None:
+                self._index = SampleIndex(list(self._lib.items))
+            return self._index
+
+    def replace(self, items: List[str]) -> None:
+        """Replace the whole library; written straight to a new snapshot."""
+        library = _Library()
+        for text in items:
+            text = (text or "").strip()
+            if text and text not in library.items:
+                library.insert(text)
+        with self._write_lock:
+            self._refresh(wait=True)
+            with self._lock:
+                self._lib = library
+                self._generation += 1
+                self._index = None
+            self._write_snapshot()
+
+    def add(self, text: str, dedupe_against_official: bool = False) -> bool:
+        text = (text or "").strip()
+        if not text:
+            return False
+
+        def change(library: _Library):
+            if text in library.items:
+                return False, []
+            if dedupe_against_official:
+                key = normalize_key(text)
+                if key and (key in official_template_keys() or key in library.key_counts):
+                    return False, []
+            library.insert(text)
+            return True, [("add", text)]
+
+        return self._mutate(change)
+
+    def remove(self, text: str) -> bool:
+        text = (text or "").strip()
+
+        def change(library: _Library):
+            if text not in library.items:
+                return False, []
+            library.discard(text)
+            return True, [("remove", text)]
+
+        return self._mutate(change)
+
+    def remove_by_id(self, sid: str) -> Optional[str]:
+        def change(library: _Library):
+            text = library.ids.get(sid)
+            if text is None:
+                return None, []
+            library.discard(text)
+            return text, [("remove", text)]
+
+        return self._mutate(change)
+
+    async def run_async(self, method: Callable[..., Any], *args) -> Any:
+        """Run a write on a worker thread; concurrent async writers queue on an ``asyncio.Lock``."""
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            return await asyncio.to_thread(method, *args)
+
+
+def _store(path: str) -> SampleStore:
+    store = _stores.get(path)
+    if store is None:
+        with _stores_lock:
+            store = _stores.setdefault(path, SampleStore(path))
+    return store
+
+
 def save_ad_samples(items: List[str]) -> None:
     """保存整理後的廣告樣本。"""
-    with _lock:
-        _save(AD_SAMPLES_FILE, items)
+    _store(AD_SAMPLES_FILE).replace(items)
+
+
+async def save_ad_samples_async(items: List[str]) -> None:
+    """save_ad_samples 的非同步版本：重寫快照在工作執行緒進行。"""
+    store = _store(AD_SAMPLES_FILE)
+    await store.run_async(store.replace, items)
 
 
 def load_ad_samples() -> List[str]:
     """讀取動態廣告樣本。"""
-    return _load(AD_SAMPLES_FILE)
+    return _store(AD_SAMPLES_FILE).items()
 
 
 def load_whitelist_samples() -> List[str]:
     """讀取白樣本（非廣告）。"""
-    return _load(WHITELIST_FILE)
+    return _store(WHITELIST_FILE).items()
 
 
-def _add(path: str, text: str, dedupe_against_official: bool = False) -> bool:
-    """加入一筆樣本，回傳是否為新增。
+def count_ad_samples() -> int:
+    return len(_store(AD_SAMPLES_FILE))
 
-    已存在於同一樣本庫（原字串完全相同），或（當 dedupe_against_official=True 時）
-    正規化後已存在於原生模板庫 / 同庫其他樣本，皆視為重複而不加入。
-    """
-    text = (text or "").strip()
-    if not text:
-        return False
-    with _lock:
-        items = _load(path)
-        if text in items:
-            return False
-        if dedupe_against_official:
-            new_key = normalize_key(text)
-            if new_key:
-                if new_key in official_template_keys():
-                    return False
-                if any(normalize_key(existing) == new_key for existing in items):
-                    return False
-        items.append(text)
-        _save(path, items)
-    return True
+
+def count_whitelist_samples() -> int:
+    return len(_store(WHITELIST_FILE))
 
 
 def add_ad_sample(text: str) -> bool:
     """入庫：新增廣告樣本。會與原生模板庫（ad_templates.py）做正規化去重，
     避免手動添加的樣本與內建範本重複。"""
-    return _add(AD_SAMPLES_FILE, text, dedupe_against_official=True)
+    return _store(AD_SAMPLES_FILE).add(text, dedupe_against_official=True)
 
 
 def add_whitelist_sample(text: str) -> bool:
     """誤封處理：把訊息加入白樣本（非廣告）。"""
-    return _add(WHITELIST_FILE, text)
+    return _store(WHITELIST_FILE).add(text)
 
 
 def remove_ad_sample(text: str) -> bool:
     """從廣告樣本移除一筆。"""
-    text = (text or "").strip()
-    with _lock:
-        items = _load(AD_SAMPLES_FILE)
-        if text not in items:
-            return False
-        items.remove(text)
-        _save(AD_SAMPLES_FILE, items)
-    return True
+    return _store(AD_SAMPLES_FILE).remove(text)
 
 
 def remove_whitelist_sample(text: str) -> bool:
     """從白樣本移除一筆。"""
-    text = (text or "").strip()
-    with _lock:
-        items = _load(WHITELIST_FILE)
-        if text not in items:
-            return False
-        items.remove(text)
-        _save(WHITELIST_FILE, items)
-    return True
+    return _store(WHITELIST_FILE).remove(text)
+
+
+async def add_ad_sample_async(text: str) -> bool:
+    """add_ad_sample 的非同步版本：寫檔在工作執行緒進行，不佔用事件迴圈。"""
+    store = _store(AD_SAMPLES_FILE)
+    return await store.run_async(store.add, text, True)
+
+
+async def add_whitelist_sample_async(text: str) -> bool:
+    """add_whitelist_sample 的非同步版本。"""
+    store = _store(WHITELIST_FILE)
+    return await store.run_async(store.add, text)
+
+
+# ================== 分頁 / 搜尋索引 ==================
+
+def sample_id(text: str) -> str:
+    """Stable sample ID derived from the text, so removal never depends on list position."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=6).hexdigest()
+
+
+def _bigrams(key: str) -> Set[str]:
+    if len(key) < 2:
+        return {key} if key else set()
+    return {key[i:i + 2] for i in range(len(key) - 1)}
+
+
+class SampleIndex:
+    """In-memory index over one sample library: id lookup, substring and bigram similarity search.
+
+    Pages are addressed by a ``<position>:<id>`` cursor naming the last item
+    returned, so concurrent additions or removals neither repeat nor skip items.
+    """
+
+    def __init__(self, items: List[str]):
+        self.items = list(items)
+        self.ids = [sample_id(text) for text in self.items]
+        self._by_id = {sid: i for i, sid in enumerate(self.ids)}
+        self._keys = [normalize_key(text) for text in self.items]
+        self._grams = [_bigrams(key) for key in self._keys]
+        self._postings: Dict[str, List[int]] = {}
+        for i, grams in enumerate(self._grams):
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(i)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, sid: str) -> Optional[str]:
+        i = self._by_id.get(sid)
+        return None if i is None else self.items[i]
+
+    def search(self, query: str = "", similar: bool = False) -> List[int]:
+        """Positions matching ``query``: all in library order, substring hits, or similarity-ranked."""
+        query = (query or "").strip()
+        if not query:
+            return list(range(len(self.items)))
+        key = normalize_key(query)
+        if not key:
+            # 只有符號的查詢，退回原文比對
+            return [i for i, text in enumerate(self.items) if query in text]
+        grams = _bigrams(key)
+        if similar:
+            overlap: Dict[int, int] = {}
+            for gram in grams:
+                for i in self._postings.get(gram, ()):
+                    overlap[i] = overlap.get(i, 0) + 1
+            scored = []
+            for i, shared in overlap.items():
+                score = shared / (len(grams) + len(self._grams[i]) - shared)
+                if score >= SIMILARITY_THRESHOLD:
+                    scored.append((-score, i))
+            return [i for _score, i in sorted(scored)]
+        if len(key) < 2:
+            return [i for i, k in enumerate(self._keys) if key in k]
+        # 子字串必含查詢的每個 bigram：先用倒排表縮小候選，再逐條確認
+        candidates: Optional[Set[int]] = None
+        for gram in grams:
+            posting = set(self._postings.get(gram, ()))
+            candidates = posting if candidates is None else candidates & posting
+            if not candidates:
+                return []
+        return [i for i in sorted(candidates or ()) if key in self._keys[i]]
+
+    def page(self, query: str = "", cursor: str = "", limit: int = SAMPLE_PAGE_SIZE, similar: bool = False) -> dict:
+        """One page of results; ``next`` is the cursor for the following page, empty at the end."""
+        limit = max(1, min(int(limit or SAMPLE_PAGE_SIZE), MAX_PAGE_SIZE))
+        results = self.search(query, similar)
+        start = 0
+        if cursor:
+            position, _, last_id = cursor.partition(":")
+            try:
+                position = int(position)
+            except ValueError:
+                position = -1
+            if 0 <= position < len(results) and self.ids[results[position]] == last_id:
+                start = position + 1
+            else:
+                found = next((n for n, i in enumerate(results) if self.ids[i] == last_id), None)
+                # 上一頁最後一筆被刪掉時，後面的項目整體前移一格
+                start = found + 1 if found is not None else max(0, min(position, len(results)))
+        chosen = results[start:start + limit]
+        items = []
+        for i in chosen:
+            text = self.items[i]
+            preview = text if len(text) <= PREVIEW_CHARS else text[:PREVIEW_CHARS] + "…"
+            items.append({"id": self.ids[i], "text": preview})
+        end = start + len(chosen)
+        next_cursor = f"{end - 1}:{self.ids[chosen[-1]]}" if chosen and end < len(results) else ""
+        return {"items": items, "next": next_cursor, "total": len(results), "query": query, "similar": bool(similar)}
+
+
+def ad_sample_index() -> SampleIndex:
+    """Index of the dynamic ad samples, rebuilt lazily after each write."""
+    return _store(AD_SAMPLES_FILE).index()
+
+
+def whitelist_sample_index() -> SampleIndex:
+    """Index of the whitelist samples, rebuilt lazily after each write."""
+    return _store(WHITELIST_FILE).index()
+
+
+def remove_ad_sample_by_id(sid: str) -> Optional[str]:
+    """依樣本 ID 移除廣告樣本，回傳被移除的文字；不存在時回傳 None。"""
+    return _store(AD_SAMPLES_FILE).remove_by_id(sid)
+
+
+def remove_whitelist_sample_by_id(sid: str) -> Optional[str]:
+    """依樣本 ID 移除白樣本，回傳被移除的文字；不存在時回傳 None。"""
+    return _store(WHITELIST_FILE).remove_by_id(sid)
+
+
+async def remove_ad_sample_by_id_async(sid: str) -> Optional[str]:
+    """remove_ad_sample_by_id 的非同步版本。"""
+    store = _store(AD_SAMPLES_FILE)
+    return await store.run_async(store.remove_by_id, sid)
+
+
+async def remove_whitelist_sample_by_id_async(sid: str) -> Optional[str]:
+    """remove_whitelist_sample_by_id 的非同步版本。"""
+    store = _store(WHITELIST_FILE)
+    return await store.run_async(store.remove_by_id, sid)
@@ -0,0 +1,122 @@
+"""User -> administered chats index for the admin panel.
+
+Bootstrapping the Mini App needs every known group the user administers.
+Asking Telegram once per (group, user) serially is far too slow with hundreds
+of groups, so the index keeps each group's administrator set (one
+``getChatAdministrators`` call per group) plus the reverse map from user id to
+chats. ``CHAT_MEMBER`` updates promote or demote users in place; groups whose
+entry is missing or older than the TTL are refreshed concurrently under a
+semaphore, and concurrent refreshes of the same group share one request.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+ADMIN_INDEX_TTL = 600
+REFRESH_CONCURRENCY = 8
+
+FetchAdmins = Callable[[int], Awaitable[Optional[Iterable[int]]]]
+
+
+class AdminIndex:
+    def __init__(self, ttl: float = ADMIN_INDEX_TTL, concurrency: int = REFRESH_CONCURRENCY):
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self._admins: Dict[int, Tuple[float, Set[int]]] = {}
+        self._by_user: Dict[int, Set[int]] = {}
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.hits = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    def set_admins(self, chat_id: int, user_ids: Iterable[int], now: Optional[float] = None) -> None:
+        """Replace the administrator set of ``chat_id`` and update the reverse map."""
+        self.forget_chat(chat_id)
+        admins = set(user_ids)
+        self._admins[chat_id] = (time.monotonic() if now is None else now, admins)
+        for user_id in admins:
+            self._by_user.setdefault(user_id, set()).add(chat_id)
+
+    def forget_chat(self, chat_id: int) -> None:
+        entry = self._admins.pop(chat_id, None)
+        if entry is None:
+            return
+        for user_id in entry[1]:
+            chats = self._by_user.get(user_id)
+            if chats is not None:
+                chats.discard(chat_id)
+                if not chats:
+                    del self._by_user[user_id]
+
+    def observe(self, chat_id: int, user_id: int, is_admin: bool) -> None:
+        """Apply a CHAT_MEMBER status change to a cached group; unknown groups wait for a refresh."""
+        entry = self._admins.get(chat_id)
+        if entry is None:
+            return
+        admins = entry[1]
+        if is_admin:
+            admins.add(user_id)
+            self._by_user.setdefault(user_id, set()).add(chat_id)
+        elif user_id in admins:
+            admins.discard(user_id)
+            chats = self._by_user.get(user_id, set())
+            chats.discard(chat_id)
+            if not chats:
+                self._by_user.pop(user_id, None)
+
+    def _fresh(self, chat_id: int, now: float) -> bool:
+        entry = self._admins.get(chat_id)
+        return entry is not None and now - entry[0] <= self.ttl
+
+    def is_admin(self, chat_id: int, user_id: int) -> Optional[bool]:
+        """Cached answer, or None when the group has no fresh entry."""
+        if not self._fresh(chat_id, time.monotonic()):
+            return None
+        return user_id in self._admins[chat_id][1]
+
+    async def _refresh(self, chat_id: int, fetch: FetchAdmins) -> None:
+        future = self._inflight.get(chat_id)
+        if future is not None:
+            await future
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[chat_id] = future
+        try:
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.concurrency)
+            async with self._semaphore:
+                self.refreshes += 1
+                admins = await fetch(chat_id)
+            if admins is None:
+                self.failures += 1
+                self.forget_chat(chat_id)
+            else:
+                self.set_admins(chat_id, admins)
+        finally:
+            del self._inflight[chat_id]
+            future.set_result(None)
+
+    async def chats_for(self, user_id: int, chat_ids: Iterable[int], fetch: FetchAdmins) -> List[int]:
+        """Return the chats in ``chat_ids`` that ``user_id`` administers, refreshing stale groups."""
+        chat_ids = list(chat_ids)
+        now = time.monotonic()
+        stale = [chat_id for chat_id in chat_ids if not self._fresh(chat_id, now)]
+        self.hits += len(chat_ids) - len(stale)
+        if stale:
+            await asyncio.gather(*(self._refresh(chat_id, fetch) for chat_id in stale))
+        # 取不到管理員名單的群組視為沒有權限
+        administered = self._by_user.get(user_id, set())
+        return [chat_id for chat_id in chat_ids if chat_id in administered]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "groups": len(self._admins),
+            "users": len(self._by_user),
+            "hits": self.hits,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
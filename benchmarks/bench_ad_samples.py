@@ -0,0 +1,109 @@
+"""Benchmark: sample writes on a 50k library, full JSON rewrite vs. append-only journal.
+
+Usage: python benchmarks/bench_ad_samples.py [--samples 50000] [--writes 500]
+
+Each write is an add or a remove-by-id, as issued by /addsample, the Mini App
+and the false-positive button. "rewrite" re-serialises the whole list per
+write (the previous behaviour); "journal" is SampleStore appending one line,
+with background compaction into the snapshot. Load time covers replaying the
+journal left behind by the writes.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ad_samples import SampleStore, _save, sample_id  # noqa: E402
+
+
+def _samples(count):
+    return [f"兼職日結 {i} 號，日賺 {random.randint(300, 9000)} 加飛機 @agent{i:06d}" for i in range(count)]
+
+
+def _ops(samples, writes):
+    ops = []
+    for i in range(writes):
+        if i % 2:
+            ops.append(("remove", sample_id(random.choice(samples))))
+        else:
+            ops.append(("add", f"新入庫樣本 {i} 返利 {random.random():.6f}"))
+    return ops
+
+
+def _percentile(latencies, p):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def bench_rewrite(path, samples, ops):
+    items = list(samples)
+    _save(path, items)
+    latencies = []
+    for op, arg in ops:
+        start = time.perf_counter()
+        if op == "add":
+            items.append(arg)
+        else:
+            items = [text for text in items if sample_id(text) != arg]
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(items, f, ensure_ascii=False, indent=2)
+        os.replace(path + ".tmp", path)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_journal(path, samples, ops):
+    _save(path, samples)
+    store = SampleStore(path)
+    len(store)
+    latencies = []
+    for op, arg in ops:
+        start = time.perf_counter()
+        if op == "add":
+            store.add(arg)
+        else:
+            store.remove_by_id(arg)
+        latencies.append(time.perf_counter() - start)
+    store.wait_compaction()
+    return latencies, store
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=50000)
+    parser.add_argument("--writes", type=int, default=500)
+    args = parser.parse_args()
+    random.seed(0)
+    samples = _samples(args.samples)
+    ops = _ops(samples, args.writes)
+    with tempfile.TemporaryDirectory() as tmp:
+        rewrite = bench_rewrite(os.path.join(tmp, "rewrite.json"), samples, ops)
+        journal, store = bench_journal(os.path.join(tmp, "journal.json"), samples, ops)
+        journal_ops = store.journal_ops()
+        journal_bytes = os.path.getsize(store.journal_path) if os.path.exists(store.journal_path) else 0
+        start = time.perf_counter()
+        replayed = SampleStore(store.path)
+        count = len(replayed)
+        load = time.perf_counter() - start
+        start = time.perf_counter()
+        replayed.compact()
+        compact = time.perf_counter() - start
+    print(f"{args.writes} writes on a {args.samples} sample library")
+    for name, latencies in (("json full rewrite", rewrite), ("append-only journal", journal)):
+        print(
+            f"{name:<20}: total {sum(latencies):8.3f}s  "
+            f"p50 {_percentile(latencies, 0.5) * 1000:8.3f}ms  p99 {_percentile(latencies, 0.99) * 1000:8.3f}ms"
+        )
+    print(f"speedup (total)     : {sum(rewrite) / max(sum(journal), 1e-9):8.1f}x")
+    print(f"journal replay load : {load:8.3f}s ({count} samples, {journal_ops} ops, {journal_bytes} bytes)")
+    print(f"compaction          : {compact:8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Benchmark: 10k group updates, full JSON rewrite vs. StateStore write-behind.
+
+Usage: python benchmarks/bench_state_store.py [--updates 10000] [--groups 100]
+
+"caller" is the time spent on the calling thread (what the event loop pays);
+"total" additionally includes the final flush to disk.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from settings import DEFAULT_FEATURES  # noqa: E402
+from state_store import StateStore  # noqa: E402
+
+
+def _groups(count):
+    return {
+        -1000000000000 - i: {
+            "title": f"group {i}",
+            "added_at": time.time(),
+            "type": "supergroup",
+            "status": "administrator",
+            "features": dict(DEFAULT_FEATURES),
+        }
+        for i in range(count)
+    }
+
+
+def bench_json(path, groups, updates):
+    ids = list(groups)
+    start = time.perf_counter()
+    for _ in range(updates):
+        chat_id = random.choice(ids)
+        groups[chat_id]["features"]["welcome"] = not groups[chat_id]["features"]["welcome"]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(groups, f, ensure_ascii=False, indent=2)
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed
+
+
+def bench_store(path, groups, updates):
+    store = StateStore(path)
+    store.start()
+    ids = list(groups)
+    start = time.perf_counter()
+    for _ in range(updates):
+        chat_id = random.choice(ids)
+        groups[chat_id]["features"]["welcome"] = not groups[chat_id]["features"]["welcome"]
+        store.put("groups", chat_id, groups[chat_id])
+    caller = time.perf_counter() - start
+    store.close()
+    total = time.perf_counter() - start
+    return caller, total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--groups", type=int, default=100)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        json_caller, json_total = bench_json(os.path.join(tmp, "known_groups.json"), _groups(args.groups), args.updates)
+        store_caller, store_total = bench_store(os.path.join(tmp, "state.sqlite3"), _groups(args.groups), args.updates)
+    print(f"{args.updates} updates over {args.groups} groups")
+    print(f"json full rewrite : caller {json_caller:8.3f}s  total {json_total:8.3f}s")
+    print(f"sqlite write-behind: caller {store_caller:8.3f}s  total {store_total:8.3f}s")
+    print(f"speedup (caller)   : {json_caller / max(store_caller, 1e-9):8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
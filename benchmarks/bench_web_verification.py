@@ -0,0 +1,111 @@
+"""Benchmark: full web verification flow against the local fake siteverify.
+
+Usage: python benchmarks/bench_web_verification.py [--users 500] [--concurrency 100] [--latency 0.05]
+
+Each simulated user opens the page, fetches the captcha image and submits the
+form; Turnstile is checked by the pooled client against fake_siteverify.py,
+so the run needs no network access.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_siteverify import FakeSiteverifyServer  # noqa: E402
+from turnstile import TurnstileClient  # noqa: E402
+from web_verification import WebVerificationServer, _hash  # noqa: E402
+
+BOT_TOKEN = "123:bench"
+
+
+def _init_data(user_id):
+    fields = {"auth_date": str(int(time.time())), "user": json.dumps({"id": user_id})}
+    check = "\n".join(f"{k}={fields[k]}" for k in sorted(fields))
+    secret = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+    return urllib.parse.urlencode(fields)
+
+
+async def _request(reader, writer, method, path, body=b""):
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: bench\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+    length = 0
+    for line in head[1:]:
+        if line.lower().startswith("content-length:"):
+            length = int(line.split(":", 1)[1])
+    await reader.readexactly(length)
+    return int(head[0].split()[1])
+
+
+async def _user(server, user_id, latencies):
+    token = server.create_session(user_id, -100)
+    server.sessions.get(token)["answer"] = _hash("424242")
+    body = urllib.parse.urlencode({
+        "captcha": "424242", "cf-turnstile-response": f"ok-{user_id}", "tg_init_data": _init_data(user_id),
+    }).encode()
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+    try:
+        await _request(reader, writer, "GET", f"/verify/{token}")
+        await _request(reader, writer, "GET", f"/verify/{token}/captcha.png")
+        status = await _request(reader, writer, "POST", f"/verify/{token}", body)
+    finally:
+        writer.close()
+    latencies.append(time.perf_counter() - started)
+    return status
+
+
+async def run(args):
+    fake = FakeSiteverifyServer(latency=args.latency)
+    await fake.start()
+    completed = []
+
+    async def on_success(token, user_id):
+        completed.append(user_id)
+
+    server = WebVerificationServer(on_success, host="127.0.0.1", port=0, max_connections=args.concurrency * 2)
+    server.bot_token = BOT_TOKEN
+    server.turnstile = TurnstileClient("secret", endpoint=fake.url)
+    await server.start()
+    gate = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def one(user_id):
+        async with gate:
+            return await _user(server, user_id, latencies)
+
+    started = time.perf_counter()
+    statuses = await asyncio.gather(*(one(1000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    turnstile = server.turnstile.stats()
+    await server.stop()
+    await fake.stop()
+
+    latencies.sort()
+    print(f"{args.users} users, concurrency {args.concurrency}, siteverify latency {args.latency * 1000:.0f}ms")
+    print(f"completed         : {len(completed)} ({statuses.count(200)} x 200)")
+    print(f"throughput        : {args.users / elapsed:8.1f} verifications/s")
+    print(f"flow latency p50  : {latencies[len(latencies) // 2] * 1000:8.1f}ms")
+    print(f"flow latency p95  : {latencies[int(len(latencies) * 0.95)] * 1000:8.1f}ms")
+    print(f"siteverify        : {turnstile['latency_ms']} over {fake.connections} connections")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
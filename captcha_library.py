@@ -0,0 +1,163 @@
+"""Rotating library of CAPTCHA photos already uploaded to Telegram.
+
+Sending a fresh PNG per challenge uploads ~10 KB per joiner, which adds up
+during a raid and puts upload time on the click-to-photo path. Each
+challenge here is uploaded once to a storage chat; afterwards it is sent by
+``file_id``, which is a tiny API call. Entries retire after ``max_uses`` sends
+or ``max_age`` seconds, and a background task uploads a few replacements per
+round for the retired ones only, so a full, idle library costs no uploads
+while the set of images (and their answers) keeps turning over instead of
+becoming a small, memorisable set. Entries are mirrored into the state store
+with their retirement deadline, so a restart keeps the warmed library.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from state_store import StateStore
+
+LIBRARY_NAMESPACE = "captcha_library"
+LIBRARY_SIZE = 48
+MAX_USES = 20
+MAX_AGE = 6 * 3600
+REFRESH_INTERVAL = 30.0
+UPLOADS_PER_ROUND = 2
+logger = logging.getLogger(__name__)
+
+# upload() 上傳一題並回傳 (file_id, file_unique_id, answer)；失敗回傳 None
+Upload = Callable[[], Awaitable[Optional[Tuple[str, str, Any]]]]
+
+
+class CaptchaLibrary:
+    def __init__(
+        self,
+        upload: Upload,
+        store: Optional[StateStore] = None,
+        namespace: str = LIBRARY_NAMESPACE,
+        size: int = LIBRARY_SIZE,
+        max_uses: int = MAX_USES,
+        max_age: float = MAX_AGE,
+        refresh_interval: float = REFRESH_INTERVAL,
+        uploads_per_round: int = UPLOADS_PER_ROUND,
+    ):
+        self.upload = upload
+        self.store = store
+        self.namespace = namespace
+        self.size = size
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+        self.uploads_per_round = uploads_per_round
+        # file_unique_id -> {"file_id", "answer", "uses", "created_at"}
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.served = 0
+        self.misses = 0
+        self.uploaded = 0
+        self.retired = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self) -> int:
+        """Restore entries persisted by a previous run; expired ones are already filtered by the store."""
+        if self.store is None:
+            return 0
+        for key, entry in self.store.load(self.namespace).items():
+            self._entries[key] = entry
+        return len(self._entries)
+
+    def add(self, unique_id: str, file_id: str, answer: Any, now: Optional[float] = None) -> None:
+        entry = {"file_id": file_id, "answer": answer, "uses": 0, "created_at": time.time() if now is None else now}
+        self._entries[unique_id] = entry
+        self._persist(unique_id, entry)
+
+    def _persist(self, unique_id: str, entry: Dict[str, Any]) -> None:
+        if self.store:
+            self.store.put(self.namespace, unique_id, entry, expires_at=entry["created_at"] + self.max_age)
+
+    def _retire(self, unique_id: str) -> None:
+        if self._entries.pop(unique_id, None) is not None:
+            self.retired += 1
+            if self.store:
+                self.store.delete(self.namespace, unique_id)
+
+    def take(self, now: Optional[float] = None) -> Optional[Tuple[str, Any]]:
+        """Return ``(file_id, answer)`` of a random live entry, or None when the library is empty."""
+        now = time.time() if now is None else now
+        while self._entries:
+            unique_id = random.choice(list(self._entries))
+            entry = self._entries[unique_id]
+            if now - entry["created_at"] > self.max_age:
+                self._retire(unique_id)
+                continue
+            entry["uses"] += 1
+            self.served += 1
+            if entry["uses"] >= self.max_uses:
+                self._retire(unique_id)
+            else:
+                self._persist(unique_id, entry)
+            return entry["file_id"], entry["answer"]
+        self.misses += 1
+        return None
+
+    def forget(self, file_id: str) -> None:
+        """Drop an entry whose file_id Telegram rejected."""
+        for unique_id, entry in list(self._entries.items()):
+            if entry["file_id"] == file_id:
+                self._retire(unique_id)
+
+    async def refresh(self, now: Optional[float] = None) -> int:
+        """One refresh round: retire the expired, then upload up to ``uploads_per_round`` entries."""
+        now = time.time() if now is None else now
+        for unique_id, entry in list(self._entries.items()):
+            if now - entry["created_at"] > self.max_age:
+                self._retire(unique_id)
+        uploads = 0
+        # 只補上用完或過期留下的空位；已滿時不上傳
+        while len(self._entries) < self.size and uploads < self.uploads_per_round:
+            result = await self.upload()
+            if result is None:
+                break
+            file_id, unique_id, answer = result
+            self.add(unique_id, file_id, answer, now)
+            self.uploaded += 1
+            uploads += 1
+        return uploads
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("驗證碼題庫補充失敗: %s", exc)
+            await asyncio.sleep(self.refresh_interval)
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "served": self.served,
+            "misses": self.misses,
+            "uploaded": self.uploaded,
+            "retired": self.retired,
+        }
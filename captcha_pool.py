@@ -0,0 +1,182 @@
+"""Background-filled pool of pre-rendered CAPTCHA challenges.
+
+Drawing and PNG-encoding a CAPTCHA takes a few milliseconds of CPU. Doing it
+inside a request or update handler puts that cost on the hot path, once per
+challenge, page refresh and wrong answer. A pool keeps ready ``(answer, png)``
+pairs so handing out a challenge is a ``deque.popleft``; a daemon thread
+renders replacements, aiming to hold about ``horizon`` seconds of recent demand
+between ``min_size`` and ``max_size``.
+
+Async callers use ``take_async`` so a pool miss renders on a small dedicated
+``RenderExecutor`` instead of the event loop; its queue is bounded, so a burst
+of misses waits for a slot rather than piling up unbounded work.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+POOL_MIN_SIZE = 8
+POOL_MAX_SIZE = 256
+POOL_HORIZON = 30.0
+DEMAND_WINDOW = 60.0
+RENDER_WORKERS = 2
+RENDER_QUEUE = 32
+logger = logging.getLogger(__name__)
+
+Challenge = Tuple[Any, bytes]
+
+
+class RenderExecutor:
+    """Thread pool for CPU-bound rendering with at most ``max_queue`` jobs waiting."""
+
+    def __init__(self, max_workers: int = RENDER_WORKERS, max_queue: int = RENDER_QUEUE, name: str = "captcha-render"):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.waiting = 0
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers + self.max_queue)
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._slots.release()
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class CaptchaPool:
+    def __init__(
+        self,
+        render: Callable[[], Challenge],
+        min_size: int = POOL_MIN_SIZE,
+        max_size: int = POOL_MAX_SIZE,
+        horizon: float = POOL_HORIZON,
+        name: str = "captcha-pool",
+    ):
+        self.render = render
+        self.min_size = min_size
+        self.max_size = max_size
+        self.horizon = horizon
+        self.name = name
+        self._ready: Deque[Challenge] = collections.deque()
+        self._takes: Deque[float] = collections.deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self.hits = 0
+        self.misses = 0
+        self.rendered = 0
+
+    def __len__(self) -> int:
+        return len(self._ready)
+
+    def target(self, now: Optional[float] = None) -> int:
+        """Pool size to aim for: recent demand over ``horizon``, clamped to the bounds."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            while self._takes and now - self._takes[0] > DEMAND_WINDOW:
+                self._takes.popleft()
+            rate = len(self._takes) / DEMAND_WINDOW
+        return max(self.min_size, min(self.max_size, math.ceil(rate * self.horizon)))
+
+    def take(self) -> Challenge:
+        """Return a ready challenge, rendering inline only when the pool is empty."""
+        self._ensure_started()
+        with self._lock:
+            self._takes.append(time.monotonic())
+        try:
+            challenge = self._ready.popleft()
+            self.hits += 1
+        except IndexError:
+            self.misses += 1
+            challenge = self._render_one()
+        self._wake.set()
+        return challenge
+
+    def take_ready(self) -> Optional[Challenge]:
+        """Return a ready challenge, or None on a miss; never renders on the caller."""
+        self._ensure_started()
+        with self._lock:
+            self._takes.append(time.monotonic())
+        try:
+            challenge = self._ready.popleft()
+            self.hits += 1
+        except IndexError:
+            self.misses += 1
+            challenge = None
+        self._wake.set()
+        return challenge
+
+    async def take_async(self, executor: RenderExecutor) -> Challenge:
+        """Like ``take`` but a pool miss renders on ``executor``, off the event loop."""
+        self._ensure_started()
+        with self._lock:
+            self._takes.append(time.monotonic())
+        try:
+            challenge = self._ready.popleft()
+            self.hits += 1
+        except IndexError:
+            self.misses += 1
+            challenge = await executor.run(self._render_one)
+        self._wake.set()
+        return challenge
+
+    def fill(self, count: Optional[int] = None) -> None:
+        """Render synchronously until the pool holds ``count`` (default: current target)."""
+        goal = self.target() if count is None else min(count, self.max_size)
+        while len(self._ready) < goal:
+            self._ready.append(self._render_one())
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "ready": len(self._ready),
+            "target": self.target(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "rendered": self.rendered,
+        }
+
+    def _render_one(self) -> Challenge:
+        challenge = self.render()
+        self.rendered += 1
+        return challenge
+
+    def _ensure_started(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopping:
+            try:
+                self.fill()
+            except Exception as exc:
+                logger.error("驗證碼預產生失敗: %s", exc)
+            # 有人取用就會被喚醒；閒置時定期檢查目標大小（需求下降後不再補滿）
+            self._wake.wait(timeout=1.0)
+            self._wake.clear()
+
+    def stop(self) -> None:
+        self._stopping = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
@@ -0,0 +1,106 @@
+"""Local stand-in for Cloudflare's Turnstile siteverify endpoint.
+
+Answers ``POST /turnstile/v0/siteverify`` like Cloudflare does: any response
+token accepted unless it starts with ``fail``. Optional artificial latency
+lets load tests reproduce a slow upstream. Point the bot at it with
+``CF_TURNSTILE_VERIFY_URL=http://127.0.0.1:<port>/turnstile/v0/siteverify``.
+
+Usage: python fake_siteverify.py [--host 127.0.0.1] [--port 8787] [--latency 0.05]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import urllib.parse
+from typing import Optional
+
+SITEVERIFY_PATH = "/turnstile/v0/siteverify"
+
+
+class FakeSiteverifyServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.requests = 0
+        self.connections = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}{SITEVERIFY_PATH}"
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                path = lines[0].split(" ")[1] if " " in lines[0] else ""
+                if not path.startswith(SITEVERIFY_PATH):
+                    status, payload = "404 Not Found", {"success": False, "error-codes": ["not-found"]}
+                else:
+                    payload = self._verdict(urllib.parse.parse_qs(body.decode("utf-8", "replace")))
+                    status = "200 OK"
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\nConnection: keep-alive\r\n\r\n".encode("latin-1") + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _verdict(form) -> dict:
+        secret = form.get("secret", [""])[0]
+        token = form.get("response", [""])[0]
+        if not secret:
+            return {"success": False, "error-codes": ["missing-input-secret"]}
+        if not token or token.startswith("fail"):
+            return {"success": False, "error-codes": ["invalid-input-response"]}
+        return {"success": True, "hostname": "localhost", "error-codes": []}
+
+
+async def _main(args) -> None:
+    server = FakeSiteverifyServer(args.host, args.port, args.latency)
+    await server.start()
+    print(f"fake siteverify listening on {server.url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", type=float, default=0.0)
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
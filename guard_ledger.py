@@ -0,0 +1,170 @@
+"""Append-only per-chat ledger of members who joined while /guard was on.
+
+A raid can bring thousands of joins in a minute. Each join only appends a line
+to an in-memory buffer; a background thread writes the buffers to
+``<chat_id>.jsonl`` in batches and fsyncs periodically, so the event loop never
+touches the disk on the join path. The set of recorded user ids lives in memory;
+an existing file from an earlier run is read by the writer thread, not by
+``append``. ``read``, ``reset`` and ``flush`` do disk I/O and should be called
+off the event loop.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+FLUSH_INTERVAL = 0.5
+FSYNC_INTERVAL = 5.0
+logger = logging.getLogger(__name__)
+
+
+class GuardLedger:
+    def __init__(self, directory: str, flush_interval: float = FLUSH_INTERVAL, fsync_interval: float = FSYNC_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        self._buffers: Dict[int, List[Tuple[int, str]]] = {}
+        # 每群已記錄的用戶；_loaded 內的群才已併入磁碟上舊檔的名單（只在 io 鎖內讀寫）
+        self._seen: Dict[int, Set[int]] = {}
+        self._loaded: Set[int] = set()
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._last_fsync = time.monotonic()
+        self._unsynced = set()
+        self._tail_checked = set()
+
+    def _path(self, chat_id: int) -> str:
+        return os.path.join(self.directory, f"{int(chat_id)}.jsonl")
+
+    def append(self, chat_id: int, user_id: int, name: str) -> int:
+        """Record one joiner; returns how many distinct users this chat has recorded so far.
+
+        Repeat events for a user already on the list are dropped. Users recorded by
+        an earlier run are only counted once the writer thread has read the file.
+        """
+        with self._lock:
+            seen = self._seen.setdefault(chat_id, set())
+            if user_id in seen:
+                return len(seen)
+            seen.add(user_id)
+            line = json.dumps({"id": user_id, "name": name, "ts": time.time()}, ensure_ascii=False)
+            self._buffers.setdefault(chat_id, []).append((user_id, line))
+            count = len(seen)
+        self._wake.set()
+        return count
+
+    def _parse(self, chat_id: int) -> Dict[int, dict]:
+        users: Dict[int, dict] = {}
+        try:
+            with open(self._path(chat_id), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        users.setdefault(int(entry["id"]), {"id": int(entry["id"]), "name": entry.get("name", "")})
+                    except (ValueError, KeyError, TypeError):
+                        continue  # 當機時寫到一半的最後一行
+        except FileNotFoundError:
+            pass
+        return users
+
+    def _merge_locked(self, chat_id: int, on_disk) -> None:
+        """Fold ids found in an earlier run's file into the in-memory set (io lock held)."""
+        with self._lock:
+            self._seen.setdefault(chat_id, set()).update(on_disk)
+        self._loaded.add(chat_id)
+
+    def flush(self, fsync: bool = False) -> None:
+        """Write buffered lines to each chat's ledger file."""
+        with self._io_lock:
+            # 換出緩衝區與寫檔都在 io 鎖內，避免 reset 刪檔後又被舊資料寫回
+            with self._lock:
+                buffers, self._buffers = self._buffers, {}
+            for chat_id, entries in buffers.items():
+                if chat_id not in self._loaded:
+                    # 這一輪才第一次碰到此群的舊檔：併入舊名單，並略過檔內已有的用戶
+                    on_disk = self._parse(chat_id)
+                    self._merge_locked(chat_id, on_disk)
+                    entries = [(user_id, line) for user_id, line in entries if user_id not in on_disk]
+                    if not entries:
+                        continue
+                lines = [line for _user_id, line in entries]
+                with open(self._path(chat_id), "ab+") as f:
+                    if f.tell() and chat_id not in self._tail_checked:
+                        # 上次當機可能留下沒有換行的半行，先補換行再接著寫
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            f.write(b"\n")
+                    self._tail_checked.add(chat_id)
+                    f.write(("\n".join(lines) + "\n").encode("utf-8"))
+                self._unsynced.add(chat_id)
+            if fsync:
+                for chat_id in self._unsynced:
+                    try:
+                        with open(self._path(chat_id), "a", encoding="utf-8") as f:
+                            os.fsync(f.fileno())
+                    except OSError:
+                        pass
+                self._unsynced.clear()
+
+    def read(self, chat_id: int) -> List[dict]:
+        """Return recorded joiners in join order, one entry per user id."""
+        self.flush(fsync=True)
+        with self._io_lock:
+            users = self._parse(chat_id)
+            if chat_id not in self._loaded:
+                self._merge_locked(chat_id, users)
+        return list(users.values())
+
+    def reset(self, chat_id: int) -> None:
+        """Forget every recorded joiner for a chat (new guard session or handled)."""
+        with self._io_lock:
+            with self._lock:
+                self._buffers.pop(chat_id, None)
+                self._seen[chat_id] = set()
+            self._loaded.add(chat_id)
+            self._unsynced.discard(chat_id)
+            try:
+                os.remove(self._path(chat_id))
+            except FileNotFoundError:
+                pass
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="guard-ledger", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._wake.wait()
+            if self._stopping:
+                break
+            self._wake.clear()
+            time.sleep(self.flush_interval)
+            now = time.monotonic()
+            fsync = now - self._last_fsync >= self.fsync_interval
+            try:
+                self.flush(fsync=fsync)
+                if fsync:
+                    self._last_fsync = now
+            except OSError as exc:
+                logger.error("防護名單寫入失敗: %s", exc)
+            if self._unsynced:
+                self._wake.set()  # 還有未 fsync 的檔案，下一輪再處理
+
+    def close(self) -> None:
+        self._stopping = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.flush(fsync=True)
@@ -0,0 +1,140 @@
+"""Join-burst processing pipeline for raid conditions.
+
+``chat_member`` joins are queued per chat instead of being handled inline by
+the update handler. Each chat drains its queue with a few workers under a
+global concurrency cap; repeated events for the same (chat, user, stage) are
+dropped while one is still queued or running and for ``dedupe_window``
+seconds after it finished (Telegram redelivers an update it thinks was lost,
+sometimes after the first copy was already handled); and jobs are ordered by priority
+so a restrict produced by a finished scan jumps ahead of scans still waiting.
+CPU-bound profile scans run on a small thread pool off the event loop.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+PRIORITY_RESTRICT = 0
+PRIORITY_SCAN = 1
+PRIORITY_WELCOME = 2
+
+GLOBAL_CONCURRENCY = 16
+PER_CHAT_CONCURRENCY = 4
+SCAN_WORKERS = 2
+DEDUPE_WINDOW = 10.0
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class JoinPipeline:
+    def __init__(
+        self,
+        concurrency: int = GLOBAL_CONCURRENCY,
+        per_chat_concurrency: int = PER_CHAT_CONCURRENCY,
+        scan_workers: int = SCAN_WORKERS,
+        dedupe_window: float = DEDUPE_WINDOW,
+    ):
+        self.concurrency = concurrency
+        self.per_chat_concurrency = per_chat_concurrency
+        self.dedupe_window = dedupe_window
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._queues: Dict[int, List[Tuple[int, int, Hashable, Job]]] = {}
+        self._workers: Dict[int, int] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._inflight: Set[Tuple[int, Hashable]] = set()
+        # 最近完成的 (chat, key) -> 完成時間；依完成順序排列，過期的從前面剪掉
+        self._recent: "collections.OrderedDict[Tuple[int, Hashable], float]" = collections.OrderedDict()
+        self._seq = itertools.count()
+        self._executor = ThreadPoolExecutor(max_workers=scan_workers, thread_name_prefix="profile-scan")
+        self.submitted = 0
+        self.deduped = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+
+    def depth(self, chat_id: Optional[int] = None) -> int:
+        """Queued (not yet started) jobs for one chat, or across all chats."""
+        if chat_id is not None:
+            return len(self._queues.get(chat_id, ()))
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "submitted": self.submitted,
+            "deduped": self.deduped,
+            "processed": self.processed,
+            "failed": self.failed,
+            "queued": self.depth(),
+            "max_depth": self.max_depth,
+        }
+
+    def submit(self, chat_id: int, key: Hashable, job: Job, priority: int = PRIORITY_SCAN) -> bool:
+        """Queue a job; returns False when the same (chat, key) is queued, running or just finished."""
+        cutoff = time.monotonic() - self.dedupe_window
+        while self._recent and next(iter(self._recent.values())) <= cutoff:
+            self._recent.popitem(last=False)
+        if (chat_id, key) in self._inflight or (chat_id, key) in self._recent:
+            self.deduped += 1
+            return False
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._inflight.add((chat_id, key))
+        queue = self._queues.setdefault(chat_id, [])
+        heapq.heappush(queue, (priority, next(self._seq), key, job))
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.depth())
+        if self._workers.get(chat_id, 0) < self.per_chat_concurrency:
+            self._workers[chat_id] = self._workers.get(chat_id, 0) + 1
+            task = asyncio.create_task(self._worker(chat_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _worker(self, chat_id: int):
+        try:
+            while self._queues.get(chat_id):
+                async with self._semaphore:
+                    queue = self._queues.get(chat_id)
+                    if not queue:
+                        break
+                    _priority, _seq, key, job = heapq.heappop(queue)
+                    try:
+                        await job()
+                    except Exception as exc:
+                        self.failed += 1
+                        logger.error("入群處理失敗 chat=%s key=%s: %s", chat_id, key, exc)
+                    finally:
+                        self._inflight.discard((chat_id, key))
+                        if self.dedupe_window > 0:
+                            self._recent[(chat_id, key)] = time.monotonic()
+                            self._recent.move_to_end((chat_id, key))
+                        self.processed += 1
+        finally:
+            self._workers[chat_id] -= 1
+            if not self._workers[chat_id]:
+                del self._workers[chat_id]
+                if not self._queues.get(chat_id):
+                    self._queues.pop(chat_id, None)
+
+    async def run_in_worker(self, fn: Callable[..., Any], *args) -> Any:
+        """Run a CPU-bound scan on the pipeline's thread pool."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def drain(self, timeout: float = 30.0) -> None:
+        """Wait until every queued and running job has finished."""
+        deadline = time.monotonic() + timeout
+        while self._tasks or self._inflight:
+            if time.monotonic() > deadline:
+                raise asyncio.TimeoutError("join pipeline did not drain")
+            await asyncio.sleep(0.005)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,207 @@
+"""Non-blocking logging: a bounded queue in front of a background writer thread.
+
+Handlers on the event loop only run the sampling filter and put the record on
+a queue; formatting, JSON encoding, file writes, rotation and gzip compression
+all happen on the ``QueueListener`` thread, so disk I/O never stalls update
+handling. Records whose arguments are immutable are formatted on the writer
+thread too; anything else is rendered before enqueueing so a later mutation
+cannot change what gets logged.
+
+High-volume messages can be rate-limited per message template: each rule is a
+token bucket, and the next record let through carries the number suppressed
+since the previous one. When the queue is full records are dropped and
+counted rather than blocking the caller.
+"""
+
+from __future__ import annotations
+
+import copy
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Optional, Tuple
+
+from tracing import current_trace_id
+
+QUEUE_SIZE = 10000
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+_IMMUTABLE = (str, int, float, bool, bytes, type(None))
+
+
+def _immutable(value) -> bool:
+    if isinstance(value, tuple):
+        return all(_immutable(item) for item in value)
+    return isinstance(value, _IMMUTABLE)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and optional context fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            entry["trace_id"] = trace_id
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class GzipRotatingFileHandler(RotatingFileHandler):
+    """Size-based rotation; rotated files are gzip-compressed (``bot.log.1.gz`` ...)."""
+
+    def __init__(self, filename: str, max_bytes: int = MAX_BYTES, backup_count: int = BACKUP_COUNT):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source: str, dest: str) -> None:
+        with open(source, "rb") as src, gzip.open(dest, "wb") as out:
+            shutil.copyfileobj(src, out)
+        os.remove(source)
+
+
+class SamplingFilter(logging.Filter):
+    """Rate-limit records whose message template starts with a configured prefix.
+
+    ``rules`` maps prefix -> (records per second, burst). Runs on the caller's
+    thread before anything is formatted, so a suppressed record costs one
+    dict lookup and a token-bucket update.
+    """
+
+    def __init__(self, rules: Dict[str, Tuple[float, float]]):
+        super().__init__()
+        self.rules = dict(rules)
+        # prefix -> [tokens, last refill, suppressed since last emitted]
+        self._buckets = {prefix: [burst, time.monotonic(), 0] for prefix, (_rate, burst) in self.rules.items()}
+        self.suppressed = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        template = record.msg if isinstance(record.msg, str) else ""
+        for prefix, (rate, burst) in self.rules.items():
+            if template.startswith(prefix):
+                break
+        else:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets[prefix]
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+            bucket[0] -= 1
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks: a full queue drops the record and counts it."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        # trace id 存在 contextvar，只能在呼叫端讀取
+        trace_id = current_trace_id()
+        if trace_id:
+            record.trace_id = trace_id
+        if record.args and not _immutable(record.args):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # traceback 物件留在佇列裡會拖住整個 frame，先轉成文字
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogPipeline:
+    def __init__(self, handler: DroppingQueueHandler, listener: QueueListener, sampler: Optional[SamplingFilter]):
+        self.handler = handler
+        self.listener = listener
+        self.sampler = sampler
+        self._stopped = False
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self.handler.queue.qsize(),
+            "dropped": self.handler.dropped,
+            "sampled_out": self.sampler.suppressed if self.sampler else 0,
+        }
+
+    def stop(self) -> None:
+        """Flush queued records and stop the writer thread."""
+        if self._stopped:
+            return
+        self._stopped = True
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+
+def setup_logging(
+    path: str = "bot.log",
+    level: int = logging.INFO,
+    sample_rules: Optional[Dict[str, Tuple[float, float]]] = None,
+    max_bytes: int = MAX_BYTES,
+    backup_count: int = BACKUP_COUNT,
+    queue_size: int = QUEUE_SIZE,
+    console: bool = True,
+) -> LogPipeline:
+    """Route the root logger through a queue to a rotating JSON file (and plain-text console)."""
+    file_handler = GzipRotatingFileHandler(path, max_bytes, backup_count)
+    file_handler.setFormatter(JsonFormatter())
+    sinks = [file_handler]
+    if console:
+        stream = logging.StreamHandler()
+        stream.setFormatter(logging.Formatter(TEXT_FORMAT))
+        sinks.append(stream)
+
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    sampler = SamplingFilter(sample_rules) if sample_rules else None
+    if sampler:
+        handler.addFilter(sampler)
+    listener = QueueListener(handler.queue, *sinks, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    listener.start()
+    return LogPipeline(handler, listener, sampler)
@@ -3,9 +3,12 @@ import re
 import sys
 import io
 import shutil
+import functools
 import subprocess
 import asyncio
+import atexit
 import time
+from types import SimpleNamespace
 from typing import Optional, Dict, Tuple
 import logging
 import uuid
@@ -13,11 +16,25 @@ import random
 from PIL import Image, ImageDraw, ImageFont
 from ad_detector import detect_ad, clean_text, check_neutral_phrase
 from web_verification import WebVerificationServer, is_configured as web_verification_configured
+from profile_cache import ProfileVerdictCache, profile_fields
+from admin_index import AdminIndex
+from state_store import StateStore, StoredDict
+from guard_ledger import GuardLedger
+from join_pipeline import PRIORITY_RESTRICT, PRIORITY_SCAN, PRIORITY_WELCOME, JoinPipeline
+from outbound import PRIORITY_BULK, PRIORITY_NOTICE, OutboundScheduler
+from timers import TimerScheduler
+from captcha_pool import CaptchaPool, RenderExecutor
+from captcha_library import CaptchaLibrary
+from metrics import counter, gauge, histogram, monitor_event_loop_lag
+from tracing import Tracer, instrument_handlers, span
+from log_pipeline import setup_logging
 from settings import (
     DEFAULT_FEATURES,
     FEATURE_LABELS,
+    compile_group_features,
     feature_enabled,
     get_group_features,
+    persistable_group,
     set_group_feature,
 )
 from telegram import (
@@ -28,6 +45,7 @@ from telegram import (
     ChatMember,
     Chat,
 )
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     ChatMemberHandler,
@@ -35,18 +53,26 @@ from telegram.ext import (
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
 # ================== 基本設定 ==================
-logging.basicConfig(
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler("bot.log", encoding='utf-8'),
-        logging.StreamHandler()
-    ],
+# 日誌經佇列交給背景執行緒寫入：bot.log 為 JSON 行、依大小輪替並 gzip 壓縮，
+# 事件迴圈上只做取樣判斷與入列。高頻訊息依模板前綴限流（每秒筆數, 突發上限）。
+LOG_SAMPLE_RULES = {
+    "📊 成員狀態變化": (5.0, 20.0),
+    "📝 用戶 %s 簡介": (5.0, 20.0),
+    "⏭ 用戶 %s 已有進行中的驗證流程": (2.0, 10.0),
+    "⏭️ 用戶 %s 已歡迎過": (2.0, 10.0),
+}
+log_pipeline = setup_logging(
+    os.getenv("BOT_LOG_FILE", "bot.log"),
+    sample_rules=LOG_SAMPLE_RULES,
+    max_bytes=int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+    backup_count=int(os.getenv("LOG_BACKUP_COUNT", "5")),
 )
+atexit.register(log_pipeline.stop)
 logger = logging.getLogger(__name__)
 
 # === 重要：必須修改這兩個值 ===
@@ -56,28 +82,53 @@ BOT_VERSION = "v3.4.0"
 # 行政頻道（公投結果公告 + 置頂）
 ADMIN_GROUP_ID = -1003502034749
 ADMIN_GROUP_LINK = "https://t.me/diacg_administration"
+# 驗證碼題庫先上傳到這個聊天取得 file_id（上傳後立即刪除訊息），之後以 file_id 重複發送
+# 預設是擁有者的私訊，不要設成公開頻道：訂閱者會看到每張上傳的題目與答案
+CAPTCHA_UPLOAD_CHAT_ID = int(os.getenv("CAPTCHA_UPLOAD_CHAT_ID", str(OWNER_ID)))
 
 # 數據存儲
 known_groups: Dict[int, Dict] = {}
 application_bot = None
 DATA_DIR = os.getenv("BOT_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "runtime"))
-pending_verifications: Dict[int, Dict] = {}
+STATE_DB_NAME = "bot_state.sqlite3"
+VERIFY_STATE_TTL = 1800  # 待驗證紀錄在狀態庫的保存時間（與 Telegram 驗證逾時一致）
+state_store: Optional[StateStore] = None
+# user_id -> 待驗證狀態；存於狀態庫（第一次存取時載入），重啟後禁言中的用戶仍可完成驗證。
+# 直接改 value 內欄位後要呼叫 pending_verifications.save(user_id)
+pending_verifications = StoredDict(lambda: _state_store(), "verifications", key_type=int, ttl=VERIFY_STATE_TTL)
 web_verification_server: Optional[WebVerificationServer] = None
 # 用戶最後一次看到的 (username, 暱稱)，用來偵測改名／改用戶名，改名時重新跑一次帳號畫像檢測
 known_profiles: Dict[int, Tuple[str, str]] = {}
+# 用戶名／暱稱／簡介的模板庫掃描結果，以 user_id + 三欄位雜湊為鍵，跨群組與三條檢測路徑共用
+profile_verdicts = ProfileVerdictCache()
+# user_id -> 其管理的群組反向索引，管理面板載入時直接查表，由 CHAT_MEMBER 事件即時更新
+admin_index = AdminIndex()
 VERIFY_ATTEMPT_LIMIT = 3  # 圖片算術驗證碼最大嘗試次數，超過需管理員手動處理
 user_welcomed: Dict[Tuple[int, int], bool] = {}
 active_referendums: Dict[int, Dict] = {}        # chat_id -> 全員禁言公投狀態
+REFERENDUM_EDIT_INTERVAL = float(os.getenv("REFERENDUM_EDIT_INTERVAL", "3"))  # 公投計票訊息最短編輯間隔（秒）
 pending_sample_actions: Dict[Tuple[int, int], str] = {}  # (chat_id, user_id) -> add_ad/whitelist
 consumed_sample_messages = set()  # (chat_id, message_id)，避免樣本輸入再進廣告偵測
 pending_false_positive_samples: Dict[str, dict] = {}  # token -> {"text","chat_id","user_id"}
 active_tests: set = set()  # (chat_id, user_id)，/test 後持續測試直到 /stop
 pending_guard_kick: Dict[int, dict] = {}  # chat_id -> {"users": {user_id: name}, "selected": set(user_id,...)}
+guard_ledger: Optional[GuardLedger] = None  # 防護模式期間加入名單（每群一份 append-only 檔案）
+guard_restrict_queue: Dict[int, list] = {}  # chat_id -> [user_id,...]，等待批次禁言
+guard_restrict_tasks: Dict[int, asyncio.Task] = {}
+GUARD_RESTRICT_BATCH = 20  # 每批同時送出的禁言請求數
+join_pipeline = JoinPipeline()  # 入群處理：每群佇列 + 並行上限 + 去重 + 禁言優先
+outbound_scheduler: Optional[OutboundScheduler] = None  # 對外 Bot API 排程器（main() 建立）
+timer_scheduler: Optional[TimerScheduler] = None  # 延遲工作（解禁、驗證逾時、刪訊息、觀察期），存於狀態庫
 recent_message_texts: Dict[Tuple[int, str], list] = {}  # (chat_id, 正規化文字) -> [timestamp,...]
 REPEAT_WINDOW_SECONDS = 600  # 重複洗版偵測時間窗（10分鐘）
 REPEAT_THRESHOLD = 3         # 同樣內容在時間窗內出現幾次視為洗版
 REPEAT_MIN_LENGTH = 8        # 太短的訊息（哈哈/在/666）不列入重複偵測，避免誤傷
-pending_sample_list: Dict[int, dict] = {}  # admin_user_id -> {"items": [...], "whitelist": bool}，供 /samples 刪除用
+pending_sample_list: Dict[int, dict] = {}  # admin_user_id -> {"whitelist": bool, "query": str, "cursor": str}，供 /samples 翻頁與刪除用
+SAMPLES_LIST_PAGE_SIZE = 10  # /samples 每頁按鈕數，避免超過 Telegram 鍵盤上限
+loop_lag_task: Optional[asyncio.Task] = None  # 事件迴圈延遲取樣（/metrics）
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "1.0"))  # 超過此秒數的處理流程寫入慢 trace 檔
+# 每個 update 一條 trace：handler 為根，偵測階段與每次 Bot API 呼叫為子 span（/traces 查看）
+tracer = Tracer(os.path.join(DATA_DIR, "slow_traces.jsonl"), slow_threshold=TRACE_SLOW_SECONDS)
 
 # ================== 權限設定 ==================
 def create_simple_mute_permissions():
@@ -143,37 +194,96 @@ def create_simple_unmute_permissions():
         return ChatPermissions(can_send_messages=True)
 
 # ================== 工具函數 ==================
-def save_known_groups():
-    """保存群組數據到文件"""
+def _state_store() -> StateStore:
+    """本機狀態庫（SQLite WAL），第一次使用時開啟並啟動背景寫入執行緒。"""
+    global state_store
+    if state_store is None:
+        state_store = StateStore(os.path.join(DATA_DIR, STATE_DB_NAME))
+        state_store.start()
+    return state_store
+
+
+def save_known_groups(*chat_ids):
+    """保存群組數據：只排入指定群組那一列（不指定則整份），由背景執行緒合併寫入。"""
     try:
-        os.makedirs(DATA_DIR, exist_ok=True)
-        with open(os.path.join(DATA_DIR, "known_groups.json"), "w", encoding='utf-8') as f:
-            import json
-            json.dump(known_groups, f, ensure_ascii=False, indent=2)
+        store = _state_store()
+        for chat_id in chat_ids or tuple(known_groups):
+            group = known_groups.get(chat_id)
+            if group is None:
+                store.delete("groups", chat_id)
+            else:
+                store.put("groups", chat_id, persistable_group(group))
     except Exception as e:
         logger.error(f"保存群組數據失敗: {e}")
 
 def load_known_groups():
-    """從文件加載群組數據"""
+    """從狀態庫加載群組數據；舊版 known_groups.json 只在第一次啟動時匯入。"""
     global known_groups
     try:
+        store = _state_store()
         data_path = os.path.join(DATA_DIR, "known_groups.json")
         legacy_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "known_groups.json")
         if not os.path.exists(data_path) and os.path.exists(legacy_path):
             data_path = legacy_path
-        with open(data_path, "r", encoding='utf-8') as f:
-            import json
-            known_groups = json.load(f)
-            known_groups = {int(k): v for k, v in known_groups.items()}
-            for group in known_groups.values():
-                group["features"] = get_group_features(group)
-    except FileNotFoundError:
-        known_groups = {}
+        store.migrate_json("groups", data_path)
+        known_groups = {int(k): v for k, v in store.load("groups").items()}
+        for group in known_groups.values():
+            group["features"] = get_group_features(group)
+            compile_group_features(group)
     except Exception as e:
         logger.error(f"加載群組數據失敗: {e}")
         known_groups = {}
 
 
+def _guard_ledger() -> GuardLedger:
+    """防護名單，第一次使用時建立並啟動背景寫入執行緒。"""
+    global guard_ledger
+    if guard_ledger is None:
+        guard_ledger = GuardLedger(os.path.join(DATA_DIR, "guard_ledger"))
+        guard_ledger.start()
+    return guard_ledger
+
+
+def _timers() -> TimerScheduler:
+    """延遲工作排程器，第一次使用時建立；工作存於狀態庫，重啟後補跑。"""
+    global timer_scheduler
+    if timer_scheduler is None:
+        timer_scheduler = TimerScheduler(_state_store())
+        timer_scheduler.register("unmute", _unmute_job)
+        timer_scheduler.register("group_unmute", _group_unmute_job)
+        timer_scheduler.register("expire_verification", _expire_verification)
+        timer_scheduler.register("delete_message", _delete_message_job)
+        timer_scheduler.register("observation", _observation_job)
+    return timer_scheduler
+
+
+def _queue_guard_restrict(bot, chat_id: int, user_id: int):
+    """防護模式新成員排入批次禁言；每個群組只有一個消化任務在跑。"""
+    guard_restrict_queue.setdefault(chat_id, []).append(user_id)
+    if chat_id not in guard_restrict_tasks:
+        guard_restrict_tasks[chat_id] = asyncio.create_task(_drain_guard_restricts(bot, chat_id))
+
+
+async def _drain_guard_restricts(bot, chat_id: int):
+    """把排隊中的防護模式禁言以 GUARD_RESTRICT_BATCH 為一批並行送出，直到佇列清空。"""
+    permissions = create_simple_mute_permissions()
+    try:
+        while guard_restrict_queue.get(chat_id):
+            queue = guard_restrict_queue[chat_id]
+            batch, queue[:] = queue[:GUARD_RESTRICT_BATCH], queue[GUARD_RESTRICT_BATCH:]
+            results = await asyncio.gather(
+                *(bot.restrict_chat_member(chat_id=chat_id, user_id=uid, permissions=permissions) for uid in batch),
+                return_exceptions=True,
+            )
+            for uid, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.error(f"防護模式禁言失敗 chat={chat_id} user={uid}: {result}")
+    finally:
+        guard_restrict_tasks.pop(chat_id, None)
+        if not guard_restrict_queue.get(chat_id):
+            guard_restrict_queue.pop(chat_id, None)
+
+
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """顯示目前群組功能開關。"""
     message = update.effective_message
@@ -229,15 +339,22 @@ async def feature_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     known_groups.setdefault(chat.id, {"title": chat.title or str(chat.id), "status": "active"})
     set_group_feature(known_groups, chat.id, name, value in {"on", "true"})
-    save_known_groups()
+    save_known_groups(chat.id)
     await update.message.reply_text(
         f"✅ {FEATURE_LABELS[name]} 已{'啟用' if value in {'on', 'true'} else '停用'}。"
     )
 
 
-async def delayed_unmute(bot, chat_id: int, user_id: int, minutes: int):
-    """延遲解除禁言"""
-    await asyncio.sleep(minutes * 60)
+def delayed_unmute(chat_id: int, user_id: int, minutes: int):
+    """排程延遲解除禁言（重啟後仍會執行）"""
+    _timers().schedule(
+        "unmute", minutes * 60, {"chat_id": chat_id, "user_id": user_id}, f"unmute:{chat_id}:{user_id}"
+    )
+
+async def _unmute_job(payload: dict):
+    """排程工作：解除單一成員禁言"""
+    bot = application_bot
+    chat_id, user_id = payload["chat_id"], payload["user_id"]
     try:
         # 使用完全解禁權限
         permissions = create_simple_unmute_permissions()
@@ -276,34 +393,49 @@ async def send_welcome_message(bot, chat_id: int, user_id: int, user_name: str,
     
     # 如果已經歡迎過且不是強制發送，則跳過
     if not force_send and key in user_welcomed and user_welcomed[key]:
-        logger.info(f"⏭️ 用戶 {user_id} 已歡迎過，跳過")
+        logger.info("⏭️ 用戶 %s 已歡迎過，跳過", user_id)
         return
     
     try:
         await bot.send_message(
             chat_id,
             f"👋 歡迎 {user_name} 加入群組！",
-            parse_mode="HTML"
+            parse_mode="HTML",
+            rate_limit_args=PRIORITY_BULK,
         )
         user_welcomed[key] = True
-        logger.info(f"✅ 已發送歡迎消息給 {user_name} (ID: {user_id})")
+        logger.info("✅ 已發送歡迎消息給 %s (ID: %s)", user_name, user_id)
     except Exception as e:
         logger.error(f"發送歡迎消息失敗: {e}")
 
 
-async def _delete_after(message, seconds: int):
-    """延遲刪除訊息"""
-    await asyncio.sleep(seconds)
+def _delete_after(message, seconds: int):
+    """排程延遲刪除訊息"""
+    _timers().schedule(
+        "delete_message", seconds, {"chat_id": message.chat_id, "message_id": message.message_id}
+    )
+
+
+async def _delete_message_job(payload: dict):
+    """排程工作：刪除訊息（已被刪掉就算了）"""
     try:
-        await message.delete()
+        await application_bot.delete_message(chat_id=payload["chat_id"], message_id=payload["message_id"])
     except Exception:
         pass
 
 
-async def _expire_verification(bot, user_id: int, delay: float = 1800, created_at: float = None):
+def _schedule_verification_expiry(user_id: int, delay: float = 1800, created_at: float = None):
     """驗證逾時（預設30分鐘）後，若還沒完成就自動清掉當下那則訊息與狀態，
     避免「開始真人驗證」按鈕或題目一直卡在群裡沒人管。"""
-    await asyncio.sleep(delay)
+    _timers().schedule(
+        "expire_verification", delay, {"user_id": user_id, "created_at": created_at}, f"verify:{user_id}"
+    )
+
+
+async def _expire_verification(payload: dict):
+    """排程工作：清掉逾時未完成的驗證"""
+    bot = application_bot
+    user_id, created_at = payload["user_id"], payload.get("created_at")
     info = pending_verifications.get(user_id)
     if not info:
         return
@@ -339,13 +471,14 @@ async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TY
                 "type": chat.type,
                 "status": new_status
             }
-            save_known_groups()
+            save_known_groups(chat.id)
             logger.info(f"✅ 記錄新群組: {chat.title} (ID: {chat.id})")
         
         elif new_status in ["left", "kicked"]:
+            admin_index.forget_chat(chat.id)
             if chat.id in known_groups:
                 del known_groups[chat.id]
-                save_known_groups()
+                save_known_groups(chat.id)
                 logger.info(f"🗑️ 移除群組記錄: {chat.title}")
                 
     except Exception as e:
@@ -390,6 +523,13 @@ def _has_template_hit(reasons: list) -> bool:
     return any("命中模板庫" in r for r in reasons)
 
 
+def _profile_template_hits(user, bio: str) -> list:
+    """用戶名／暱稱／簡介對廣告模板庫的命中清單 [(欄位, 命中原因), ...]。
+    三欄位沒變時直接取快取結果，不重跑 detect_ad。"""
+    fields = profile_fields(user.username, user.full_name, bio)
+    return profile_verdicts.scan(user.id, fields, detect_ad)
+
+
 async def _scan_profile_for_ad_signal(bot, user, bio: str = None) -> Tuple[bool, list]:
     """對用戶當下的用戶名／暱稱／簡介跑一次廣告模板庫掃描，回傳 (是否命中, 詳細原因列表)。
     改名重新檢測與訊息內判不出來時的畫像輔助判斷共用同一份邏輯。"""
@@ -400,18 +540,10 @@ async def _scan_profile_for_ad_signal(bot, user, bio: str = None) -> Tuple[bool,
             bio = user_chat.bio or ""
         except Exception:
             pass
-    reasons = []
-    profile_fields = (
-        ("用戶名", f"@{user.username}" if user.username else ""),
-        ("暱稱", user.full_name or ""),
-        ("簡介", bio),
-    )
-    for field_label, field_text in profile_fields:
-        if not field_text:
-            continue
-        hit, _score, hit_reason = detect_ad(field_text)
-        if hit:
-            reasons.append(f"{field_label}命中模板庫[{hit_reason}]")
+    reasons = [
+        f"{field_label}命中模板庫[{hit_reason}]"
+        for field_label, hit_reason in _profile_template_hits(user, bio)
+    ]
     return len(reasons) > 0, reasons
 
 
@@ -424,9 +556,8 @@ async def handle_profile_rename_check(update: Update, context: ContextTypes.DEFA
     user = update.effective_user
     if not message or not chat or not user or chat.type not in ("group", "supergroup"):
         return
-    if not feature_enabled(known_groups.get(chat.id, {}), "profile_check"):
-        return
-    if not feature_enabled(known_groups.get(chat.id, {}), "rename_recheck"):
+    group = known_groups.get(chat.id, {})
+    if not feature_enabled(group, "profile_check") or not feature_enabled(group, "rename_recheck"):
         return
 
     current = (user.username or "", user.full_name or "")
@@ -449,7 +580,7 @@ async def handle_profile_rename_check(update: Update, context: ContextTypes.DEFA
 
     logger.warning(f"🔁 改名後命中廣告模板庫: {user.id} {previous} → {current}, 原因: {reasons}")
 
-    if feature_enabled(known_groups.get(chat.id, {}), "profile_hit_report"):
+    if feature_enabled(group, "profile_hit_report"):
         await _notify_admin_group_silent(
             context.bot,
             f"🔁 <b>改名重新檢測命中</b>\n"
@@ -460,7 +591,7 @@ async def handle_profile_rename_check(update: Update, context: ContextTypes.DEFA
             f"原因：{', '.join(reasons)}",
         )
 
-    if not feature_enabled(known_groups.get(chat.id, {}), "join_captcha"):
+    if not feature_enabled(group, "join_captcha"):
         return  # 沒開公開驗證流程時，只靜默通報，不在群裡動作，交管理員自行判斷
 
     has_perms, _perm_msg = await check_bot_permissions(context.bot, chat.id)
@@ -502,10 +633,12 @@ async def handle_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 "type": chat.type,
                 "status": "unknown"
             }
-            save_known_groups()
+            save_known_groups(chat.id)
+
+        admin_index.observe(chat.id, user.id, new_status in ("administrator", "creator"))
 
         # DEBUG：記錄所有成員狀態變化
-        logger.info(f"📊 成員狀態變化: {user.full_name} | {old_status} → {new_status} | 群組: {chat.title}")
+        logger.info("📊 成員狀態變化: %s | %s → %s | 群組: %s", user.full_name, old_status, new_status, chat.title)
         
         # 成員離開
         if new_status in ["left", "kicked"] and old_status in ["member", "administrator", "restricted"]:
@@ -515,229 +648,252 @@ async def handle_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await context.bot.send_message(
                 chat.id,
                 f"{name} 離開了我們，我們會想念他的 👋",
-                parse_mode="HTML"
+                parse_mode="HTML",
+                rate_limit_args=PRIORITY_BULK,
             )
-            logger.info(f"👋 成員離開: {user.full_name} (ID: {user.id}) 離開 {chat.title}")
+            logger.info("👋 成員離開: %s (ID: %s) 離開 %s", user.full_name, user.id, chat.title)
             return
 
         if old_status in ["left", "kicked"] and new_status == "member":
-            logger.info(f"👤 新成員: {user.full_name} (ID: {user.id}) 加入 {chat.title}")
+            logger.info("👤 新成員: %s (ID: %s) 加入 %s", user.full_name, user.id, chat.title)
 
             # 防止 Telegram 對同一次入群重複送出 chat_member 事件，導致驗證流程被跑兩次
             if user.id in pending_verifications:
-                logger.info(f"⏭ 用戶 {user.id} 已有進行中的驗證流程，忽略重複事件")
+                logger.info("⏭ 用戶 %s 已有進行中的驗證流程，忽略重複事件", user.id)
                 return
 
             # 🛡 防護模式：完全靜默，不發任何提示，直接關閉所有權限並記錄名單，關閉時再統一處理
             if known_groups.get(chat.id, {}).get("guard_mode", False):
-                try:
-                    await context.bot.restrict_chat_member(
-                        chat_id=chat.id,
-                        user_id=user.id,
-                        permissions=create_simple_mute_permissions(),
-                    )
-                except Exception as e:
-                    logger.error(f"防護模式禁言失敗 chat={chat.id} user={user.id}: {e}")
-                known_groups[chat.id].setdefault("guard_joined", []).append({
-                    "id": user.id,
-                    "name": user.full_name or str(user.id),
-                })
-                save_known_groups()
+                _queue_guard_restrict(context.bot, chat.id, user.id)
+                recorded = _guard_ledger().append(chat.id, user.id, user.full_name or str(user.id))
                 logger.info(
-                    f"🛡 防護模式：新成員 {user.id} 已靜默禁言並記錄（{chat.id}），"
-                    f"目前名單共 {len(known_groups[chat.id]['guard_joined'])} 人"
+                    f"🛡 防護模式：新成員 {user.id} 已排入靜默禁言並記錄（{chat.id}），"
+                    f"目前名單共 {recorded} 人"
                 )
                 return
 
             # 記錄這次看到的 (用戶名, 暱稱) 基準值，供之後改名重新檢測比對
             known_profiles[user.id] = (user.username or "", user.full_name or "")
 
-            # 檢查用戶簡介
-            bio = ""
-            is_suspicious = False
-            hard_block = False
-            reasons = []
-            if feature_enabled(known_groups.get(chat.id, {}), "profile_check"):
-                try:
-                    user_chat = await context.bot.get_chat(user.id)
-                    bio = user_chat.bio or ""
-                    logger.info(f"📝 用戶 {user.id} 簡介: {bio[:50]}{'...' if len(bio) > 50 else ''}")
-                except Exception as e:
-                    logger.warning(f"無法獲取用戶 {user.id} 簡介: {e}")
-
-                # 檢查 @ 標籤
-                if re.search(r"@\w+", bio, re.IGNORECASE):
-                    is_suspicious = True
-                    reasons.append("@標籤")
-
-                # 檢查連結
-                if re.search(r"https?://|t\.me/", bio, re.IGNORECASE):
-                    is_suspicious = True
-                    reasons.append("網址/連結")
-
-                # 非中文名稱（純英文或其他非中文字元），群組情境下視為軟性可疑訊號
-                display_name = user.full_name or ""
-                if display_name.strip() and not re.search(r"[\u4e00-\u9fff]", display_name):
-                    is_suspicious = True
-                    reasons.append("非中文名稱")
-
-                # 用戶名／暱稱／簡介直接對廣告模板庫掃描（L1 正則 + L2 TF-IDF 相似度）
-                # 命中模板庫視為高置信度廣告帳號，標記 hard_block：不給自助驗證按鈕，只能由管理員手動解除
-                profile_fields = (
-                    ("用戶名", f"@{user.username}" if user.username else ""),
-                    ("暱稱", user.full_name or ""),
-                    ("簡介", bio),
-                )
-                for field_label, field_text in profile_fields:
-                    if not field_text:
-                        continue
-                    hit, _score, hit_reason = detect_ad(field_text)
-                    if hit:
-                        is_suspicious = True
-                        hard_block = True
-                        reasons.append(f"{field_label}命中模板庫[{hit_reason}]")
-
-            group_profile_hit_report = feature_enabled(known_groups.get(chat.id, {}), "profile_hit_report")
-            group_join_captcha = feature_enabled(known_groups.get(chat.id, {}), "join_captcha")
-
-            if hard_block:
-                logger.warning(f"🚫 高置信度廣告帳號: {user.id}, 原因: {reasons}")
-
-                if group_profile_hit_report and _has_template_hit(reasons):
-                    await _notify_admin_group_silent(
-                        context.bot,
-                        f"🚫 <b>入群高置信度廣告帳號</b>\n"
-                        f"群組：{chat.title}（{chat.id}）\n"
-                        f"用戶：{user.mention_html()}\n"
-                        f"原因：{', '.join(reasons)}",
-                    )
-
-                has_perms, perm_msg = await check_bot_permissions(context.bot, chat.id)
-                if not has_perms:
-                    await context.bot.send_message(
-                        chat.id,
-                        f"⚠️ 檢測到高置信度廣告帳號但權限不足\n{perm_msg}",
-                        parse_mode="HTML"
-                    )
-                    return
-
-                try:
-                    await context.bot.restrict_chat_member(
-                        chat_id=chat.id,
-                        user_id=user.id,
-                        permissions=create_simple_mute_permissions(),
-                    )
-                    await context.bot.send_message(
-                        chat.id,
-                        f"🚫 {user.mention_html()} 帳號資料命中異常規則（{_public_reason_text(reasons)}），"
-                        f"已直接禁言，不提供自助驗證，需管理員手動確認後解除。",
-                        parse_mode="HTML"
-                    )
-                except Exception as e:
-                    logger.error(f"高置信度廣告帳號禁言失敗: {e}")
-                return
+            # 簡介讀取、帳號畫像掃描與後續處置交給入群管線，handler 立即返回，
+            # 炸群時不會讓 polling 迴圈卡在逐一處理上
+            join_pipeline.submit(
+                chat.id,
+                ("scan", user.id),
+                tracer.bind("join_scan", lambda: _scan_join(context.bot, chat, user)),
+                PRIORITY_SCAN,
+            )
 
-            if is_suspicious:
-                logger.info(f"⚠️ 可疑用戶: {user.id}, 原因: {reasons}")
-
-                if group_profile_hit_report and _has_template_hit(reasons):
-                    await _notify_admin_group_silent(
-                        context.bot,
-                        f"⚠️ <b>入群可疑帳號</b>\n"
-                        f"群組：{chat.title}（{chat.id}）\n"
-                        f"用戶：{user.mention_html()}\n"
-                        f"原因：{', '.join(reasons)}",
-                    )
-
-                has_perms, perm_msg = await check_bot_permissions(context.bot, chat.id)
-                if not has_perms:
-                    await context.bot.send_message(
-                        chat.id,
-                        f"⚠️ 檢測到可疑用戶但權限不足\n{perm_msg}",
-                        parse_mode="HTML"
-                    )
-                    return
-
-                try:
-                    # 完全禁言（禁止所有功能）
-                    await context.bot.restrict_chat_member(
-                        chat_id=chat.id,
-                        user_id=user.id,
-                        permissions=create_simple_mute_permissions(),
-                    )
-
-                    if not group_join_captcha:
-                        # 關閉公開驗證流程：靜默禁言 + （已於上方）私下通報，交管理員自行判斷解除，
-                        # 群組內不出現任何提示，避免公開挑戰流程本身也被拿去研究規避。
-                        logger.info(f"🔕 靜默模式（join_captcha 關閉）：{user.id} 已禁言但不公開提示")
-                        return
-
-                    # 記錄待驗證信息（此時還沒出題，題目留到按下開始驗證才產生）
-                    pending_verifications[user.id] = {
-                        "chat_id": chat.id,
-                        "user_name": user.mention_html(),
-                        "reasons": reasons,
-                        "timestamp": time.time(),
-                        "needs_welcome": True,  # 標記需要歡迎
-                        "captcha_answer": None,
-                        "attempts": 0,
-                        "message_ref": None,
-                    }
-
-                    keyboard = []
-                    verify_text = (
-                        f"⚠️ {user.mention_html()} 需要人機驗證（{_public_reason_text(reasons)}）\n"
-                    )
-                    if web_verification_server:
-                        token = web_verification_server.create_session(user.id, chat.id)
-                        pending_verifications[user.id]["web_token"] = token
-                        keyboard = [[
-                            InlineKeyboardButton("🌐 開啟網頁驗證", url=web_verification_server.url(token))
-                        ]]
-                        verify_text += "請點下方按鈕，完成數字圖片與 Cloudflare 驗證（5 分鐘內有效）"
-                    else:
-                        keyboard = [[
-                            InlineKeyboardButton("🔍 開始真人驗證", callback_data=f"captchastart_{user.id}")
-                        ]]
-                        verify_text += f"請點下方按鈕開始驗證（{VERIFY_ATTEMPT_LIMIT} 次機會，30 分鐘內有效）"
-
-                    sent = await context.bot.send_message(
-                        chat.id,
-                        verify_text,
-                        reply_markup=InlineKeyboardMarkup(keyboard),
-                        parse_mode="HTML"
-                    )
-                    pending_verifications[user.id]["message_ref"] = {
-                        "chat_id": sent.chat_id,
-                        "message_id": sent.message_id,
-                    }
-                    cleanup_delay = 300 if web_verification_server else 1800
-                    asyncio.create_task(_expire_verification(
-                        context.bot,
-                        user.id,
-                        cleanup_delay,
-                        pending_verifications[user.id]["timestamp"],
-                    ))
-
-                except Exception as e:
-                    logger.error(f"禁言失敗: {e}")
-            
-            else:
-                # 不可疑的用戶，立即發送歡迎消息
-                await send_welcome_message(
-                    context.bot, 
-                    chat.id, 
-                    user.id, 
-                    user.mention_html(),
-                    force_send=True
-                )
-                    
     except Exception as e:
         logger.error(f"處理成員失敗: {e}")
 
+
+def _assess_join_profile(user, bio: str, check_profile: bool) -> Tuple[bool, bool, list]:
+    """入群帳號畫像判定（CPU 密集，於入群管線的執行緒池執行）。
+    回傳 (是否可疑, 是否命中模板庫需直接封鎖, 原因列表)。"""
+    is_suspicious = False
+    hard_block = False
+    reasons = []
+    if not check_profile:
+        return is_suspicious, hard_block, reasons
+
+    # 檢查 @ 標籤
+    if re.search(r"@\w+", bio, re.IGNORECASE):
+        is_suspicious = True
+        reasons.append("@標籤")
+
+    # 檢查連結
+    if re.search(r"https?://|t\.me/", bio, re.IGNORECASE):
+        is_suspicious = True
+        reasons.append("網址/連結")
+
+    # 非中文名稱（純英文或其他非中文字元），群組情境下視為軟性可疑訊號
+    display_name = user.full_name or ""
+    if display_name.strip() and not re.search(r"[\u4e00-\u9fff]", display_name):
+        is_suspicious = True
+        reasons.append("非中文名稱")
+
+    # 用戶名／暱稱／簡介直接對廣告模板庫掃描（L1 正則 + L2 TF-IDF 相似度）
+    # 命中模板庫視為高置信度廣告帳號，標記 hard_block：不給自助驗證按鈕，只能由管理員手動解除
+    for field_label, hit_reason in _profile_template_hits(user, bio):
+        is_suspicious = True
+        hard_block = True
+        reasons.append(f"{field_label}命中模板庫[{hit_reason}]")
+    return is_suspicious, hard_block, reasons
+
+
+async def _scan_join(bot, chat, user):
+    """入群管線第一段：讀取簡介、在執行緒池掃描帳號畫像，再把處置排回管線。
+    可疑帳號的禁言以最高優先權插隊，排在其他還沒掃描的新成員前面。"""
+    bio = ""
+    check_profile = feature_enabled(known_groups.get(chat.id, {}), "profile_check")
+    if check_profile:
+        try:
+            user_chat = await bot.get_chat(user.id)
+            bio = user_chat.bio or ""
+            logger.info("📝 用戶 %s 簡介: %s%s", user.id, bio[:50], "..." if len(bio) > 50 else "")
+        except Exception as e:
+            logger.warning(f"無法獲取用戶 {user.id} 簡介: {e}")
+
+    with span("profile_scan"):
+        is_suspicious, hard_block, reasons = await join_pipeline.run_in_worker(
+            _assess_join_profile, user, bio, check_profile
+        )
+    if is_suspicious:
+        key, priority = ("restrict", user.id), PRIORITY_RESTRICT
+    else:
+        key, priority = ("welcome", user.id), PRIORITY_WELCOME
+    join_pipeline.submit(
+        chat.id,
+        key,
+        tracer.bind("join_act", lambda: _act_on_join(bot, chat, user, is_suspicious, hard_block, reasons)),
+        priority,
+    )
+
+
+async def _act_on_join(bot, chat, user, is_suspicious: bool, hard_block: bool, reasons: list):
+    """入群管線第二段：依帳號畫像判定結果禁言、發驗證或歡迎。"""
+    group = known_groups.get(chat.id, {})
+    group_profile_hit_report = feature_enabled(group, "profile_hit_report")
+    group_join_captcha = feature_enabled(group, "join_captcha")
+
+    if hard_block:
+        logger.warning(f"🚫 高置信度廣告帳號: {user.id}, 原因: {reasons}")
+
+        if group_profile_hit_report and _has_template_hit(reasons):
+            await _notify_admin_group_silent(
+                bot,
+                f"🚫 <b>入群高置信度廣告帳號</b>\n"
+                f"群組：{chat.title}（{chat.id}）\n"
+                f"用戶：{user.mention_html()}\n"
+                f"原因：{', '.join(reasons)}",
+            )
+
+        has_perms, perm_msg = await check_bot_permissions(bot, chat.id)
+        if not has_perms:
+            await bot.send_message(
+                chat.id,
+                f"⚠️ 檢測到高置信度廣告帳號但權限不足\n{perm_msg}",
+                parse_mode="HTML"
+            )
+            return
+
+        try:
+            await bot.restrict_chat_member(
+                chat_id=chat.id,
+                user_id=user.id,
+                permissions=create_simple_mute_permissions(),
+            )
+            await bot.send_message(
+                chat.id,
+                f"🚫 {user.mention_html()} 帳號資料命中異常規則（{_public_reason_text(reasons)}），"
+                f"已直接禁言，不提供自助驗證，需管理員手動確認後解除。",
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            logger.error(f"高置信度廣告帳號禁言失敗: {e}")
+        return
+
+    if is_suspicious:
+        logger.info("⚠️ 可疑用戶: %s, 原因: %s", user.id, reasons)
+
+        if group_profile_hit_report and _has_template_hit(reasons):
+            await _notify_admin_group_silent(
+                bot,
+                f"⚠️ <b>入群可疑帳號</b>\n"
+                f"群組：{chat.title}（{chat.id}）\n"
+                f"用戶：{user.mention_html()}\n"
+                f"原因：{', '.join(reasons)}",
+            )
+
+        has_perms, perm_msg = await check_bot_permissions(bot, chat.id)
+        if not has_perms:
+            await bot.send_message(
+                chat.id,
+                f"⚠️ 檢測到可疑用戶但權限不足\n{perm_msg}",
+                parse_mode="HTML"
+            )
+            return
+
+        try:
+            # 完全禁言（禁止所有功能）
+            await bot.restrict_chat_member(
+                chat_id=chat.id,
+                user_id=user.id,
+                permissions=create_simple_mute_permissions(),
+            )
+
+            if not group_join_captcha:
+                # 關閉公開驗證流程：靜默禁言 + （已於上方）私下通報，交管理員自行判斷解除，
+                # 群組內不出現任何提示，避免公開挑戰流程本身也被拿去研究規避。
+                logger.info(f"🔕 靜默模式（join_captcha 關閉）：{user.id} 已禁言但不公開提示")
+                return
+
+            # 記錄待驗證信息（此時還沒出題，題目留到按下開始驗證才產生）
+            pending_verifications[user.id] = {
+                "chat_id": chat.id,
+                "user_name": user.mention_html(),
+                "reasons": reasons,
+                "timestamp": time.time(),
+                "needs_welcome": True,  # 標記需要歡迎
+                "captcha_answer": None,
+                "attempts": 0,
+                "message_ref": None,
+            }
+
+            keyboard = []
+            verify_text = (
+                f"⚠️ {user.mention_html()} 需要人機驗證（{_public_reason_text(reasons)}）\n"
+            )
+            if web_verification_server:
+                token = web_verification_server.create_session(user.id, chat.id)
+                pending_verifications[user.id]["web_token"] = token
+                pending_verifications.save(user.id)
+                keyboard = [[
+                    InlineKeyboardButton("🌐 開啟網頁驗證", url=web_verification_server.url(token))
+                ]]
+                verify_text += "請點下方按鈕，完成數字圖片與 Cloudflare 驗證（5 分鐘內有效）"
+            else:
+                keyboard = [[
+                    InlineKeyboardButton("🔍 開始真人驗證", callback_data=f"captchastart_{user.id}")
+                ]]
+                verify_text += f"請點下方按鈕開始驗證（{VERIFY_ATTEMPT_LIMIT} 次機會，30 分鐘內有效）"
+
+            sent = await bot.send_message(
+                chat.id,
+                verify_text,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode="HTML"
+            )
+            pending_verifications[user.id]["message_ref"] = {
+                "chat_id": sent.chat_id,
+                "message_id": sent.message_id,
+            }
+            pending_verifications.save(user.id)
+            cleanup_delay = 300 if web_verification_server else 1800
+            _schedule_verification_expiry(
+                user.id,
+                cleanup_delay,
+                pending_verifications[user.id]["timestamp"],
+            )
+
+        except Exception as e:
+            logger.error(f"禁言失敗: {e}")
+
+    else:
+        # 不可疑的用戶，發送歡迎消息
+        await send_welcome_message(
+            bot,
+            chat.id,
+            user.id,
+            user.mention_html(),
+            force_send=True
+        )
+
 # ================== 圖片算術驗證碼 ==================
+@functools.lru_cache(maxsize=None)
 def _load_captcha_font(size: int):
-    """嘗試載入系統字型，找不到就退回 Pillow 內建字型。"""
+    """嘗試載入系統字型，找不到就退回 Pillow 內建字型（每個字級只載入一次）。"""
     candidates = [
         "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
         "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
@@ -755,8 +911,8 @@ def _load_captcha_font(size: int):
         return ImageFont.load_default()
 
 
-def generate_math_captcha():
-    """產生一題簡單算術驗證碼圖片。回傳 (圖片 BytesIO, 正確答案:int)。"""
+def _render_math_captcha():
+    """繪製一題算術驗證碼。回傳 (正確答案:int, PNG bytes)，由 math_captcha_pool 在背景呼叫。"""
     op = random.choice(["+", "-", "×"])
     if op == "+":
         a, b = random.randint(1, 20), random.randint(1, 20)
@@ -795,12 +951,89 @@ def generate_math_captcha():
         x_cursor += 22 if ch != " " else 12
 
     buf = io.BytesIO()
-    buf.name = "captcha.png"
     img.save(buf, "PNG")
-    buf.seek(0)
+    return answer, buf.getvalue()
+
+
+math_captcha_pool = CaptchaPool(_render_math_captcha, name="math-captcha-pool")
+# 預產生池用完時在這裡補畫，不佔用事件迴圈；排隊上限避免瞬間大量點擊堆積工作
+captcha_render_executor = RenderExecutor(name="math-captcha-render")
+captcha_photo_latency = histogram(
+    "captcha_click_to_photo_seconds", "從點擊驗證按鈕到題目圖片送出的時間",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0),
+)
+
+
+async def generate_math_captcha():
+    """取一題預先產生的算術驗證碼。回傳 (圖片 BytesIO, 正確答案:int)。"""
+    answer, png = await math_captcha_pool.take_async(captcha_render_executor)
+    buf = io.BytesIO(png)
+    buf.name = "captcha.png"
     return buf, answer
 
 
+captcha_library: Optional[CaptchaLibrary] = None
+
+
+async def _upload_library_captcha():
+    """題庫補充：上傳一題到 CAPTCHA_UPLOAD_CHAT_ID 取得 file_id，隨即刪掉那則訊息。
+
+    直接交給 captcha_render_executor 繪製，不從 math_captcha_pool 取題，
+    以免題庫補充被算成入群需求、讓預產生池跟著加大。
+    """
+    answer, png = await captcha_render_executor.run(_render_math_captcha)
+    captcha_img = io.BytesIO(png)
+    captcha_img.name = "captcha.png"
+    try:
+        sent = await application_bot.send_photo(
+            CAPTCHA_UPLOAD_CHAT_ID, photo=captcha_img, disable_notification=True,
+            rate_limit_args=PRIORITY_BULK,
+        )
+    except Exception as e:
+        logger.warning(f"驗證碼題庫上傳失敗: {e}")
+        return None
+    try:
+        await sent.delete()
+    except Exception:
+        pass
+    photo = sent.photo[-1]
+    return photo.file_id, photo.file_unique_id, answer
+
+
+async def _send_math_captcha(bot, user_id: int, verify_info: dict, caption: str):
+    """送出一題算術驗證碼（優先用題庫 file_id，失效時改送新圖），更新 verify_info 並回傳送出的訊息。"""
+    hit = captcha_library.take() if captcha_library else None
+    while True:
+        if hit:
+            photo, answer = hit
+        else:
+            photo, answer = await generate_math_captcha()
+        options = _generate_captcha_options(answer)
+        verify_info["captcha_answer"] = answer
+        pending_verifications.save(user_id)
+        keyboard = [[
+            InlineKeyboardButton(str(opt), callback_data=f"captcha_{user_id}_{opt}")
+            for opt in options
+        ]]
+        try:
+            sent = await bot.send_photo(
+                verify_info["chat_id"],
+                photo=photo,
+                caption=caption,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode="HTML",
+            )
+        except BadRequest as e:
+            if not hit:
+                raise
+            logger.warning(f"題庫 file_id 失效，改送新圖: {e}")
+            captcha_library.forget(photo)
+            hit = None
+            continue
+        # 當場上傳的新圖不收進題庫：群組成員已看過，題庫也只由背景補充維持上限
+        return sent
+
+
 def _generate_captcha_options(answer: int, count: int = 4) -> list:
     """產生含正確答案在內、隨機排序的選項清單。"""
     options = {answer}
@@ -817,6 +1050,7 @@ def _generate_captcha_options(answer: int, count: int = 4) -> list:
 async def on_captcha_start_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """處理「🔍 開始真人驗證」按鈕（captchastart_{user_id}）：點下去才產生題目與選項，
     擋掉單純隨機亂點一次就走的機器人。"""
+    clicked_at = time.perf_counter()
     query = update.callback_query
     if not query or not query.data:
         return
@@ -839,36 +1073,27 @@ async def on_captcha_start_click(update: Update, context: ContextTypes.DEFAULT_T
 
     if time.time() - verify_info["timestamp"] > 1800:
         await query.edit_message_text("❌ 驗證已過期（超過30分鐘）", reply_markup=None)
-        asyncio.create_task(_delete_after(query.message, 5))
+        _delete_after(query.message, 5)
         del pending_verifications[user_id]
         return
 
-    captcha_img, answer = generate_math_captcha()
-    options = _generate_captcha_options(answer)
-    verify_info["captcha_answer"] = answer
-
-    keyboard = [[
-        InlineKeyboardButton(str(opt), callback_data=f"captcha_{user_id}_{opt}")
-        for opt in options
-    ]]
-
     try:
         await query.message.delete()
     except Exception:
         pass
 
-    sent = await context.bot.send_photo(
-        verify_info["chat_id"],
-        photo=captcha_img,
-        caption=f"{verify_info['user_name']} 請點選圖片中算式的正確答案（剩餘 {VERIFY_ATTEMPT_LIMIT - verify_info['attempts']} 次機會）",
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="HTML",
+    sent = await _send_math_captcha(
+        context.bot, user_id, verify_info,
+        f"{verify_info['user_name']} 請點選圖片中算式的正確答案（剩餘 {VERIFY_ATTEMPT_LIMIT - verify_info['attempts']} 次機會）",
     )
+    captcha_photo_latency.observe(time.perf_counter() - clicked_at)
     verify_info["message_ref"] = {"chat_id": sent.chat_id, "message_id": sent.message_id}
+    pending_verifications.save(user_id)
 
 
 async def on_captcha_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """處理圖片算術驗證碼的選項按鈕（captcha_{user_id}_{選項}）。"""
+    clicked_at = time.perf_counter()
     query = update.callback_query
     if not query:
         return
@@ -899,7 +1124,7 @@ async def on_captcha_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if time.time() - verify_info["timestamp"] > 1800:
             await query.edit_message_caption(caption="❌ 驗證已過期（超過30分鐘）", reply_markup=None)
-            asyncio.create_task(_delete_after(query.message, 5))
+            _delete_after(query.message, 5)
             del pending_verifications[user_id]
             return
 
@@ -911,31 +1136,22 @@ async def on_captcha_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     caption=f"❌ 已達最大嘗試次數（{VERIFY_ATTEMPT_LIMIT}次），請聯繫管理員手動處理。",
                     reply_markup=None,
                 )
-                asyncio.create_task(_delete_after(query.message, 8))
+                _delete_after(query.message, 8)
                 return
 
             # 答錯，重新出題，舊題目直接刪除避免洗版
-            captcha_img, answer = generate_math_captcha()
-            options = _generate_captcha_options(answer)
-            verify_info["captcha_answer"] = answer
             remaining = VERIFY_ATTEMPT_LIMIT - verify_info["attempts"]
-
-            keyboard = [[
-                InlineKeyboardButton(str(opt), callback_data=f"captcha_{user_id}_{opt}")
-                for opt in options
-            ]]
             try:
                 await query.message.delete()
             except Exception:
                 pass
-            sent = await context.bot.send_photo(
-                chat_id,
-                photo=captcha_img,
-                caption=f"{verify_info['user_name']} ❌ 答錯了，請見新題目（剩餘 {remaining} 次機會）",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="HTML",
+            sent = await _send_math_captcha(
+                context.bot, user_id, verify_info,
+                f"{verify_info['user_name']} ❌ 答錯了，請見新題目（剩餘 {remaining} 次機會）",
             )
+            captcha_photo_latency.observe(time.perf_counter() - clicked_at)
             verify_info["message_ref"] = {"chat_id": sent.chat_id, "message_id": sent.message_id}
+            pending_verifications.save(user_id)
             return
 
         # 答對，解除禁言
@@ -962,7 +1178,7 @@ async def on_captcha_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode="HTML",
                 reply_markup=None,
             )
-            asyncio.create_task(_delete_after(query.message, 5))
+            _delete_after(query.message, 5)
         except Exception as e:
             logger.error(f"解除禁言失敗: {e}")
             await query.edit_message_caption(caption=f"❌ 解除禁言失敗: {str(e)[:100]}", reply_markup=None)
@@ -1102,31 +1318,76 @@ def build_referendum_keyboard(chat_id: int) -> InlineKeyboardMarkup:
     ]]
     return InlineKeyboardMarkup(keyboard)
 
-async def update_referendum_message(context, chat_id: int, query=None):
-    """更新公投訊息"""
+async def _send_referendum_edit(context, chat_id: int, ref: Dict, text: str, priority: int) -> bool:
+    """把公投訊息改成 text；成功後才記下 rendered_text，失敗的內容下次仍會重送。
+    一律走 bot.edit_message_text（CallbackQuery.edit_message_text 不接受 rate_limit_args）。"""
+    ref["last_edit_at"] = time.monotonic()
+    try:
+        await context.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=ref["message_id"],
+            text=text,
+            reply_markup=build_referendum_keyboard(chat_id),
+            parse_mode="HTML",
+            rate_limit_args=priority,
+        )
+    except Exception as e:
+        logger.warning(f"更新公投訊息失敗: {e}")
+        return False
+    ref["rendered_text"] = text
+    return True
+
+async def _edit_referendum_message(context, chat_id: int, priority: int = PRIORITY_BULK):
+    """立即把公投訊息改成目前票數（內容沒變就不送）"""
     ref = active_referendums.get(chat_id)
     if not ref:
         return
     text = build_referendum_text(chat_id)
-    keyboard = build_referendum_keyboard(chat_id)
-    try:
-        if query:
-            await query.edit_message_text(text, reply_markup=keyboard, parse_mode="HTML")
-        else:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=ref["message_id"],
-                text=text,
-                reply_markup=keyboard,
-                parse_mode="HTML"
-            )
-    except Exception as e:
-        logger.warning(f"更新公投訊息失敗: {e}")
+    if text == ref.get("rendered_text"):
+        return
+    await _send_referendum_edit(context, chat_id, ref, text, priority)
 
-async def observation_timer(context, chat_id: int):
-    """30 秒追平觀察期計時器"""
-    await asyncio.sleep(30)
+def _cancel_referendum_edit(ref: Optional[Dict]):
+    """取消尚未送出的合併編輯（狀態轉換或公投結束時）"""
+    task = ref.get("edit_task") if ref else None
+    if task and not task.done():
+        task.cancel()
+    if ref:
+        ref["edit_task"] = None
+
+async def _deferred_referendum_edit(context, chat_id: int, delay: float):
+    await asyncio.sleep(delay)
+    ref = active_referendums.get(chat_id)
+    if not ref:
+        return
+    ref["edit_task"] = None
+    # 到點才組字，反映等待期間累積的所有投票
+    await _edit_referendum_message(context, chat_id)
+
+async def update_referendum_message(context, chat_id: int, immediate: bool = False):
+    """更新公投訊息：同一場公投每 REFERENDUM_EDIT_INTERVAL 秒最多編輯一次，狀態轉換時立即送出"""
+    ref = active_referendums.get(chat_id)
+    if not ref:
+        return
+    if immediate:
+        _cancel_referendum_edit(ref)
+        await _edit_referendum_message(context, chat_id, PRIORITY_NOTICE)
+        return
+    pending = ref.get("edit_task")
+    if pending and not pending.done():
+        return  # 已排定的編輯會帶上這一票
+    wait = ref.get("last_edit_at", 0.0) + REFERENDUM_EDIT_INTERVAL - time.monotonic()
+    if wait <= 0:
+        await _edit_referendum_message(context, chat_id)
+    else:
+        ref["edit_task"] = asyncio.create_task(_deferred_referendum_edit(context, chat_id, wait))
 
+async def _observation_job(payload: dict):
+    """排程工作：觀察期結束（公投函式只用到 context.bot）"""
+    await observation_timer(SimpleNamespace(bot=application_bot), payload["chat_id"])
+
+async def observation_timer(context, chat_id: int):
+    """30 秒追平觀察期到期：判定勝負或進入下一輪"""
     ref = active_referendums.get(chat_id)
     if not ref or ref["state"] != "observation":
         return
@@ -1147,7 +1408,7 @@ async def observation_timer(context, chat_id: int):
         else:
             await end_referendum(context, chat_id, "❌ 反對方勝出，公投遭否決！")
 
-async def advance_to_next_round(context, chat_id: int, query=None):
+async def advance_to_next_round(context, chat_id: int):
     """進入下一輪延長投票"""
     ref = active_referendums.get(chat_id)
     if not ref:
@@ -1158,27 +1419,14 @@ async def advance_to_next_round(context, chat_id: int, query=None):
     ref["leading_option"] = None
     new_target = ref["current_target"]
 
-    text = build_referendum_text(chat_id)
-    keyboard = build_referendum_keyboard(chat_id)
+    _cancel_referendum_edit(ref)
     notice = f"\n\n🔄 <b>雙方追平！進入延長投票，新目標：{new_target} 票</b>"
-
-    try:
-        if query:
-            await query.edit_message_text(text + notice, reply_markup=keyboard, parse_mode="HTML")
-        else:
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=ref["message_id"],
-                text=text + notice,
-                reply_markup=keyboard,
-                parse_mode="HTML"
-            )
-    except Exception as e:
-        logger.warning(f"更新延長投票訊息失敗: {e}")
+    await _send_referendum_edit(context, chat_id, ref, build_referendum_text(chat_id) + notice, PRIORITY_NOTICE)
 
 async def execute_group_mute(context, chat_id: int):
     """執行公投通過：全員禁言 5 分鐘"""
     ref = active_referendums.pop(chat_id, None)
+    _cancel_referendum_edit(ref)
 
     try:
         mute_perms = create_simple_mute_permissions()
@@ -1194,21 +1442,27 @@ async def execute_group_mute(context, chat_id: int):
                     chat_id=chat_id,
                     message_id=ref["message_id"],
                     text=result_text,
-                    parse_mode="HTML"
+                    parse_mode="HTML",
+                    rate_limit_args=PRIORITY_NOTICE,
                 )
         except Exception:
             await context.bot.send_message(chat_id, result_text, parse_mode="HTML")
 
-        asyncio.create_task(delayed_group_unmute(context.bot, chat_id, 5))
+        delayed_group_unmute(chat_id, 5)
         logger.info(f"🔇 全員禁言已執行: 群組 {chat_id}")
 
     except Exception as e:
         logger.error(f"全員禁言失敗: {e}")
         await context.bot.send_message(chat_id, f"❌ 執行禁言失敗: {e}")
 
-async def delayed_group_unmute(bot, chat_id: int, minutes: int):
-    """延遲解除全員禁言"""
-    await asyncio.sleep(minutes * 60)
+def delayed_group_unmute(chat_id: int, minutes: int):
+    """排程延遲解除全員禁言（重啟後仍會執行，不會讓群組一直禁言）"""
+    _timers().schedule("group_unmute", minutes * 60, {"chat_id": chat_id}, f"group_unmute:{chat_id}")
+
+async def _group_unmute_job(payload: dict):
+    """排程工作：解除全員禁言"""
+    bot = application_bot
+    chat_id = payload["chat_id"]
     try:
         permissions = create_simple_unmute_permissions()
         await bot.set_chat_permissions(chat_id, permissions)
@@ -1220,18 +1474,20 @@ async def delayed_group_unmute(bot, chat_id: int, minutes: int):
 async def end_referendum(context, chat_id: int, message: str):
     """結束公投（否決）"""
     ref = active_referendums.pop(chat_id, None)
+    _cancel_referendum_edit(ref)
     try:
         if ref:
             await context.bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=ref["message_id"],
                 text=f"🗳️ <b>公投結束</b>\n{message}",
-                parse_mode="HTML"
+                parse_mode="HTML",
+                rate_limit_args=PRIORITY_NOTICE,
             )
     except Exception as e:
         logger.warning(f"結束公投訊息更新失敗: {e}")
 
-async def check_referendum_state(context, chat_id: int, query=None):
+async def check_referendum_state(context, chat_id: int):
     """每次投票後檢查公投狀態"""
     ref = active_referendums.get(chat_id)
     if not ref:
@@ -1247,18 +1503,14 @@ async def check_referendum_state(context, chat_id: int, query=None):
             leading = "yes" if yes_count >= target else "no"
             ref["state"] = "observation"
             ref["leading_option"] = leading
-            await update_referendum_message(context, chat_id, query)
+            await update_referendum_message(context, chat_id, immediate=True)
 
-            # 取消舊計時器（如有）
-            old_task = ref.get("observation_task")
-            if old_task and not old_task.done():
-                old_task.cancel()
-
-            ref["observation_task"] = asyncio.create_task(
-                observation_timer(context, chat_id)
+            # 同一群組的觀察期工作 id 固定，重新排程會取代舊計時器
+            ref["observation_job"] = _timers().schedule(
+                "observation", 30, {"chat_id": chat_id}, f"observation:{chat_id}"
             )
         else:
-            await update_referendum_message(context, chat_id, query)
+            await update_referendum_message(context, chat_id)
 
     elif ref["state"] == "observation":
         leading = ref["leading_option"]
@@ -1266,12 +1518,10 @@ async def check_referendum_state(context, chat_id: int, query=None):
 
         if trailing_count >= target:
             # 追平！取消計時器，進入下一輪
-            old_task = ref.get("observation_task")
-            if old_task and not old_task.done():
-                old_task.cancel()
-            await advance_to_next_round(context, chat_id, query)
+            _timers().cancel(ref.get("observation_job"))
+            await advance_to_next_round(context, chat_id)
         else:
-            await update_referendum_message(context, chat_id, query)
+            await update_referendum_message(context, chat_id)
 
 async def referendum_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """處理 /vote 指令"""
@@ -1303,7 +1553,7 @@ async def referendum_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "current_target": 3,
         "state": "voting",
         "leading_option": None,
-        "observation_task": None,
+        "observation_job": None,
         "message_id": None,
     }
 
@@ -1346,7 +1596,7 @@ async def on_referendum_vote(update: Update, context: ContextTypes.DEFAULT_TYPE)
         ref["no_votes"].add(voter_id)
         await query.answer("❌ 已投反對票")
 
-    await check_referendum_state(context, chat_id, query)
+    await check_referendum_state(context, chat_id)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1422,8 +1672,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/vote - 發起禁言公投\n"
         "/addsample - 加入廣告樣本\n"
         "/whitelist - 加入非廣告樣本\n"
-        "/samples [wl] - 檢視並刪除動態樣本庫內容（wl 看白樣本庫）\n"
+        "/samples [wl] [關鍵字] - 分頁檢視、搜尋並刪除動態樣本庫內容（wl 看白樣本庫）\n"
         "/exportsamples - 匯出樣本庫\n"
+        "/traces - 查看各處理流程耗時與慢 trace\n"
         "/cleanupads - 整理並去除廣告樣本重複項\n"
         "/test - 開始逐則測試（/stop 結束）\n"
         "/guard - 防護模式（別名 /omg，靜默禁言新加入者並記錄名單，/stop 解除後可選擇踢出）\n"
@@ -1470,8 +1721,9 @@ async def guard_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     known_groups.setdefault(chat.id, {"title": chat.title or str(chat.id), "status": "active"})
     known_groups[chat.id]["title"] = chat.title or str(chat.id)
     known_groups[chat.id]["guard_mode"] = True
-    known_groups[chat.id]["guard_joined"] = []
-    save_known_groups()
+    known_groups[chat.id].pop("guard_joined", None)
+    await asyncio.to_thread(_guard_ledger().reset, chat.id)
+    save_known_groups(chat.id)
 
     logger.warning(f"🛡 防護模式已由 {user.id} 於群組 {chat.id} 啟動")
     await message.reply_text(
@@ -1617,13 +1869,19 @@ async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     known_groups[chat.id]["guard_mode"] = False
-    joined = known_groups[chat.id].get("guard_joined", [])
-    known_groups[chat.id]["guard_joined"] = []
+    # 舊版把名單存在群組紀錄的 guard_joined；升級當下若還在防護中一併讀出
+    legacy_joined = known_groups[chat.id].pop("guard_joined", [])
+    ledger = _guard_ledger()
+    # 讀名單會先 fsync 再整份解析，放到背景執行緒
+    joined = await asyncio.to_thread(ledger.read, chat.id)
+    recorded_ids = {u["id"] for u in joined}
+    joined = [u for u in legacy_joined if u["id"] not in recorded_ids] + joined
+    await asyncio.to_thread(ledger.reset, chat.id)
     logger.warning(
         f"🛡 防護模式已由 {user.id} 於群組 {chat.id} 解除，"
         f"讀到的名單: {joined}"
     )
-    save_known_groups()
+    save_known_groups(chat.id)
 
     await message.reply_text(f"🛑 已停止測試模式。\n🛡 防護模式已解除（期間共 {len(joined)} 人加入）。")
 
@@ -1719,7 +1977,7 @@ async def banme(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         # 2分鐘後解除
-        asyncio.create_task(delayed_unmute(context.bot, chat.id, user.id, 2))
+        delayed_unmute(chat.id, user.id, 2)
         
     except Exception as e:
         logger.error(f"/banme 失敗: {e}")
@@ -1756,10 +2014,61 @@ async def list_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
         groups_text += f"{idx}. {title}\n   ID: `{chat_id}`\n\n"
     
     groups_text += f"總計: {len(known_groups)} 個群組"
+    groups_text += f"\n排程工作: {_timers().pending()} 個"
+    if captcha_library:
+        library = captcha_library.stats()
+        groups_text += f"\n驗證碼題庫: {library['entries']} 題（已重複使用 {library['served']} 次）"
+    latency = captcha_photo_latency.summary()
+    if latency["count"]:
+        groups_text += (
+            f"\n驗證碼出圖: p50 {latency['p50']:.2f}s / p95 {latency['p95']:.2f}s（{latency['count']} 次）"
+        )
     
     await update.message.reply_text(groups_text, parse_mode="Markdown")
 
 
+def _format_trace_tree(node: dict, depth: int = 0, limit: int = 12) -> list:
+    """把慢 trace 的 span 樹攤平成縮排文字行（只列前幾個子 span）。"""
+    ms = node.get("ms")
+    error = f" ⚠️{node['error']}" if node.get("error") else ""
+    lines = [f"{'  ' * depth}{node['name']} {ms if ms is not None else '?'}ms{error}"]
+    for child in node.get("children", [])[:limit]:
+        lines.extend(_format_trace_tree(child, depth + 1, limit))
+    return lines
+
+
+async def traces_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/traces：各 handler 的 p50/p99 與最近幾條慢 trace 的耗時分解（Owner，私聊）。"""
+    user = update.effective_user
+    chat = update.effective_chat
+    if chat.type != "private":
+        await update.message.reply_text("❌ 此指令僅在私聊中可用！")
+        return
+    if user.id != OWNER_ID:
+        await update.message.reply_text(f"❌ 僅管理員可用 (ID: {OWNER_ID})")
+        return
+
+    rows = tracer.summary()
+    if not rows:
+        await update.message.reply_text("📭 尚無 trace 紀錄")
+        return
+    lines = [f"⏱ Handler 耗時（共 {tracer.traces} 條，慢 trace {tracer.slow} 條，門檻 {tracer.slow_threshold:g}s）", ""]
+    for row in rows[:15]:
+        lines.append(f"{row['handler']}: p50 {row['p50'] * 1000:.0f}ms / p99 {row['p99'] * 1000:.0f}ms（{row['count']} 次）")
+    recent = list(tracer.recent_slow)[-3:]
+    if recent:
+        lines.append("")
+        lines.append("🐢 最近的慢 trace：")
+        for entry in reversed(recent):
+            when = time.strftime("%H:%M:%S", time.localtime(entry["ts"]))
+            lines.append(f"[{when}] trace {entry['trace_id']}")
+            lines.extend(_format_trace_tree(entry))
+    text = "\n".join(lines)
+    if len(text) > 4000:
+        text = text[:4000] + "\n…"
+    await update.message.reply_text(text)
+
+
 async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Open the Telegram Mini App group management panel."""
     if not update.effective_message or not update.effective_user:
@@ -1774,7 +2083,7 @@ async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     if chat and chat.type in ("group", "supergroup"):
         known_groups.setdefault(chat.id, {"title": chat.title or str(chat.id), "status": "active"})
         known_groups[chat.id]["title"] = chat.title or str(chat.id)
-        save_known_groups()
+        save_known_groups(chat.id)
     await update.effective_message.reply_text(
         "⚙️ 開啟群組管理面板：",
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("開啟管理面板", url=web_verification_server.admin_url())]]),
@@ -1785,18 +2094,20 @@ async def admin_panel_api(user_id: int, action: str, payload: dict) -> dict:
     """Mini App API for group settings and owner-managed ad samples."""
     if action == "bootstrap":
         groups = []
-        for raw_chat_id, info in known_groups.items():
-            chat_id = int(raw_chat_id)
-            if not await is_group_admin(application_bot, chat_id, user_id):
-                continue
+        chat_ids = [int(raw_chat_id) for raw_chat_id in known_groups]
+        if user_id != OWNER_ID:
+            chat_ids = await admin_index.chats_for(user_id, chat_ids, _fetch_chat_admins)
+        for chat_id in chat_ids:
+            info = known_groups.get(chat_id, {})
             groups.append({
                 "id": chat_id,
                 "title": info.get("title", str(chat_id)),
                 "features": get_group_features(info),
                 "labels": FEATURE_LABELS,
             })
-        from ad_samples import load_ad_samples
-        return {"groups": groups, "samples": load_ad_samples() if user_id == OWNER_ID else []}
+        from ad_samples import ad_sample_index
+        samples = ad_sample_index().page() if user_id == OWNER_ID else {"items": [], "next": "", "total": 0}
+        return {"groups": groups, "samples": samples}
     if action == "set_feature":
         chat_id = int(payload.get("chat_id"))
         feature = str(payload.get("feature", ""))
@@ -1807,23 +2118,28 @@ async def admin_panel_api(user_id: int, action: str, payload: dict) -> dict:
             raise ValueError("功能名稱無效")
         known_groups.setdefault(chat_id, {"title": str(chat_id), "status": "active"})
         set_group_feature(known_groups, chat_id, feature, enabled)
-        save_known_groups()
+        save_known_groups(chat_id)
         return {"features": get_group_features(known_groups[chat_id])}
-    if action in {"add_sample", "remove_sample"}:
+    if action in {"samples", "add_sample", "remove_sample"}:
         if user_id != OWNER_ID:
             raise PermissionError("只有 Bot 擁有者可以管理廣告樣本")
-        from ad_samples import add_ad_sample, load_ad_samples, remove_ad_sample
+        from ad_samples import add_ad_sample_async, remove_ad_sample_by_id_async
         if action == "add_sample":
             text = str(payload.get("text", "")).strip()
-            if not text or not add_ad_sample(text):
+            if not text or not await add_ad_sample_async(text):
                 raise ValueError("樣本為空、重複，或已存在於原生模板庫")
-        else:
-            items = load_ad_samples()
-            index = int(payload.get("index"))
-            if index < 0 or index >= len(items) or not remove_ad_sample(items[index]):
+            _reload_detector()
+        elif action == "remove_sample":
+            if not await remove_ad_sample_by_id_async(str(payload.get("id", ""))):
                 raise ValueError("樣本不存在或已被移除")
-        _reload_detector()
-        return {"samples": load_ad_samples()}
+            _reload_detector()
+        from ad_samples import ad_sample_index
+        return {"samples": ad_sample_index().page(
+            query=str(payload.get("query", "")),
+            cursor=str(payload.get("cursor", "")),
+            limit=payload.get("limit") or 0,
+            similar=bool(payload.get("similar")),
+        )}
     raise ValueError("未知管理操作")
 
 
@@ -1849,7 +2165,7 @@ async def update_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         error = result.stderr.strip()
 
         # 刪除「請稍候」提示
-        asyncio.create_task(_delete_after(msg_wait, 0))
+        _delete_after(msg_wait, 0)
 
         if result.returncode != 0:
             diag = (
@@ -1866,7 +2182,7 @@ async def update_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if "Already up to date" in output:
             msg = await update.message.reply_text("✅ 已是最新版本，無需更新。")
-            asyncio.create_task(_delete_after(msg, 20))
+            _delete_after(msg, 20)
             return
 
         msg = await update.message.reply_text(
@@ -1882,8 +2198,12 @@ async def update_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except Exception:
                 pass
 
-        # 再等1秒後重啟
+        # 再等1秒後重啟；execv 不會跑任何清理，先把狀態庫待寫入的資料落盤
         await asyncio.sleep(1)
+        if guard_ledger:
+            await asyncio.to_thread(guard_ledger.flush, True)
+        if state_store:
+            state_store.flush()
         os.execv(sys.executable, sys.argv)
 
     except subprocess.TimeoutExpired:
@@ -1914,7 +2234,7 @@ async def updatead_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         error = result.stderr.strip()
 
         # 刪除「請稍候」提示
-        asyncio.create_task(_delete_after(msg_wait, 0))
+        _delete_after(msg_wait, 0)
 
         if result.returncode != 0:
             diag = (
@@ -1942,6 +2262,7 @@ async def updatead_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # 直接替換 detect_ad 函數引用
         import sys
         sys.modules[__name__].detect_ad = _ad.detect_ad
+        profile_verdicts.clear()
 
         # 統計模板數量
         template_count = len(_adt.AD_TEMPLATES)
@@ -1953,7 +2274,7 @@ async def updatead_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"🔄 模板已熱重載，無需重啟。",
             parse_mode="HTML"
         )
-        asyncio.create_task(_delete_after(msg, 20))
+        _delete_after(msg, 20)
         logger.info(f"✅ 廣告模板已熱重載，共 {template_count} 條")
 
     except subprocess.TimeoutExpired:
@@ -1965,14 +2286,11 @@ async def updatead_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ================== 動態樣本庫指令 ==================
 
 def _reload_detector():
-    """重建偵測器向量器，讓動態樣本即時生效。"""
-    import importlib
-    import ad_samples as _as
+    """重建偵測器向量器，讓動態樣本即時生效。
+    樣本庫本身常駐記憶體（寫入即更新），不再 reload ad_samples／ad_detector 模組。"""
     import ad_detector as _ad
-    importlib.reload(_as)
-    importlib.reload(_ad)
-    import sys
-    sys.modules[__name__].detect_ad = _ad.detect_ad
+    _ad.rebuild_vectorizers()
+    profile_verdicts.clear()
 
 
 def _extract_sample_text(update) -> str:
@@ -1988,16 +2306,16 @@ def _extract_sample_text(update) -> str:
     return ""
 
 
-def _dedupe_ad_samples():
+async def _dedupe_ad_samples():
     """整理動態廣告樣本，並與官方模板庫做正規化去重。
 
     官方模板是基準；若動態樣本與官方模板在 NFKC/casefold/去空白符號後相同，
     保留官方版本並移除動態副本，避免匯入的樣本只和自己比較。
     """
-    from ad_samples import load_ad_samples, save_ad_samples, normalize_key, official_template_keys
+    from ad_samples import load_ad_samples, save_ad_samples_async, normalize_key, official_template_keys
 
     official_keys = official_template_keys()
-    samples = load_ad_samples()
+    samples = await asyncio.to_thread(load_ad_samples)
     seen = set(official_keys)
     cleaned = []
     for sample in samples:
@@ -2006,7 +2324,7 @@ def _dedupe_ad_samples():
             seen.add(normalized)
             cleaned.append(sample.strip())
     removed = len(samples) - len(cleaned)
-    save_ad_samples(cleaned)
+    await save_ad_samples_async(cleaned)
     return len(cleaned), removed, len(official_keys)
 
 
@@ -2021,7 +2339,7 @@ async def cleanup_ads_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await message.reply_text("❌ 只有本群管理員可以整理廣告樣本。")
         return
     try:
-        total, removed, official_total = _dedupe_ad_samples()
+        total, removed, official_total = await _dedupe_ad_samples()
         _reload_detector()
         await message.reply_text(
             f"✅ 廣告樣本整理完成\n"
@@ -2035,48 +2353,84 @@ async def cleanup_ads_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 
-def _build_sample_list_keyboard(items: list, prefix: str) -> InlineKeyboardMarkup:
+def _build_sample_list_keyboard(page: dict, prefix: str, offset: int = 0) -> InlineKeyboardMarkup:
     rows = []
-    for i, s in enumerate(items):
+    for i, item in enumerate(page["items"], offset + 1):
+        s = item["text"]
         preview = s if len(s) <= 40 else s[:40] + "…"
-        rows.append([InlineKeyboardButton(f"🗑 {i + 1}. {preview}", callback_data=f"{prefix}_{i}")])
+        rows.append([InlineKeyboardButton(f"🗑 {i}. {preview}", callback_data=f"{prefix}_{item['id']}")])
+    nav = []
+    if offset:
+        nav.append(InlineKeyboardButton("⏮ 第一頁", callback_data="samplespage_"))
+    if page["next"]:
+        nav.append(InlineKeyboardButton("下一頁 ▶", callback_data=f"samplespage_{page['next']}"))
+    if nav:
+        rows.append(nav)
     return InlineKeyboardMarkup(rows)
 
 
+def _sample_list_page(state: dict):
+    """依 /samples 的狀態（樣本庫、搜尋字、游標）取一頁，回傳 (文字, 鍵盤)。"""
+    from ad_samples import ad_sample_index, whitelist_sample_index
+
+    is_whitelist = state["whitelist"]
+    index = whitelist_sample_index() if is_whitelist else ad_sample_index()
+    page = index.page(query=state["query"], cursor=state["cursor"], limit=SAMPLES_LIST_PAGE_SIZE)
+    label = "白樣本庫（非廣告）" if is_whitelist else "動態廣告樣本庫"
+    if not page["items"]:
+        if state["query"]:
+            return f"{label}找不到包含「{state['query']}」的樣本。", None
+        return f"目前{label}是空的。", None
+    # 游標格式為「上一頁最後一筆的位置:ID」，由此推算本頁的編號起點
+    offset = int(state["cursor"].split(":", 1)[0]) + 1 if state["cursor"] else 0
+    found = f"符合「{state['query']}」的樣本" if state["query"] else "樣本"
+    text = (
+        f"📋 {label}共 {len(index)} 條，{found} {page['total']} 條"
+        f"（第 {offset + 1}-{offset + len(page['items'])} 條），點按鈕可刪除："
+    )
+    prefix = "delwl" if is_whitelist else "delsample"
+    return text, _build_sample_list_keyboard(page, prefix, offset)
+
+
 async def samples_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """/samples：列出動態廣告樣本庫（或 /samples wl 列出白樣本庫），點按鈕可直接刪除。"""
+    """/samples [wl] [關鍵字]：分頁列出動態廣告樣本庫（wl 為白樣本庫），可搜尋，點按鈕可直接刪除。"""
     user = update.effective_user
     message = update.effective_message
     if user.id != OWNER_ID:
         await message.reply_text("❌ 僅管理員可用此指令！")
         return
 
-    from ad_samples import load_ad_samples, load_whitelist_samples
-
-    args = context.args if context.args else []
+    args = list(context.args) if context.args else []
     is_whitelist = len(args) > 0 and args[0].lower() in ("wl", "whitelist", "白名单", "白樣本")
+    if is_whitelist:
+        args = args[1:]
 
-    items = load_whitelist_samples() if is_whitelist else load_ad_samples()
-    label = "白樣本庫（非廣告）" if is_whitelist else "動態廣告樣本庫"
-
-    if not items:
-        await message.reply_text(f"目前{label}是空的。")
-        return
+    state = {"whitelist": is_whitelist, "query": " ".join(args).strip(), "cursor": ""}
+    pending_sample_list[user.id] = state
+    text, keyboard = _sample_list_page(state)
+    await message.reply_text(text, reply_markup=keyboard)
 
-    if len(items) > 30:
-        await message.reply_text(f"⚠️ {label}共 {len(items)} 條，只顯示前 30 條，其餘請用 /exportsamples 匯出查看。")
-        items = items[:30]
 
-    pending_sample_list[user.id] = {"items": items, "whitelist": is_whitelist}
-    prefix = "delwl" if is_whitelist else "delsample"
-    await message.reply_text(
-        f"📋 {label}共 {len(items)} 條，點按鈕可刪除：",
-        reply_markup=_build_sample_list_keyboard(items, prefix),
-    )
+async def on_sample_page_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """處理 /samples 清單的翻頁按鈕（samplespage_{cursor}）。"""
+    query = update.callback_query
+    if not query or not query.data:
+        return
+    if query.from_user.id != OWNER_ID:
+        await query.answer("僅限管理員操作", show_alert=True)
+        return
+    await query.answer()
+    state = pending_sample_list.get(query.from_user.id)
+    if not state:
+        await query.edit_message_text("❌ 這份列表已過期，請重新 /samples", reply_markup=None)
+        return
+    state["cursor"] = query.data.split("_", 1)[1]
+    text, keyboard = _sample_list_page(state)
+    await query.edit_message_text(text, reply_markup=keyboard)
 
 
 async def on_sample_delete_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """處理 /samples 清單裡的刪除按鈕（delsample_{index} / delwl_{index}）。"""
+    """處理 /samples 清單裡的刪除按鈕（delsample_{id} / delwl_{id}）。"""
     query = update.callback_query
     if not query or not query.data:
         return
@@ -2087,20 +2441,14 @@ async def on_sample_delete_click(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     is_whitelist = query.data.startswith("delwl_")
-    try:
-        idx = int(query.data.split("_", 1)[1])
-    except (IndexError, ValueError):
-        return
+    sid = query.data.split("_", 1)[1]
 
-    state = pending_sample_list.get(query.from_user.id)
-    if not state or state.get("whitelist") != is_whitelist or idx >= len(state["items"]):
-        await query.edit_message_text("❌ 這份列表已過期，請重新 /samples", reply_markup=None)
-        return
-
-    target_text = state["items"][idx]
-
-    from ad_samples import remove_ad_sample, remove_whitelist_sample
-    removed = remove_whitelist_sample(target_text) if is_whitelist else remove_ad_sample(target_text)
+    from ad_samples import remove_ad_sample_by_id_async, remove_whitelist_sample_by_id_async
+    # 以樣本 ID 刪除，列表顯示後樣本庫有增減也不會刪錯
+    if is_whitelist:
+        removed = await remove_whitelist_sample_by_id_async(sid)
+    else:
+        removed = await remove_ad_sample_by_id_async(sid)
 
     if not removed:
         await query.edit_message_text("⚠️ 刪除失敗（可能已被移除）。", reply_markup=None)
@@ -2111,16 +2459,12 @@ async def on_sample_delete_click(update: Update, context: ContextTypes.DEFAULT_T
     except Exception as e:
         logger.error(f"刪除樣本後熱重載失敗: {e}")
 
-    state["items"].pop(idx)
-    label = "白樣本庫" if is_whitelist else "動態廣告樣本庫"
-    if state["items"]:
-        prefix = "delwl" if is_whitelist else "delsample"
-        await query.edit_message_text(
-            f"✅ 已刪除，{label}剩餘 {len(state['items'])} 條：",
-            reply_markup=_build_sample_list_keyboard(state["items"], prefix),
-        )
-    else:
-        await query.edit_message_text(f"✅ 已刪除，{label}現在是空的。", reply_markup=None)
+    state = pending_sample_list.get(query.from_user.id)
+    if not state or state.get("whitelist") != is_whitelist:
+        await query.edit_message_text("✅ 已刪除。", reply_markup=None)
+        return
+    text, keyboard = _sample_list_page(state)
+    await query.edit_message_text(f"✅ 已刪除。\n{text}", reply_markup=keyboard)
 
 
 async def addsample_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2130,7 +2474,7 @@ async def addsample_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ 僅管理員可用此指令！")
         return
 
-    from ad_samples import add_ad_sample, load_ad_samples
+    from ad_samples import add_ad_sample_async, count_ad_samples
     text = _extract_sample_text(update)
     if not text:
         await update.message.reply_text(
@@ -2138,14 +2482,14 @@ async def addsample_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    added = add_ad_sample(text)
+    added = await add_ad_sample_async(text)
     if not added:
         await update.message.reply_text("ℹ️ 此樣本已存在於廣告樣本庫或原生模板庫（正規化去重），未重複加入。")
         return
 
     try:
         _reload_detector()
-        total = len(load_ad_samples())
+        total = count_ad_samples()
         preview = text if len(text) <= 60 else text[:60] + "…"
         await update.message.reply_text(
             f"✅ 已入庫廣告樣本並即時生效！\n\n"
@@ -2164,7 +2508,7 @@ async def whitelist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ 僅管理員可用此指令！")
         return
 
-    from ad_samples import add_whitelist_sample, load_whitelist_samples
+    from ad_samples import add_whitelist_sample_async, count_whitelist_samples
     text = _extract_sample_text(update)
     if not text:
         await update.message.reply_text(
@@ -2172,7 +2516,7 @@ async def whitelist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    added = add_whitelist_sample(text)
+    added = await add_whitelist_sample_async(text)
 
     # 若是回覆某位用戶的訊息，順便嘗試恢復其發言權限（誤封解除）
     unmute_note = ""
@@ -2195,7 +2539,7 @@ async def whitelist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         _reload_detector()
-        total = len(load_whitelist_samples())
+        total = count_whitelist_samples()
         preview = text if len(text) <= 60 else text[:60] + "…"
         await update.message.reply_text(
             f"✅ 已加入白樣本（非廣告）並即時生效！\n\n"
@@ -2264,6 +2608,9 @@ async def is_group_admin(bot, chat_id: int, user_id: int) -> bool:
     """確認使用者是該群組管理員；Owner 可跨群組管理樣本。"""
     if user_id == OWNER_ID:
         return True
+    cached = admin_index.is_admin(chat_id, user_id)
+    if cached is not None:
+        return cached
     try:
         member = await bot.get_chat_member(chat_id, user_id)
         return member.status in ("administrator", "creator")
@@ -2272,6 +2619,16 @@ async def is_group_admin(bot, chat_id: int, user_id: int) -> bool:
         return False
 
 
+async def _fetch_chat_admins(chat_id: int):
+    """管理員反向索引的回源：一次取回整個群組的管理員名單，失敗回傳 None。"""
+    try:
+        admins = await application_bot.get_chat_administrators(chat_id)
+    except Exception as e:
+        logger.warning(f"取得管理員名單失敗 chat={chat_id}: {e}")
+        return None
+    return [admin.user.id for admin in admins]
+
+
 async def on_sample_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """處理樣本庫按鈕；新增樣本時由下一則文字訊息提供內容。"""
     query = update.callback_query
@@ -2301,7 +2658,7 @@ async def on_sample_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
             known_groups.get(chat_id, {}), feature_name
         ))
         known_groups.setdefault(chat_id, {})["title"] = query.message.chat.title or str(chat_id)
-        save_known_groups()
+        save_known_groups(chat_id)
         enabled = feature_enabled(known_groups.get(chat_id, {}), feature_name)
         features = get_group_features(known_groups.get(chat_id, {}))
         lines = ["⚙️ <b>群組功能設定</b>"]
@@ -2353,8 +2710,8 @@ async def on_sample_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_chat_id = record.get("chat_id", chat_id)
         target_user_id = record.get("user_id")
 
-        from ad_samples import add_whitelist_sample, load_whitelist_samples
-        added = add_whitelist_sample(text)
+        from ad_samples import add_whitelist_sample_async, count_whitelist_samples
+        added = await add_whitelist_sample_async(text)
 
         # 恢復被誤封用戶的發言權限
         unmute_note = ""
@@ -2376,7 +2733,7 @@ async def on_sample_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         try:
             _reload_detector()
-            total = len(load_whitelist_samples())
+            total = count_whitelist_samples()
             await query.edit_message_reply_markup(reply_markup=None)
             await query.message.reply_text(f"✅ 已將該則誤封訊息加入非廣告樣本庫，目前共 {total} 條{unmute_note}。")
         except Exception as e:
@@ -2427,15 +2784,15 @@ async def handle_sample_input(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     text = message.text.strip()
     if action == "add_ad":
-        from ad_samples import add_ad_sample, load_ad_samples
-        added = add_ad_sample(text)
+        from ad_samples import add_ad_sample_async, count_ad_samples
+        added = await add_ad_sample_async(text)
         label = "廣告樣本"
-        total = len(load_ad_samples())
+        total = count_ad_samples()
     else:
-        from ad_samples import add_whitelist_sample, load_whitelist_samples
-        added = add_whitelist_sample(text)
+        from ad_samples import add_whitelist_sample_async, count_whitelist_samples
+        added = await add_whitelist_sample_async(text)
         label = "非廣告白樣本"
-        total = len(load_whitelist_samples())
+        total = count_whitelist_samples()
 
     if not added:
         await message.reply_text(f"ℹ️ 此{label}已存在，沒有重複加入。")
@@ -2463,7 +2820,8 @@ async def handle_new_member_service_message(update: Update, context: ContextType
 async def get_all_admins(bot, chat_id: int) -> list:
     """取得群組所有管理員列表"""
     try:
-        admins = await bot.get_chat_administrators(chat_id)
+        with span("get_all_admins", chat_id=chat_id):
+            admins = await bot.get_chat_administrators(chat_id)
         return [a.user for a in admins if not a.user.is_bot]
     except Exception as e:
         logger.error(f"取得管理員列表失敗: {e}")
@@ -2543,17 +2901,10 @@ async def _check_sender_profile_ad_signal(bot, user) -> Tuple[bool, str]:
     except Exception:
         pass
 
-    fields = (
-        ("用戶名", f"@{user.username}" if user.username else ""),
-        ("暱稱", user.full_name or ""),
-        ("簡介", bio),
-    )
-    for label, field_text in fields:
-        if not field_text:
-            continue
-        hit, _score, hit_reason = detect_ad(field_text)
-        if hit:
-            return True, f"{label}命中模板庫[{hit_reason}]"
+    hits = _profile_template_hits(user, bio)
+    if hits:
+        label, hit_reason = hits[0]
+        return True, f"{label}命中模板庫[{hit_reason}]"
     return False, ""
 
 
@@ -2607,7 +2958,8 @@ async def handle_message_ad_check(update: Update, context: ContextTypes.DEFAULT_
     if (chat.id, message.message_id) in consumed_sample_messages:
         consumed_sample_messages.discard((chat.id, message.message_id))
         return
-    if not feature_enabled(known_groups.get(chat.id, {}), "ad_detection"):
+    group = known_groups.get(chat.id, {})
+    if not feature_enabled(group, "ad_detection"):
         return
 
     # 管理員發的訊息不偵測
@@ -2622,12 +2974,12 @@ async def handle_message_ad_check(update: Update, context: ContextTypes.DEFAULT_
     # 廣告載體（合成字串一樣會拿去跑 detect_ad，但這裡直接把「非管理員分享聯絡人」
     # 本身當成廣告訊號處理，不用等關鍵字命中，公開群組本來就幾乎沒有分享聯絡人
     # 卡片的正常需求）。
-    if message.contact is not None and feature_enabled(known_groups.get(chat.id, {}), "block_contact_share"):
+    if message.contact is not None and feature_enabled(group, "block_contact_share"):
         is_ad, confidence, reason = True, 0.0, "非管理員分享聯絡人卡片（一律視為廣告，不需命中關鍵字）"
     else:
         is_ad = False
         confidence, reason = 0.0, ""
-        if feature_enabled(known_groups.get(chat.id, {}), "external_quote_check"):
+        if feature_enabled(group, "external_quote_check"):
             ext_hit, ext_desc = _extract_external_reference_signal(message)
             if ext_hit:
                 # 引用內容本身也拿去跑一次關鍵字/相似度比對，命中的話原因更精確；
@@ -2654,10 +3006,10 @@ async def handle_message_ad_check(update: Update, context: ContextTypes.DEFAULT_
         else:
             return
 
-    logger.info(f"廣告偵測: 用戶 {user.id} 在 {chat.id} | {reason} | 信心:{confidence:.2f}")
+    logger.info("廣告偵測: 用戶 %s 在 %s | %s | 信心:%.2f", user.id, chat.id, reason, confidence)
 
     # 禁言該用戶
-    if feature_enabled(known_groups.get(chat.id, {}), "ad_mute"):
+    if feature_enabled(group, "ad_mute"):
         try:
             await context.bot.restrict_chat_member(
                 chat_id=chat.id,
@@ -2668,13 +3020,13 @@ async def handle_message_ad_check(update: Update, context: ContextTypes.DEFAULT_
             logger.error(f"廣告禁言失敗: {e}")
 
     # 刪除廣告訊息
-    if feature_enabled(known_groups.get(chat.id, {}), "ad_delete"):
+    if feature_enabled(group, "ad_delete"):
         try:
             await message.delete()
         except Exception:
             pass
 
-    if not feature_enabled(known_groups.get(chat.id, {}), "ad_notify_admins"):
+    if not feature_enabled(group, "ad_notify_admins"):
         return
 
     # 取得所有管理員並產生 @ 列表
@@ -2783,7 +3135,7 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🔇 {mention} 已被禁言。",
         parse_mode="HTML"
     )
-    asyncio.create_task(_delete_after(msg, 20))
+    _delete_after(msg, 20)
     logger.info(f"/ban: 管理員 {user.id} 禁言用戶 {target_user.id} 於群組 {chat.id}")
 
 # ================== 錯誤處理 ==================
@@ -2791,7 +3143,88 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """全局錯誤處理"""
     logger.error(f"錯誤: {context.error}", exc_info=True)
 
+# ================== 指標（Web 服務的 /metrics） ==================
+updates_total = counter("telegram_updates_total", "收到的 Telegram 更新數（依類型）", labelnames=("type",))
+_UPDATE_TYPES = (
+    "message", "edited_message", "channel_post", "edited_channel_post", "callback_query",
+    "chat_member", "my_chat_member", "chat_join_request", "inline_query", "message_reaction",
+)
+
+
+async def _count_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """所有更新先經過這裡計數（group=-1，不影響後續處理）。"""
+    for kind in _UPDATE_TYPES:
+        if getattr(update, kind, None) is not None:
+            break
+    else:
+        kind = "other"
+    updates_total.inc(type=kind)
+
+
+def _register_metric_gauges():
+    """記憶體索引與佇列大小；只在 /metrics 被讀取時計算。"""
+    gauge("bot_index_entries", "記憶體索引筆數", lambda: {
+        ("recent_message_texts",): len(recent_message_texts),
+        ("known_profiles",): len(known_profiles),
+        ("profile_verdicts",): len(profile_verdicts),
+        ("user_welcomed",): len(user_welcomed),
+        ("known_groups",): len(known_groups),
+        ("admin_index_groups",): admin_index.stats()["groups"],
+    }, labelnames=("index",))
+    gauge("pending_verifications", "進行中的入群驗證數", lambda: len(pending_verifications))
+    gauge(
+        "web_verification_sessions", "有效的網頁驗證 session 數",
+        lambda: web_verification_server.sessions.stats()["live"] if web_verification_server else 0,
+    )
+    gauge(
+        "outbound_queue_depth", "等待發送的 Bot API 呼叫數（依優先級）",
+        lambda: {(name,): depth for name, depth in outbound_scheduler.queue_depth().items()} if outbound_scheduler else {},
+        labelnames=("priority",),
+    )
+    gauge("join_pipeline_queued", "入群處理佇列長度", lambda: join_pipeline.depth())
+    gauge("timer_jobs_pending", "待執行的延遲工作數", lambda: timer_scheduler.pending() if timer_scheduler else 0)
+    gauge("guard_restrict_queued", "防護模式等待批次禁言的人數", lambda: sum(len(q) for q in guard_restrict_queue.values()))
+    gauge("log_records", "日誌佇列狀態（排隊中 / 佇列滿而丟棄 / 取樣略過）", lambda: {
+        (name,): value for name, value in log_pipeline.stats().items()
+    }, labelnames=("state",))
+
 # ================== 主程式 ==================
+async def _post_init(application: Application):
+    """事件迴圈啟動後：載入排程工作（重啟期間已到期的立即執行），啟動 Web 驗證服務或驗證碼題庫"""
+    global web_verification_server, captcha_library, loop_lag_task
+    _timers().start()
+    # 待驗證狀態首次讀取會掃 SQLite，先在背景執行緒載入，之後的 handler 只碰記憶體
+    await asyncio.to_thread(pending_verifications.preload)
+    _register_metric_gauges()
+    loop_lag_task = asyncio.get_running_loop().create_task(monitor_event_loop_lag())
+    if web_verification_server:
+        try:
+            await web_verification_server.start()
+            logger.info("🌐 Web 驗證服務已啟動：%s", web_verification_server.base_url)
+        except Exception as exc:
+            web_verification_server = None
+            logger.exception("Web 驗證服務啟動失敗，回退 Telegram 驗證碼：%s", exc)
+    if not web_verification_server:
+        # 題庫只服務 Telegram 圖片驗證碼回退流程；走網頁驗證時不預先上傳
+        captcha_library = CaptchaLibrary(_upload_library_captcha, _state_store())
+        captcha_library.load()
+        captcha_library.start()
+
+
+async def _post_shutdown(application: Application):
+    if loop_lag_task:
+        loop_lag_task.cancel()
+    if timer_scheduler:
+        await timer_scheduler.stop()
+    if web_verification_server:
+        await web_verification_server.stop()
+    if captcha_library:
+        await captcha_library.stop()
+    math_captcha_pool.stop()
+    captcha_render_executor.shutdown()
+    await asyncio.to_thread(tracer.close)
+
+
 def main():
     """主程序"""
     # 檢查 Token
@@ -2805,28 +3238,33 @@ def main():
     load_known_groups()
     
     # 創建應用
-    application = Application.builder().token(bot_token).build()
+    # 所有 Bot API 呼叫經過 outbound_scheduler：全域 / 每群組限流，禁言與刪除優先於歡迎與編輯
+    global outbound_scheduler
+    outbound_scheduler = OutboundScheduler()
+    application = (
+        Application.builder()
+        .token(bot_token)
+        .rate_limiter(outbound_scheduler)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
     global application_bot
     application_bot = application.bot
 
     # 有完整環境變數時啟用 Web 數字圖片 + Turnstile；未配置則保留 Telegram 驗證碼回退。
     global web_verification_server
     if web_verification_configured():
-        loop = asyncio.get_event_loop()
-
         async def _web_success(token: str, user_id: int):
             await complete_web_verification(application.bot, token, user_id)
 
         async def _admin_callback(user_id: int, action: str, payload: dict):
             return await admin_panel_api(user_id, action, payload)
 
-        try:
-            web_verification_server = WebVerificationServer(loop, _web_success, admin_callback=_admin_callback)
-            web_verification_server.start()
-            logger.info("🌐 Web 驗證服務已啟動：%s", web_verification_server.base_url)
-        except Exception as exc:
-            web_verification_server = None
-            logger.exception("Web 驗證服務啟動失敗，回退 Telegram 驗證碼：%s", exc)
+        # 伺服器跑在 Bot 自己的事件迴圈上，於 _post_init 啟動
+        web_verification_server = WebVerificationServer(
+            _web_success, admin_callback=_admin_callback, store=_state_store()
+        )
     else:
         logger.warning(
             "未配置 WEB_VERIFY_BASE_URL/CF_TURNSTILE_SITE_KEY/CF_TURNSTILE_SECRET_KEY，"
@@ -2834,6 +3272,7 @@ def main():
         )
     
     # 註冊處理器
+    application.add_handler(TypeHandler(Update, _count_update), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("banme", banme))
@@ -2854,6 +3293,7 @@ def main():
     application.add_handler(CommandHandler("stop", stop_command))
     application.add_handler(CommandHandler("omg", guard_command))
     application.add_handler(CommandHandler("guard", guard_command))
+    application.add_handler(CommandHandler("traces", traces_command))
 
     # 防護模式（/guard、別名 /omg）：刪除「OO加入了群組」系統訊息
     application.add_handler(MessageHandler(
@@ -2887,6 +3327,7 @@ def main():
     application.add_handler(CallbackQueryHandler(on_captcha_click, pattern=r"^captcha_"))
     application.add_handler(CallbackQueryHandler(on_guard_kick_click, pattern=r"^guard(kick|sel|exec)_"))
     application.add_handler(CallbackQueryHandler(on_sample_delete_click, pattern=r"^del(sample|wl)_"))
+    application.add_handler(CallbackQueryHandler(on_sample_page_click, pattern=r"^samplespage_"))
     application.add_handler(CallbackQueryHandler(on_verify_click))
     
     application.add_handler(ChatMemberHandler(
@@ -2900,6 +3341,8 @@ def main():
     ))
     
     application.add_error_handler(error_handler)
+    # 所有 handler 包上 trace 根 span（須在全部 add_handler 之後）
+    instrument_handlers(application, tracer)
     
     # 啟動信息
     print(f"\n{'='*60}")
@@ -2931,9 +3374,14 @@ def main():
         )
     except KeyboardInterrupt:
         print("\n👋 機器人已停止")
-        save_known_groups()
     except Exception as e:
         print(f"❌ 啟動失敗: {e}")
+    finally:
+        join_pipeline.shutdown()
+        if guard_ledger:
+            guard_ledger.close()
+        if state_store:
+            state_store.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,238 @@
+"""In-process metrics with Prometheus text exposition.
+
+Cumulative fixed buckets (the Prometheus layout) keep ``observe`` O(buckets)
+with constant memory no matter how many samples arrive; percentiles are
+estimated by linear interpolation inside the bucket that holds the rank.
+Counters and histograms may carry labels; gauges are callbacks evaluated only
+when ``render`` is called, so sizes of live structures cost nothing between
+scrapes. Metrics are registered by name, which also keeps them intact when a
+module that defines them is hot-reloaded.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import bisect
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_INTERVAL = 0.5
+
+LabelValues = Tuple[str, ...]
+GaugeValue = Union[float, Dict[LabelValues, float]]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{name}="{escaped}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _label_key(labelnames: Sequence[str], labels: Dict[str, object]) -> LabelValues:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str = "",
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        labelnames: Sequence[str] = (),
+    ):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        # 最後一格是 +Inf
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+        self._children: Dict[LabelValues, Histogram] = {}
+
+    def labels(self, **labels) -> "Histogram":
+        """Child histogram for one label combination, created on first use."""
+        key = _label_key(self.labelnames, labels)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, Histogram(self.name, self.help, self.buckets))
+        return child
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative(self) -> List[int]:
+        """Counts of observations <= each bucket bound, ending with the +Inf total."""
+        with self._lock:
+            counts = list(self._counts)
+        total = 0
+        out = []
+        for count in counts:
+            total += count
+            out.append(total)
+        return out
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Estimated ``p`` quantile (0..1), or None before the first observation."""
+        cumulative = self.cumulative()
+        if not cumulative[-1]:
+            return None
+        rank = p * cumulative[-1]
+        index = bisect.bisect_left(cumulative, rank)
+        if index >= len(self.buckets):
+            # 落在 +Inf 格，只能回報最大的有限邊界
+            return self.buckets[-1]
+        lower = self.buckets[index - 1] if index else 0.0
+        below = cumulative[index - 1] if index else 0
+        in_bucket = cumulative[index] - below
+        fraction = (rank - below) / in_bucket if in_bucket else 1.0
+        return lower + (self.buckets[index] - lower) * fraction
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        return {
+            "count": self.count,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "avg": self.sum / self.count if self.count else None,
+        }
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        series = sorted(self._children.items()) if self.labelnames else [((), self)]
+        for values, child in series:
+            cumulative = child.cumulative()
+            bounds = [_format_value(b) for b in child.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, cumulative):
+                labels = _format_labels(self.labelnames, values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {cumulative[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str = "", labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(self.labelnames, labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """Value read from ``fn`` at scrape time; ``fn`` returns a number or {label values: number}."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], GaugeValue], labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        value = self.fn()
+        items = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        for values, number in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(number)}")
+        return lines
+
+
+Metric = Union[Histogram, Counter, Gauge]
+_registry: Dict[str, Metric] = {}
+_registry_lock = threading.Lock()
+
+
+def _register(name: str, factory: Callable[[], Metric]) -> Metric:
+    with _registry_lock:
+        existing = _registry.get(name)
+        if existing is None:
+            existing = _registry[name] = factory()
+        return existing
+
+
+def histogram(
+    name: str, help: str = "", buckets: Sequence[float] = DEFAULT_BUCKETS, labelnames: Sequence[str] = ()
+) -> Histogram:
+    """Return the histogram registered as ``name``, creating it on first use."""
+    return _register(name, lambda: Histogram(name, help, buckets, labelnames))
+
+
+def counter(name: str, help: str = "", labelnames: Sequence[str] = ()) -> Counter:
+    return _register(name, lambda: Counter(name, help, labelnames))
+
+
+def gauge(name: str, help: str, fn: Callable[[], GaugeValue], labelnames: Sequence[str] = ()) -> Gauge:
+    """Register a callback gauge; re-registering a name replaces its callback."""
+    with _registry_lock:
+        metric = _registry[name] = Gauge(name, help, fn, labelnames)
+    return metric
+
+
+def histograms() -> List[Histogram]:
+    with _registry_lock:
+        return [metric for metric in _registry.values() if isinstance(metric, Histogram)]
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format (0.0.4)."""
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda metric: metric.name)
+    lines: List[str] = []
+    for metric in metrics:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            # 單一 gauge 回呼失敗不影響其他指標
+            continue
+    return "\n".join(lines) + "\n"
+
+
+async def monitor_event_loop_lag(interval: float = LOOP_LAG_INTERVAL) -> None:
+    """Sleep ``interval`` repeatedly and record how late each wake-up was."""
+    lag_histogram = histogram(
+        "event_loop_lag_seconds", "How late the event loop woke a periodic timer",
+        buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+    )
+    last = {"lag": 0.0}
+    gauge("event_loop_lag_last_seconds", "Most recent event loop lag sample", lambda: last["lag"])
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - started - interval)
+        last["lag"] = lag
+        lag_histogram.observe(lag)
@@ -0,0 +1,375 @@
+"""Priority-aware outbound Bot API scheduler.
+
+Plugged into python-telegram-bot as the application's rate limiter, so every
+call made through ``context.bot`` / ``application.bot`` passes through here.
+
+* A global token bucket keeps the bot under Telegram's ~30 requests/second.
+* Message-producing calls (send*/edit*) also take a token from a per-chat
+  bucket (20/minute in groups, 1/second in private chats). Moderation calls
+  (restrict, ban, delete) only use the global bucket so a raid's mutes are
+  never held back by the group's message limit.
+* Waiting calls are granted in priority order: restrict/delete first, then
+  notices, then welcomes and edits. Callers can override the class with
+  ``rate_limit_args=PRIORITY_*``.
+* ``RetryAfter`` pauses the affected chat (or everything, for chat-less
+  calls) and retries automatically.
+* Time spent waiting for a token is recorded per priority class; call latency
+  and errors per Bot API method go to the shared metrics registry, and both
+  show up as spans in the calling update's trace.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Callable, Coroutine, Deque, Dict, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import counter, histogram
+from tracing import span
+
+PRIORITY_CRITICAL = 0  # 禁言、踢出、刪除
+PRIORITY_NOTICE = 1    # 通知、驗證提示、驗證碼圖片
+PRIORITY_BULK = 2      # 歡迎、離群通知、訊息編輯
+
+PRIORITY_NAMES = {PRIORITY_CRITICAL: "critical", PRIORITY_NOTICE: "notice", PRIORITY_BULK: "bulk"}
+
+_API_LATENCY = histogram(
+    "telegram_api_request_seconds", "Bot API call latency per method (excluding rate-limit waits)",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0), labelnames=("method",),
+)
+_API_ERRORS = counter("telegram_api_errors_total", "Bot API call errors per method", labelnames=("method", "error"))
+
+GLOBAL_RATE = 30.0
+GROUP_RATE = 20 / 60
+GROUP_BURST = 20
+PRIVATE_RATE = 1.0
+PRIVATE_BURST = 1
+MAX_RETRIES = 3
+
+_ENDPOINT_PRIORITY = {
+    "restrictChatMember": PRIORITY_CRITICAL,
+    "banChatMember": PRIORITY_CRITICAL,
+    "unbanChatMember": PRIORITY_CRITICAL,
+    "deleteMessage": PRIORITY_CRITICAL,
+    "deleteMessages": PRIORITY_CRITICAL,
+    "setChatPermissions": PRIORITY_CRITICAL,
+    "editMessageText": PRIORITY_BULK,
+    "editMessageCaption": PRIORITY_BULK,
+    "editMessageReplyMarkup": PRIORITY_BULK,
+}
+# 不排隊的呼叫：讀取類與 callback 回應（Telegram 不對它們套用發訊頻率限制）
+_UNTHROTTLED = {"answerCallbackQuery", "logOut", "close"}
+logger = logging.getLogger(__name__)
+
+
+def endpoint_priority(endpoint: str) -> int:
+    return _ENDPOINT_PRIORITY.get(endpoint, PRIORITY_NOTICE)
+
+
+def _is_unthrottled(endpoint: str) -> bool:
+    return endpoint.startswith("get") or endpoint in _UNTHROTTLED
+
+
+def _is_chat_limited(endpoint: str) -> bool:
+    return endpoint.startswith(("send", "edit", "copy", "forward"))
+
+
+def _retry_after_seconds(exc: RetryAfter) -> float:
+    # PTB 22 回傳秒數，之後的版本改為 timedelta
+    value = exc.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+LaneKey = Tuple[Any, Any]
+
+
+class _Lane:
+    """Waiters sharing one (chat bucket, pause target) pair; FIFO within each priority."""
+
+    __slots__ = ("key", "queues", "version")
+
+    def __init__(self, key: LaneKey):
+        self.key = key
+        # priority -> deque[(seq, future, enqueued_at)]；空的 deque 立即移除
+        self.queues: Dict[int, Deque[Tuple[int, asyncio.Future, float]]] = {}
+        # 每次重新放進 ready / blocked heap 就加一，heap 裡版本不符的項目是過期的
+        self.version = 0
+
+    def head(self) -> Optional[Tuple[int, int]]:
+        """``(priority, seq)`` of the next waiter, or None when empty."""
+        if not self.queues:
+            return None
+        priority = min(self.queues)
+        return priority, self.queues[priority][0][0]
+
+    def pop(self, priority: int) -> Tuple[int, asyncio.Future, float]:
+        queue = self.queues[priority]
+        entry = queue.popleft()
+        if not queue:
+            del self.queues[priority]
+        return entry
+
+
+class OutboundScheduler(BaseRateLimiter[int]):
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        group_rate: float = GROUP_RATE,
+        group_burst: int = GROUP_BURST,
+        private_rate: float = PRIVATE_RATE,
+        private_burst: int = PRIVATE_BURST,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.max_retries = max_retries
+        self._chat_buckets: Dict[Any, TokenBucket] = {}
+        self._paused_until: Dict[Any, float] = {}  # chat_id 或 None（全域）-> monotonic 時間
+        # 等待者依 (chat_key, pause_key) 分道：chat_key 決定要不要扣每群組的令牌，
+        # pause_key 是 RetryAfter 暫停的對象（呼叫的 chat_id）
+        self._lanes: Dict[LaneKey, _Lane] = {}
+        # 可立即放行的分道，依隊首 (priority, seq) 排序：(priority, seq, version, lane_key)
+        self._ready: List[Tuple[int, int, int, LaneKey]] = []
+        # 被群組限流或暫停卡住的分道，依可放行時間排序：(ready_at, seq, version, lane_key)
+        self._blocked: List[Tuple[float, int, int, LaneKey]] = []
+        self._seq = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.retries = 0
+        # priority -> [次數, 總等待秒數, 最長等待秒數]
+        self.wait_stats: Dict[int, List[float]] = {p: [0, 0.0, 0.0] for p in PRIORITY_NAMES}
+
+    async def initialize(self) -> None:
+        self._ensure_dispatcher()
+
+    async def shutdown(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    def queue_depth(self) -> Dict[str, int]:
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for lane in self._lanes.values():
+            for priority, queue in lane.queues.items():
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                depth[name] = depth.get(name, 0) + sum(not future.done() for _seq, future, _at in queue)
+        return depth
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Per-priority grant count, mean and max queue wait (seconds)."""
+        result = {}
+        for priority, (count, total, longest) in self.wait_stats.items():
+            result[PRIORITY_NAMES.get(priority, str(priority))] = {
+                "granted": count,
+                "avg_wait": total / count if count else 0.0,
+                "max_wait": longest,
+            }
+        return result
+
+    def _ensure_dispatcher(self) -> None:
+        if self._wake is None:
+            self._wake = asyncio.Event()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    def _chat_bucket(self, chat_key: Any) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_key)
+        if bucket is None:
+            is_private = isinstance(chat_key, int) and chat_key > 0
+            bucket = TokenBucket(
+                self.private_rate if is_private else self.group_rate,
+                self.private_burst if is_private else self.group_burst,
+            )
+            self._chat_buckets[chat_key] = bucket
+        return bucket
+
+    def _lane_wait(self, key: LaneKey, now: float) -> float:
+        chat_key, pause_key = key
+        wait = self._paused_until.get(pause_key, 0.0) - now if pause_key is not None else 0.0
+        if chat_key is not None:
+            wait = max(wait, self._chat_bucket(chat_key).wait_time(now))
+        return wait
+
+    def _push_ready(self, lane: _Lane) -> None:
+        head = lane.head()
+        if head is None:
+            del self._lanes[lane.key]
+            return
+        lane.version += 1
+        heapq.heappush(self._ready, (head[0], head[1], lane.version, lane.key))
+
+    def _push_blocked(self, lane: _Lane, ready_at: float) -> None:
+        lane.version += 1
+        heapq.heappush(self._blocked, (ready_at, next(self._seq), lane.version, lane.key))
+
+    def _live_lane(self, key: LaneKey, version: int) -> Optional[_Lane]:
+        lane = self._lanes.get(key)
+        return lane if lane is not None and lane.version == version else None
+
+    def _grant(self, now: float) -> Optional[float]:
+        """Release the best waiter that may proceed now; otherwise return how long to sleep.
+
+        Each call costs O(log lanes): only lane heads sit in the heaps, and a
+        lane blocked by its chat bucket or a pause is parked until it is due.
+        """
+        global_wait = max(self._paused_until.get(None, 0.0) - now, self.global_bucket.wait_time(now))
+        if global_wait > 0:
+            return global_wait
+        while self._blocked and self._blocked[0][0] <= now:
+            _ready_at, _seq, version, key = heapq.heappop(self._blocked)
+            lane = self._live_lane(key, version)
+            if lane is not None:
+                self._push_ready(lane)
+        while self._ready:
+            priority, seq, version, key = heapq.heappop(self._ready)
+            lane = self._live_lane(key, version)
+            if lane is None:
+                continue
+            future = lane.queues[priority][0][1]
+            if future.done():
+                # 呼叫端已取消：丟掉隊首，依新的隊首重新排
+                lane.pop(priority)
+                self._push_ready(lane)
+                continue
+            lane_wait = self._lane_wait(key, now)
+            if lane_wait > 0:
+                self._push_blocked(lane, now + lane_wait)
+                continue
+            _seq, future, enqueued_at = lane.pop(priority)
+            self.global_bucket.take()
+            if key[0] is not None:
+                self._chat_bucket(key[0]).take()
+            waited = now - enqueued_at
+            stats = self.wait_stats.setdefault(priority, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += waited
+            stats[2] = max(stats[2], waited)
+            future.set_result(waited)
+            self._push_ready(lane)
+            return None
+        if len(self._chat_buckets) > 1000:
+            for chat_key in [k for k, b in self._chat_buckets.items() if b.idle(now)]:
+                del self._chat_buckets[chat_key]
+            for chat_key in [k for k, until in self._paused_until.items() if until <= now]:
+                del self._paused_until[chat_key]
+        return self._blocked[0][0] - now if self._blocked else None
+
+    async def _dispatch(self) -> None:
+        while True:
+            if not self._lanes:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            delay = self._grant(time.monotonic())
+            if delay is None and self._lanes:
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, priority: int, chat_key: Any, pause_key: Any = None) -> None:
+        self._ensure_dispatcher()
+        future = asyncio.get_running_loop().create_future()
+        key = (chat_key, pause_key)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane(key)
+        seq = next(self._seq)
+        head = lane.head()
+        lane.queues.setdefault(priority, collections.deque()).append((seq, future, time.monotonic()))
+        if head is None or priority < head[0]:
+            # 新的隊首：以新的排序鍵重新放進 ready heap，舊項目因版本不符作廢
+            self._push_ready(lane)
+        self._wake.set()
+        await future
+
+    def _pause(self, chat_key: Any, seconds: float) -> None:
+        until = time.monotonic() + seconds
+        self._paused_until[chat_key] = max(self._paused_until.get(chat_key, 0.0), until)
+        if self._wake:
+            self._wake.set()
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Any:
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else endpoint_priority(endpoint)
+        throttled = not _is_unthrottled(endpoint)
+        chat_key = data.get("chat_id") if _is_chat_limited(endpoint) else None
+        # 禁言、刪除等不受每群組限流，但 RetryAfter 仍只暫停該群組；沒有 chat_id 的呼叫才暫停全部
+        pause_key = data.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            if throttled:
+                with span("rate_limit_wait", priority=PRIORITY_NAMES.get(priority, priority)):
+                    await self._acquire(priority, chat_key, pause_key)
+            backoff = 0.0
+            started = time.perf_counter()
+            try:
+                with span(f"api.{endpoint}", attempt=attempt):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                _API_ERRORS.inc(method=endpoint, error="RetryAfter")
+                if attempt == self.max_retries:
+                    raise
+                seconds = _retry_after_seconds(exc) + 0.1
+                self.retries += 1
+                logger.warning("Telegram 頻率限制 %s chat=%s，%.1f 秒後重試", endpoint, pause_key, seconds)
+                if throttled:
+                    # 暫停交給分派器處理：下一輪 _acquire 會等到暫停結束
+                    self._pause(pause_key, seconds)
+                else:
+                    backoff = seconds
+            except Exception as exc:
+                _API_ERRORS.inc(method=endpoint, error=type(exc).__name__)
+                raise
+            finally:
+                _API_LATENCY.labels(method=endpoint).observe(time.perf_counter() - started)
+            if backoff:
+                await asyncio.sleep(backoff)
+        return None
@@ -0,0 +1,96 @@
+"""Per-user profile verdict cache for username / nickname / bio scans.
+
+The join check, the rename re-check and the neutral-message profile lookup all
+run ``detect_ad`` over the same three profile fields, often seconds apart and
+across every group a user is in. Verdicts are keyed by user id plus a digest of
+those fields, so an unchanged profile becomes a dictionary lookup and any edit
+to the fields falls through to a fresh scan.
+"""
+
+import hashlib
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+PROFILE_CACHE_TTL = 3600
+PROFILE_CACHE_MAX_ENTRIES = 50000
+
+ProfileFields = Tuple[Tuple[str, str], ...]
+ProfileHits = List[Tuple[str, str]]
+
+
+def profile_fields(username: Optional[str], full_name: Optional[str], bio: Optional[str]) -> ProfileFields:
+    """Return the labelled profile fields in the order every scan uses."""
+    return (
+        ("用戶名", f"@{username}" if username else ""),
+        ("暱稱", full_name or ""),
+        ("簡介", bio or ""),
+    )
+
+
+def fields_digest(fields: ProfileFields) -> str:
+    """Stable digest of the field texts; changes whenever any field changes."""
+    joined = "\x00".join(text for _label, text in fields)
+    return hashlib.blake2b(joined.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ProfileVerdictCache:
+    """Bounded user-id -> (fields digest, template hits) cache."""
+
+    def __init__(self, ttl: float = PROFILE_CACHE_TTL, max_entries: int = PROFILE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: Dict[int, Tuple[str, float, ProfileHits]] = {}
+        # 入群掃描在執行緒池跑，讀寫都要上鎖
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int, digest: str) -> Optional[ProfileHits]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        cached_digest, stored_at, verdict = entry
+        if cached_digest != digest or time.monotonic() - stored_at > self.ttl:
+            return None
+        return verdict
+
+    def put(self, user_id: int, digest: str, verdict: ProfileHits) -> None:
+        # 重新插入讓字典順序維持「最近寫入在最後」，超量時從最舊的開始淘汰
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (digest, time.monotonic(), verdict)
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        """Drop every verdict, e.g. after the template library or samples change."""
+        with self._lock:
+            self._entries.clear()
+
+    def scan(
+        self,
+        user_id: int,
+        fields: ProfileFields,
+        detector: Callable[[str], Tuple[bool, float, str]],
+    ) -> ProfileHits:
+        """Return ``[(field_label, hit_reason), ...]`` for fields that hit the detector."""
+        digest = fields_digest(fields)
+        cached = self.get(user_id, digest)
+        if cached is not None:
+            self.hits += 1
+            return list(cached)
+        self.misses += 1
+        verdict = []
+        for label, text in fields:
+            if not text:
+                continue
+            hit, _score, reason = detector(text)
+            if hit:
+                verdict.append((label, reason))
+        self.put(user_id, digest, verdict)
+        return list(verdict)
@@ -40,6 +40,12 @@ FEATURE_LABELS = {
 }
 
 
+# 每個功能對應一個位元；群組解析後的開關壓成一個 int 快取在群組紀錄上，
+# feature_enabled 只需一次字典讀取 + 一次位元運算。
+FEATURE_BITS = {name: 1 << index for index, name in enumerate(DEFAULT_FEATURES)}
+FEATURE_MASK_KEY = "_feature_mask"
+
+
 def get_group_features(group: MutableMapping) -> Dict[str, bool]:
     """Return valid settings, filling defaults for old or new group records."""
     stored = group.get("features", {})
@@ -53,11 +59,31 @@ def get_group_features(group: MutableMapping) -> Dict[str, bool]:
     }
 
 
+def compile_group_features(group: MutableMapping) -> int:
+    """Resolve a group's features into an immutable bitmask and cache it on the record."""
+    features = get_group_features(group)
+    mask = 0
+    for name, enabled in features.items():
+        if enabled:
+            mask |= FEATURE_BITS[name]
+    group[FEATURE_MASK_KEY] = mask
+    return mask
+
+
 def feature_enabled(group: MutableMapping, feature: str) -> bool:
     """Check a feature; unknown feature names are disabled for safety."""
-    if feature not in DEFAULT_FEATURES:
+    bit = FEATURE_BITS.get(feature)
+    if bit is None:
         return False
-    return get_group_features(group)[feature]
+    mask = group.get(FEATURE_MASK_KEY)
+    if mask is None:
+        mask = compile_group_features(group)
+    return bool(mask & bit)
+
+
+def persistable_group(group: MutableMapping) -> Dict:
+    """Copy of a group record without derived runtime keys (the feature mask)."""
+    return {key: value for key, value in group.items() if key != FEATURE_MASK_KEY}
 
 
 def set_group_feature(groups: MutableMapping, chat_id: int, feature: str, enabled: bool) -> None:
@@ -68,3 +94,4 @@ def set_group_feature(groups: MutableMapping, chat_id: int, feature: str, enable
     group = groups.setdefault(key, {})
     group["features"] = get_group_features(group)
     group["features"][feature] = bool(enabled)
+    compile_group_features(group)
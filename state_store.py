@@ -0,0 +1,329 @@
+"""SQLite-backed runtime state with coalesced write-behind flushing.
+
+Records are JSON values addressed by ``(namespace, key)``, one row each, so a
+feature toggle rewrites a single group instead of the whole groups file.
+Callers serialize on ``put`` and return immediately; a background thread
+batches every pending row into one WAL transaction. Repeated writes of the same
+key between flushes collapse into the last value.
+
+Records may carry an ``expires_at`` wall-clock deadline. Expired rows are
+invisible to reads and are purged through a partial index on that column, so
+short-lived state (pending verifications, web sessions) can live here too.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+FLUSH_INTERVAL = 0.5
+PURGE_INTERVAL = 60.0
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID
+"""
+_EXPIRY_INDEX = (
+    "CREATE INDEX IF NOT EXISTS records_expiry ON records (expires_at) WHERE expires_at IS NOT NULL"
+)
+
+
+class StateStore:
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(records)")}
+        if "expires_at" not in columns:
+            # 舊版資料庫沒有到期欄位
+            self._conn.execute("ALTER TABLE records ADD COLUMN expires_at REAL")
+        self._conn.execute(_EXPIRY_INDEX)
+        # (namespace, key) -> (序列化後的 JSON, 到期時間)；None 代表刪除
+        self._pending: Dict[Tuple[str, str], Optional[Tuple[str, Optional[float]]]] = {}
+        self._pending_lock = threading.Lock()
+        self._conn_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_deleted = 0
+        self.rows_purged = 0
+
+    # ---------- 讀取 ----------
+    def load(self, namespace: str) -> Dict[str, Any]:
+        """Return every live record in a namespace, including writes not yet flushed."""
+        now = time.time()
+        with self._conn_lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM records WHERE namespace = ? "
+                "AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, now),
+            ).fetchall()
+        data = {}
+        for key, value in rows:
+            try:
+                data[key] = json.loads(value)
+            except json.JSONDecodeError:
+                logger.error("狀態庫資料損毀，略過 %s/%s", namespace, key)
+        with self._pending_lock:
+            for (pending_ns, key), value in self._pending.items():
+                if pending_ns != namespace:
+                    continue
+                if value is None or _expired(value[1], now):
+                    data.pop(key, None)
+                else:
+                    data[key] = json.loads(value[0])
+        return data
+
+    def get(self, namespace: str, key: Any) -> Optional[Any]:
+        """Look up one live record by primary key without loading the namespace."""
+        now = time.time()
+        item = (namespace, str(key))
+        with self._pending_lock:
+            if item in self._pending:
+                value = self._pending[item]
+                return None if value is None or _expired(value[1], now) else json.loads(value[0])
+        with self._conn_lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM records WHERE namespace = ? AND key = ?", item
+            ).fetchone()
+        if row is None or _expired(row[1], now):
+            return None
+        return json.loads(row[0])
+
+    def count(self, namespace: str) -> int:
+        """Number of flushed, unexpired records in a namespace."""
+        with self._conn_lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM records WHERE namespace = ? "
+                "AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, time.time()),
+            ).fetchone()[0]
+
+    # ---------- 寫入 ----------
+    def put(self, namespace: str, key: Any, value: Any, expires_at: Optional[float] = None) -> None:
+        """Queue one record for the next flush; the value is serialized now.
+
+        ``expires_at`` is a ``time.time()`` deadline after which the record is
+        treated as deleted.
+        """
+        encoded = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        with self._pending_lock:
+            self._pending[(namespace, str(key))] = (encoded, expires_at)
+        self._wake.set()
+
+    def delete(self, namespace: str, key: Any) -> None:
+        with self._pending_lock:
+            self._pending[(namespace, str(key))] = None
+        self._wake.set()
+
+    def flush(self) -> int:
+        """Write all pending records in one transaction; returns the row count."""
+        with self._pending_lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+        upserts = [
+            (ns, key, value[0], value[1]) for (ns, key), value in batch.items() if value is not None
+        ]
+        deletes = [(ns, key) for (ns, key), value in batch.items() if value is None]
+        with self._conn_lock:
+            try:
+                self._conn.execute("BEGIN")
+                if upserts:
+                    self._conn.executemany(
+                        "INSERT INTO records (namespace, key, value, expires_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(namespace, key) DO UPDATE SET "
+                        "value = excluded.value, expires_at = excluded.expires_at",
+                        upserts,
+                    )
+                if deletes:
+                    self._conn.executemany(
+                        "DELETE FROM records WHERE namespace = ? AND key = ?", deletes
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                # 寫入失敗時把這批放回去，較新的寫入優先
+                with self._pending_lock:
+                    for item, value in batch.items():
+                        self._pending.setdefault(item, value)
+                raise
+        self.flushes += 1
+        self.rows_written += len(upserts)
+        self.rows_deleted += len(deletes)
+        return len(batch)
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        """Delete flushed rows whose deadline has passed; returns the row count."""
+        now = time.time() if now is None else now
+        with self._conn_lock:
+            purged = self._conn.execute(
+                "DELETE FROM records WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,)
+            ).rowcount
+        self.rows_purged += purged
+        return purged
+
+    # ---------- 背景寫入執行緒 ----------
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="state-store", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        last_purge = time.monotonic()
+        while not self._stopping:
+            self._wake.wait(timeout=PURGE_INTERVAL)
+            if self._stopping:
+                break
+            if self._wake.is_set():
+                # 等一個合併視窗，讓同一波更新併成一筆交易
+                self._wake.clear()
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception as exc:
+                    logger.error("狀態庫寫入失敗: %s", exc)
+            if time.monotonic() - last_purge >= PURGE_INTERVAL:
+                last_purge = time.monotonic()
+                try:
+                    self.purge_expired()
+                except Exception as exc:
+                    logger.error("狀態庫清理過期資料失敗: %s", exc)
+
+    def close(self) -> None:
+        """Stop the writer thread, flush what is left and close the database."""
+        self._stopping = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        try:
+            self.flush()
+        finally:
+            with self._conn_lock:
+                self._conn.close()
+
+    # ---------- 舊資料遷移 ----------
+    def migrate_json(
+        self,
+        namespace: str,
+        json_path: str,
+        transform: Optional[Callable[[Any], Any]] = None,
+    ) -> int:
+        """One-time import of a legacy ``{key: record}`` JSON file into an empty namespace.
+
+        The source file is renamed to ``*.migrated`` afterwards so it is not
+        imported twice. Returns the number of imported records.
+        """
+        if not os.path.exists(json_path) or self.count(namespace):
+            return 0
+        with open(json_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            return 0
+        for key, value in data.items():
+            self.put(namespace, key, transform(value) if transform else value)
+        self.flush()
+        os.replace(json_path, json_path + ".migrated")
+        logger.info("已將 %s 遷移到狀態庫（%d 筆）", json_path, len(data))
+        return len(data)
+
+
+def _expired(expires_at: Optional[float], now: float) -> bool:
+    return expires_at is not None and expires_at <= now
+
+
+class StoredDict(MutableMapping):
+    """A dict whose entries are mirrored into one state-store namespace.
+
+    The namespace is read on first access, not at import time. Assigning or
+    deleting a key queues the write; values mutated in place must be written
+    back with :meth:`save`. With ``ttl`` set, each write also gives the record
+    an expiry so stale entries disappear from the store on their own.
+    """
+
+    def __init__(
+        self,
+        store_factory: Callable[[], StateStore],
+        namespace: str,
+        key_type: Callable[[str], Any] = str,
+        ttl: Optional[float] = None,
+    ):
+        self._store_factory = store_factory
+        self.namespace = namespace
+        self._key_type = key_type
+        self.ttl = ttl
+        self._data: Optional[Dict[Any, Any]] = None
+
+    def _loaded(self) -> Dict[Any, Any]:
+        if self._data is None:
+            data: Dict[Any, Any] = {}
+            try:
+                raw = self._store_factory().load(self.namespace)
+            except Exception as exc:
+                logger.error("讀取狀態庫 %s 失敗: %s", self.namespace, exc)
+                raw = {}
+            for key, value in raw.items():
+                try:
+                    data[self._key_type(key)] = value
+                except (TypeError, ValueError):
+                    continue
+            # 整份讀完才換上，別的執行緒不會看到讀到一半的內容
+            if self._data is None:
+                self._data = data
+        return self._data
+
+    def preload(self) -> None:
+        """Read the namespace now (e.g. from a worker thread) so later access stays in memory."""
+        self._loaded()
+
+    def save(self, key: Any) -> None:
+        """Persist the current value of ``key`` after an in-place change."""
+        value = self._loaded().get(key)
+        if value is None:
+            return
+        expires_at = time.time() + self.ttl if self.ttl else None
+        try:
+            self._store_factory().put(self.namespace, key, value, expires_at)
+        except Exception as exc:
+            logger.error("寫入狀態庫 %s/%s 失敗: %s", self.namespace, key, exc)
+
+    def __getitem__(self, key: Any) -> Any:
+        return self._loaded()[key]
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self._loaded()[key] = value
+        self.save(key)
+
+    def __delitem__(self, key: Any) -> None:
+        del self._loaded()[key]
+        try:
+            self._store_factory().delete(self.namespace, key)
+        except Exception as exc:
+            logger.error("刪除狀態庫 %s/%s 失敗: %s", self.namespace, key, exc)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._loaded())
+
+    def __len__(self) -> int:
+        return len(self._loaded())
@@ -1,6 +1,7 @@
 import unittest
 
 from ad_detector import clean_text, detect_ad
+from metrics import counter, histogram
 
 
 class ObfuscatedAdTests(unittest.TestCase):
@@ -55,5 +56,16 @@ class ObfuscatedAdTests(unittest.TestCase):
         self.assertTrue(detect_ad(text)[0])
 
 
+class DetectAdMetricsTests(unittest.TestCase):
+    def test_verdicts_and_stage_latency_are_recorded(self):
+        verdicts = counter("detect_ad_verdicts_total")
+        stages = histogram("detect_ad_stage_seconds")
+        before = verdicts.value(verdict="ad", reason="rules")
+        rules_before = stages.labels(stage="rules").count
+        detect_ad("五大联赛足球红单推荐👗天天收米🦆日赚6千 @xhdkm8121bot")
+        self.assertEqual(verdicts.value(verdict="ad", reason="rules"), before + 1)
+        self.assertEqual(stages.labels(stage="rules").count, rules_before + 1)
+
+
 if __name__ == "__main__":
     unittest.main()
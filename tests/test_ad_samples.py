@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import ad_samples
+import ad_templates
+from ad_samples import SampleIndex, SampleStore, sample_id
+
+
+class SampleIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.items = [f"兼職日結 {i} 號 加我飛機" if i % 3 == 0 else f"今天天氣不錯 {i}" for i in range(100)]
+        self.index = SampleIndex(self.items)
+
+    def test_pages_walk_the_whole_library_once(self):
+        seen = []
+        cursor = ""
+        while True:
+            page = self.index.page(cursor=cursor, limit=30)
+            self.assertLessEqual(len(page["items"]), 30)
+            seen.extend(item["text"] for item in page["items"])
+            cursor = page["next"]
+            if not cursor:
+                break
+        self.assertEqual(seen, self.items)
+
+    def test_cursor_survives_removal_of_last_item(self):
+        first = self.index.page(limit=10)
+        removed = self.items[9]
+        shrunk = SampleIndex([text for text in self.items if text != removed])
+        second = shrunk.page(cursor=first["next"], limit=10)
+        self.assertEqual(second["items"][0]["text"], self.items[10])
+
+    def test_substring_search_ignores_width_and_symbols(self):
+        page = self.index.page(query="兼職日結０號")
+        self.assertEqual([item["text"] for item in page["items"]], ["兼職日結 0 號 加我飛機"])
+        page = self.index.page(query="兼職 日結", limit=50)
+        self.assertEqual(page["total"], 34)
+        self.assertTrue(all("兼職" in item["text"] for item in page["items"]))
+        self.assertEqual(self.index.page(query="7")["total"], len([t for t in self.items if "7" in t]))
+
+    def test_similarity_search_ranks_closest_first(self):
+        page = self.index.page(query="兼職日結3號加我飛機", similar=True)
+        self.assertEqual(page["items"][0]["text"], "兼職日結 3 號 加我飛機")
+        self.assertNotIn("天氣", "".join(item["text"] for item in page["items"]))
+
+    def test_ids_are_stable_and_resolvable(self):
+        sid = sample_id(self.items[5])
+        self.assertEqual(SampleIndex(reversed(self.items)).get(sid), self.items[5])
+
+
+class SampleStorageTests(unittest.TestCase):
+    def test_remove_by_id_and_index_refresh(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ads.json")
+            with mock.patch.object(ad_samples, "AD_SAMPLES_FILE", path):
+                ad_samples.save_ad_samples(["第一條樣本內容", "第二條樣本內容"])
+                index = ad_samples.ad_sample_index()
+                self.assertIs(index, ad_samples.ad_sample_index())
+                sid = index.page()["items"][0]["id"]
+                self.assertEqual(ad_samples.remove_ad_sample_by_id(sid), "第一條樣本內容")
+                self.assertIsNone(ad_samples.remove_ad_sample_by_id(sid))
+                self.assertEqual([i["text"] for i in ad_samples.ad_sample_index().page()["items"]], ["第二條樣本內容"])
+
+    def test_async_save_replaces_the_library_off_loop(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ads.json")
+            with mock.patch.object(ad_samples, "AD_SAMPLES_FILE", path):
+                ad_samples.add_ad_sample("整理前的樣本")
+                asyncio.run(ad_samples.save_ad_samples_async(["整理後的樣本"]))
+                self.assertEqual(ad_samples.load_ad_samples(), ["整理後的樣本"])
+                self.assertEqual(SampleStore(path).journal_ops(), 0)
+
+
+class SampleStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "ads.json")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_file_is_parsed_once_until_it_changes_on_disk(self):
+        store = SampleStore(self.path)
+        store.add("第一條樣本內容")
+        for _ in range(5):
+            self.assertEqual(store.items(), ["第一條樣本內容"])
+        self.assertEqual(store.loads, 1)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(["外部寫入的樣本", "第一條樣本內容"], f, ensure_ascii=False)
+        store.items()
+        store.wait_reload(5)
+        self.assertEqual(store.items(), ["外部寫入的樣本", "第一條樣本內容"])
+        self.assertEqual(store.loads, 2)
+
+    def test_readers_keep_serving_old_data_while_a_reload_reads_the_disk(self):
+        store = SampleStore(self.path)
+        store.add("舊樣本")
+        ad_samples._save(self.path, ["新樣本"])
+        os.remove(store.journal_path)
+        entered, release = threading.Event(), threading.Event()
+        real_load = ad_samples._load
+        threads = []
+
+        def slow_load(path):
+            threads.append(threading.get_ident())
+            entered.set()
+            release.wait(5)
+            return real_load(path)
+
+        with mock.patch.object(ad_samples, "_load", slow_load):
+            # 讀取端只觸發背景重讀，自己不解析也不等待
+            self.assertEqual(store.items(), ["舊樣本"])
+            self.assertTrue(entered.wait(5))
+            self.assertNotIn(threading.get_ident(), threads)
+            self.assertEqual(store.items(), ["舊樣本"])
+            release.set()
+            store.wait_reload(5)
+        self.assertEqual(store.items(), ["新樣本"])
+        self.assertEqual(store.loads, 2)
+
+    def test_normalized_duplicates_are_rejected_against_both_libraries(self):
+        store = SampleStore(self.path)
+        self.assertTrue(store.add("兼職日結 加我飛機", dedupe_against_official=True))
+        self.assertFalse(store.add("兼職日結　加我飛機！", dedupe_against_official=True))
+        self.assertFalse(store.add(ad_templates.AD_TEMPLATES[0] + " ", dedupe_against_official=True))
+        self.assertTrue(store.remove("兼職日結 加我飛機"))
+        self.assertTrue(store.add("兼職日結　加我飛機！", dedupe_against_official=True))
+        self.assertEqual(SampleStore(self.path).items(), ["兼職日結　加我飛機！"])
+
+    def test_writes_append_to_the_journal_and_replay_on_load(self):
+        ad_samples._save(self.path, ["快照裡的樣本"])
+        store = SampleStore(self.path)
+        store.add("第一條")
+        store.add("第二條")
+        store.remove("快照裡的樣本")
+        with open(self.path, encoding="utf-8") as f:
+            self.assertEqual(json.load(f), ["快照裡的樣本"])
+        with open(store.journal_path, "a", encoding="utf-8") as f:
+            f.write('{"op": "add", "text": "寫到一半')
+        reloaded = SampleStore(self.path)
+        self.assertEqual(reloaded.items(), ["第一條", "第二條"])
+        self.assertEqual(reloaded.journal_ops(), 3)
+
+    def test_writes_after_a_torn_line_survive_reload(self):
+        store = SampleStore(self.path)
+        store.add("當機前")
+        with open(store.journal_path, "a", encoding="utf-8") as f:
+            f.write('{"op": "add", "text": "寫到一半')
+        restarted = SampleStore(self.path)
+        self.assertTrue(restarted.add("after-crash"))
+        self.assertTrue(restarted.remove("當機前"))
+        self.assertEqual(SampleStore(self.path).items(), ["after-crash"])
+
+    def test_compaction_folds_the_journal_into_the_snapshot(self):
+        store = SampleStore(self.path, compact_min_ops=10)
+        for i in range(10):
+            store.add(f"樣本 {i}")
+        store.wait_compaction(5)
+        self.assertEqual(store.compactions, 1)
+        self.assertEqual(store.journal_ops(), 0)
+        self.assertEqual(os.path.getsize(store.journal_path), 0)
+        with open(self.path, encoding="utf-8") as f:
+            self.assertEqual(json.load(f), [f"樣本 {i}" for i in range(10)])
+        store.remove("樣本 3")
+        self.assertEqual(len(SampleStore(self.path).items()), 9)
+
+    def test_replaying_a_journal_already_in_the_snapshot_is_harmless(self):
+        store = SampleStore(self.path)
+        store.add("甲")
+        store.add("乙")
+        store.remove("甲")
+        store.add("甲")
+        with open(store.journal_path, encoding="utf-8") as f:
+            journal = f.read()
+        store.compact()
+        # 模擬寫完快照、清日誌前當機
+        with open(store.journal_path, "w", encoding="utf-8") as f:
+            f.write(journal)
+        self.assertEqual(sorted(SampleStore(self.path).items()), ["乙", "甲"])
+
+    def test_official_keys_follow_template_reload(self):
+        keys = ad_samples.official_template_keys()
+        self.assertIs(keys, ad_samples.official_template_keys())
+        with mock.patch.object(ad_templates, "AD_TEMPLATES", ["全新模板內容"]):
+            self.assertEqual(ad_samples.official_template_keys(), {"全新模板內容"})
+        self.assertEqual(ad_samples.official_template_keys(), keys)
+
+    def test_async_writers_run_off_loop_without_losing_updates(self):
+        store = SampleStore(self.path)
+
+        async def main():
+            results = await asyncio.gather(*(store.run_async(store.add, f"樣本 {i}") for i in range(30)))
+            return results
+
+        self.assertTrue(all(asyncio.run(main())))
+        self.assertEqual(len(SampleStore(self.path).items()), 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
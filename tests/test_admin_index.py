@@ -0,0 +1,78 @@
+import asyncio
+import time
+import unittest
+
+from admin_index import AdminIndex
+
+
+class AdminIndexTests(unittest.IsolatedAsyncioTestCase):
+    async def test_refreshes_misses_concurrently_with_a_bound(self):
+        index = AdminIndex(concurrency=4)
+        active = 0
+        peak = 0
+
+        async def fetch(chat_id):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return [1, 2] if chat_id % 2 else [2]
+
+        started = time.perf_counter()
+        chats = await index.chats_for(1, range(40), fetch)
+        elapsed = time.perf_counter() - started
+        self.assertEqual(chats, list(range(1, 40, 2)))
+        self.assertEqual(peak, 4)
+        # 40 個群組、4 個並行 -> 約 10 輪，而不是 40 輪
+        self.assertLess(elapsed, 0.3)
+        self.assertEqual(index.refreshes, 40)
+
+    async def test_warm_cache_answers_without_fetching(self):
+        index = AdminIndex()
+        for chat_id in range(500):
+            index.set_admins(chat_id, [7] if chat_id < 3 else [8])
+
+        async def fetch(chat_id):
+            raise AssertionError("warm cache should not fetch")
+
+        self.assertEqual(await index.chats_for(7, range(500), fetch), [0, 1, 2])
+        self.assertEqual(index.hits, 500)
+
+    async def test_chat_member_updates_promote_and_demote(self):
+        index = AdminIndex()
+        index.set_admins(-100, [1])
+        index.observe(-100, 2, True)
+        index.observe(-100, 1, False)
+        index.observe(-200, 3, True)  # 未快取的群組等下次回源
+        self.assertIs(index.is_admin(-100, 2), True)
+        self.assertIs(index.is_admin(-100, 1), False)
+        self.assertIsNone(index.is_admin(-200, 3))
+        self.assertEqual(index.stats()["users"], 1)
+
+    async def test_failed_or_stale_refresh_drops_access(self):
+        index = AdminIndex(ttl=60)
+        index.set_admins(-100, [1], now=time.monotonic() - 120)
+
+        async def fetch(chat_id):
+            return None
+
+        self.assertEqual(await index.chats_for(1, [-100], fetch), [])
+        self.assertEqual(index.failures, 1)
+
+    async def test_concurrent_lookups_share_one_refresh(self):
+        index = AdminIndex()
+        calls = []
+
+        async def fetch(chat_id):
+            calls.append(chat_id)
+            await asyncio.sleep(0.01)
+            return [1]
+
+        results = await asyncio.gather(*(index.chats_for(1, [-100], fetch) for _ in range(5)))
+        self.assertEqual(results, [[-100]] * 5)
+        self.assertEqual(calls, [-100])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import itertools
+import os
+import tempfile
+import unittest
+
+from captcha_library import CaptchaLibrary
+from state_store import StateStore
+
+
+def _uploader(log):
+    counter = itertools.count()
+
+    async def upload():
+        n = next(counter)
+        log.append(n)
+        return f"file{n}", f"uniq{n}", n
+
+    return upload
+
+
+class CaptchaLibraryTests(unittest.IsolatedAsyncioTestCase):
+    async def test_refresh_uploads_gradually(self):
+        uploads = []
+        library = CaptchaLibrary(_uploader(uploads), size=5, uploads_per_round=2)
+        self.assertIsNone(library.take())
+        self.assertEqual(await library.refresh(), 2)
+        self.assertEqual(len(library), 2)
+        await library.refresh()
+        await library.refresh()
+        self.assertEqual(len(library), 5)
+        # 已滿時不再上傳，直到有題目用完或過期
+        self.assertEqual(await library.refresh(), 0)
+        self.assertEqual((len(library), library.retired, len(uploads)), (5, 0, 5))
+
+    async def test_refresh_replaces_only_used_up_and_expired_entries(self):
+        library = CaptchaLibrary(_uploader([]), size=3, max_uses=1, max_age=60, uploads_per_round=3)
+        await library.refresh(now=0)
+        library.take(now=10)
+        self.assertEqual(await library.refresh(now=10), 1)
+        self.assertEqual(await library.refresh(now=50), 0)
+        self.assertEqual(await library.refresh(now=61), 2)
+        self.assertEqual((len(library), library.retired), (3, 3))
+
+    async def test_entries_retire_after_max_uses(self):
+        library = CaptchaLibrary(_uploader([]), size=1, max_uses=3)
+        await library.refresh()
+        served = [library.take() for _ in range(4)]
+        self.assertEqual(served[:3], [("file0", 0)] * 3)
+        self.assertIsNone(served[3])
+        self.assertEqual(library.stats()["retired"], 1)
+
+    async def test_expired_entries_are_not_served(self):
+        library = CaptchaLibrary(_uploader([]), size=1, max_age=60)
+        library.add("u", "old", 7, now=0)
+        self.assertIsNone(library.take(now=61))
+
+    async def test_forget_rejected_file_id(self):
+        library = CaptchaLibrary(_uploader([]))
+        library.add("u", "bad", 1)
+        library.forget("bad")
+        self.assertEqual(len(library), 0)
+
+    async def test_entries_survive_restart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = StateStore(os.path.join(tmp, "state.sqlite3"))
+            library = CaptchaLibrary(_uploader([]), store, size=3, uploads_per_round=3)
+            await library.refresh()
+            library.take()
+            store.flush()
+            restored = CaptchaLibrary(_uploader([]), store)
+            self.assertEqual(restored.load(), 3)
+            self.assertEqual(sum(entry["uses"] for entry in restored._entries.values()), 1)
+            store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from captcha_pool import DEMAND_WINDOW, CaptchaPool, RenderExecutor
+from web_verification import SessionStore, _font, _render_challenge
+
+
+class CaptchaPoolTests(unittest.TestCase):
+    def test_take_serves_prerendered_challenges(self):
+        counter = iter(range(1000))
+        pool = CaptchaPool(lambda: (next(counter), b"png"), min_size=4)
+        pool.fill()
+        self.assertEqual(len(pool), 4)
+        self.assertEqual(pool.take(), (0, b"png"))
+        self.assertEqual(pool.hits, 1)
+        self.assertEqual(pool.misses, 0)
+        pool.stop()
+
+    def test_empty_pool_renders_inline(self):
+        pool = CaptchaPool(lambda: ("1", b"png"), min_size=0)
+        pool._ensure_started = lambda: None
+        self.assertEqual(pool.take(), ("1", b"png"))
+        self.assertEqual(pool.misses, 1)
+
+    def test_session_on_an_empty_pool_defers_rendering(self):
+        pool = CaptchaPool(_render_challenge, min_size=0)
+        pool._ensure_started = lambda: None
+        sessions = SessionStore(pool=pool)
+        token = sessions.create(1, -100)
+        self.assertEqual((pool.misses, pool.rendered), (1, 0))
+        self.assertIsNone(sessions.cached_image(token))
+        self.assertTrue(sessions.image(token).startswith(b"\x89PNG"))
+
+    def test_target_scales_with_demand(self):
+        pool = CaptchaPool(lambda: ("1", b""), min_size=8, max_size=100, horizon=30)
+        now = time.monotonic()
+        self.assertEqual(pool.target(now), 8)
+        pool._takes.extend([now] * 120)  # 每分鐘 120 次 -> 30 秒約 60 張
+        self.assertEqual(pool.target(now), 60)
+        pool._takes.extend([now] * 1000)
+        self.assertEqual(pool.target(now), 100)
+        self.assertEqual(pool.target(now + DEMAND_WINDOW + 1), 8)
+
+    def test_background_thread_refills(self):
+        pool = CaptchaPool(_render_challenge, min_size=3)
+        answer, image = pool.take()
+        self.assertEqual(len(answer), 6)
+        self.assertTrue(image.startswith(b"\x89PNG"))
+        deadline = time.monotonic() + 5
+        while len(pool) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        pool.stop()
+        self.assertGreaterEqual(len(pool), 3)
+
+    def test_fonts_are_loaded_once_per_size(self):
+        self.assertIs(_font(36), _font(36))
+
+    def test_session_image_is_a_lookup_and_rotates(self):
+        pool = CaptchaPool(_render_challenge, min_size=2)
+        pool.fill()
+        sessions = SessionStore(pool=pool)
+        token = sessions.create(1, -100)
+        first = sessions.image(token)
+        self.assertIs(first, sessions.image(token))
+        rotated = sessions.rotate_captcha(token)
+        self.assertIs(rotated, sessions.image(token))
+        self.assertIsNot(rotated, first)
+        self.assertTrue(sessions.claim(token))
+        self.assertIsNone(sessions.image(token))
+        pool.stop()
+
+
+class RenderExecutorTests(unittest.IsolatedAsyncioTestCase):
+    async def test_pool_miss_renders_off_the_event_loop(self):
+        loop_thread = threading.get_ident()
+        threads = []
+
+        def render():
+            threads.append(threading.get_ident())
+            return "1", b"png"
+
+        pool = CaptchaPool(render, min_size=0)
+        pool._ensure_started = lambda: None
+        executor = RenderExecutor(max_workers=1)
+        self.assertEqual(await pool.take_async(executor), ("1", b"png"))
+        self.assertEqual(pool.misses, 1)
+        self.assertNotIn(loop_thread, threads)
+        executor.shutdown()
+
+    async def test_queue_is_bounded(self):
+        release = threading.Event()
+        executor = RenderExecutor(max_workers=1, max_queue=1)
+        jobs = [asyncio.create_task(executor.run(release.wait, 5)) for _ in range(4)]
+        await asyncio.sleep(0.05)
+        # 1 個執行中 + 1 個排隊，其餘在外面等空位
+        self.assertEqual(executor.waiting, 2)
+        release.set()
+        await asyncio.gather(*jobs)
+        self.assertEqual(executor.waiting, 0)
+        executor.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
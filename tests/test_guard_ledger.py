@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from guard_ledger import GuardLedger
+
+
+class GuardLedgerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_append_read_and_reset(self):
+        ledger = GuardLedger(self.tmp.name)
+        for user_id in range(3):
+            ledger.append(-100, user_id, f"user{user_id}")
+        self.assertEqual(ledger.append(-100, 1, "duplicate event"), 3)
+        joined = ledger.read(-100)
+        self.assertEqual([u["id"] for u in joined], [0, 1, 2])
+        self.assertEqual(joined[1]["name"], "user1")
+        ledger.reset(-100)
+        self.assertEqual(ledger.read(-100), [])
+
+    def test_ledger_survives_restart_and_skips_torn_line(self):
+        ledger = GuardLedger(self.tmp.name, flush_interval=0.01)
+        ledger.start()
+        ledger.append(-100, 7, "seven")
+        ledger.close()
+        with open(os.path.join(self.tmp.name, "-100.jsonl"), "a", encoding="utf-8") as f:
+            f.write('{"id": 8, "na')
+        reopened = GuardLedger(self.tmp.name)
+        self.assertEqual(reopened.read(-100), [{"id": 7, "name": "seven"}])
+        self.assertEqual(reopened.append(-100, 9, "nine"), 2)
+        self.assertEqual([u["id"] for u in reopened.read(-100)], [7, 9])
+
+    def test_append_never_reads_the_file_and_writer_merges_earlier_runs(self):
+        ledger = GuardLedger(self.tmp.name)
+        ledger.append(-100, 7, "seven")
+        ledger.close()
+        reopened = GuardLedger(self.tmp.name)
+        with mock.patch("builtins.open", side_effect=AssertionError("append touched the disk")):
+            self.assertEqual(reopened.append(-100, 7, "seven again"), 1)
+            self.assertEqual(reopened.append(-100, 8, "eight"), 2)
+        reopened.flush()
+        # 寫入執行緒讀過舊檔後，重複的 7 不會再寫一次，計數也併入舊名單
+        self.assertEqual(reopened.append(-100, 9, "nine"), 3)
+        reopened.flush()
+        with open(os.path.join(self.tmp.name, "-100.jsonl"), encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import unittest
+
+from join_pipeline import PRIORITY_RESTRICT, PRIORITY_SCAN, JoinPipeline
+
+
+class _Clock:
+    """Virtual time: every sleeping job wakes on the next tick, once all runnable work has settled."""
+
+    def __init__(self):
+        self.ticks = 0
+        self._tick = None
+
+    async def sleep(self):
+        if self._tick is None:
+            self._tick = asyncio.get_running_loop().create_future()
+        await self._tick
+
+    async def run(self, done):
+        while not done():
+            for _ in range(20):
+                await asyncio.sleep(0)
+            tick, self._tick = self._tick, None
+            if tick is not None:
+                self.ticks += 1
+                tick.set_result(None)
+
+
+class JoinPipelineTests(unittest.TestCase):
+    def test_raid_simulation_throughput_and_queue_depth(self):
+        """600 joins (plus duplicate events) across 3 chats, one tick of API latency each."""
+        joins = 600
+
+        async def scenario():
+            pipeline = JoinPipeline(concurrency=16, per_chat_concurrency=4)
+            clock = _Clock()
+            handled = []
+            running = {}
+            peaks = {"total": 0}
+
+            async def job(chat_id, user_id):
+                running[chat_id] = running.get(chat_id, 0) + 1
+                peaks[chat_id] = max(peaks.get(chat_id, 0), running[chat_id])
+                peaks["total"] = max(peaks["total"], sum(running.values()))
+                await clock.sleep()
+                running[chat_id] -= 1
+                handled.append((chat_id, user_id))
+
+            for user_id in range(joins):
+                chat_id = -100 - user_id % 3
+                pipeline.submit(chat_id, ("scan", user_id), lambda c=chat_id, u=user_id: job(c, u))
+                # Telegram 重送同一次入群事件
+                pipeline.submit(chat_id, ("scan", user_id), lambda c=chat_id, u=user_id: job(c, u))
+            await clock.run(lambda: len(handled) == joins)
+            await pipeline.drain()
+            pipeline.shutdown()
+            return pipeline, handled, peaks, clock.ticks
+
+        pipeline, handled, peaks, ticks = asyncio.run(scenario())
+        self.assertEqual(len(handled), joins)
+        self.assertEqual(len(set(handled)), joins)
+        self.assertEqual(pipeline.deduped, joins)
+        self.assertEqual(pipeline.depth(), 0)
+        self.assertGreaterEqual(pipeline.max_depth, joins - 12)
+        # 三個群組各自跑滿 4 個並行：600 次掃描只花 600 / 12 = 50 個延遲單位，逐一處理要 600 個
+        self.assertEqual(ticks, joins // 12)
+        self.assertEqual(peaks.pop("total"), 12)
+        self.assertEqual(peaks, {-100: 4, -101: 4, -102: 4})
+
+    def test_redelivered_join_after_the_scan_finished_is_dropped_within_the_window(self):
+        async def scenario():
+            pipeline = JoinPipeline(dedupe_window=0.05)
+            scans = []
+
+            async def scan():
+                scans.append(1)
+
+            accepted = [pipeline.submit(-100, ("scan", 1), scan)]
+            await pipeline.drain()
+            accepted.append(pipeline.submit(-100, ("scan", 1), scan))
+            await asyncio.sleep(0.06)
+            accepted.append(pipeline.submit(-100, ("scan", 1), scan))
+            await pipeline.drain()
+            pipeline.shutdown()
+            return accepted, len(scans)
+
+        accepted, scans = asyncio.run(scenario())
+        self.assertEqual(accepted, [True, False, True])
+        self.assertEqual(scans, 2)
+
+    def test_restrict_jumps_ahead_of_queued_scans(self):
+        async def scenario():
+            pipeline = JoinPipeline(concurrency=1, per_chat_concurrency=1)
+            order = []
+
+            async def scan(user_id):
+                order.append(("scan", user_id))
+                if user_id == 0:
+                    pipeline.submit(-100, ("restrict", 0), restrict, PRIORITY_RESTRICT)
+
+            async def restrict():
+                order.append(("restrict", 0))
+
+            for user_id in range(4):
+                pipeline.submit(-100, ("scan", user_id), lambda u=user_id: scan(u), PRIORITY_SCAN)
+            await pipeline.drain()
+            pipeline.shutdown()
+            return order
+
+        order = asyncio.run(scenario())
+        self.assertEqual(order[:2], [("scan", 0), ("restrict", 0)])
+
+    def test_scans_run_off_the_event_loop(self):
+        async def scenario():
+            pipeline = JoinPipeline()
+            loop_thread = threading.get_ident()
+            worker_thread = await pipeline.run_in_worker(threading.get_ident)
+            pipeline.shutdown()
+            return loop_thread, worker_thread
+
+        loop_thread, worker_thread = asyncio.run(scenario())
+        self.assertNotEqual(loop_thread, worker_thread)
+
+
+if __name__ == "__main__":
+    unittest.main()
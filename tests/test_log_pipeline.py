@@ -0,0 +1,117 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import queue
+import tempfile
+import unittest
+
+from log_pipeline import DroppingQueueHandler, SamplingFilter, setup_logging
+from tracing import Tracer
+
+
+def _record(msg, *args, exc_info=None):
+    return logging.LogRecord("test", logging.INFO, __file__, 1, msg, args, exc_info)
+
+
+class LogPipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "bot.log")
+        root = logging.getLogger()
+        self._saved = (list(root.handlers), root.level)
+
+    def tearDown(self):
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in self._saved[0]:
+            root.addHandler(handler)
+        root.setLevel(self._saved[1])
+        self.tmp.cleanup()
+
+    def _lines(self, path=None):
+        with open(path or self.path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_records_are_written_as_json_lines(self):
+        pipeline = setup_logging(self.path, console=False)
+        log = logging.getLogger("bot")
+        log.info("新成員: %s (ID: %s)", "小明", 42)
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            log.exception("處理失敗")
+        pipeline.stop()
+        first, second = self._lines()
+        self.assertEqual((first["level"], first["logger"], first["msg"]), ("INFO", "bot", "新成員: 小明 (ID: 42)"))
+        self.assertEqual(second["level"], "ERROR")
+        self.assertIn("ValueError: boom", second["exc"])
+
+    def test_rotated_files_are_gzipped(self):
+        pipeline = setup_logging(self.path, max_bytes=2000, backup_count=2, console=False)
+        for i in range(200):
+            logging.getLogger("bot").info("line %s %s", i, "x" * 40)
+        pipeline.stop()
+        self.assertTrue(os.path.exists(self.path + ".1.gz"))
+        self.assertTrue(os.path.exists(self.path + ".2.gz"))
+        self.assertFalse(os.path.exists(self.path + ".3.gz"))
+        with gzip.open(self.path + ".1.gz", "rt", encoding="utf-8") as f:
+            self.assertTrue(json.loads(f.readline())["msg"].startswith("line "))
+        self.assertEqual(self._lines()[-1]["msg"], f"line 199 {'x' * 40}")
+
+    def test_sampling_limits_hot_templates_and_reports_suppressed(self):
+        pipeline = setup_logging(self.path, sample_rules={"📊 成員狀態變化": (0.0, 3.0)}, console=False)
+        log = logging.getLogger("bot")
+        for i in range(10):
+            log.info("📊 成員狀態變化: %s", i)
+        log.info("👤 新成員: %s", 1)
+        pipeline.sampler._buckets["📊 成員狀態變化"][0] = 1.0
+        log.info("📊 成員狀態變化: %s", "after")
+        pipeline.stop()
+        lines = self._lines()
+        self.assertEqual([line["msg"] for line in lines[:3]], [f"📊 成員狀態變化: {i}" for i in range(3)])
+        self.assertEqual(lines[3]["msg"], "👤 新成員: 1")
+        self.assertEqual((lines[4]["msg"], lines[4]["suppressed"]), ("📊 成員狀態變化: after", 7))
+        self.assertEqual(pipeline.stats()["sampled_out"], 7)
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = DroppingQueueHandler(queue.Queue(1))
+        for i in range(3):
+            handler.handle(_record("msg %s", i))
+        self.assertEqual(handler.dropped, 2)
+
+    def test_mutable_args_are_rendered_before_enqueueing(self):
+        handler = DroppingQueueHandler(queue.Queue())
+        reasons = ["@標籤"]
+        prepared = handler.prepare(_record("原因: %s", reasons))
+        reasons.append("網址/連結")
+        self.assertEqual((prepared.msg, prepared.args), ("原因: ['@標籤']", None))
+        deferred = handler.prepare(_record("用戶 %s", 42))
+        self.assertEqual((deferred.msg, deferred.args), ("用戶 %s", (42,)))
+
+    def test_trace_id_is_captured_on_the_caller(self):
+        handler = DroppingQueueHandler(queue.Queue())
+        prepared = []
+
+        async def work():
+            prepared.append(handler.prepare(_record("inside")))
+
+        asyncio.run(Tracer(None).run("handler", "77", work))
+        self.assertEqual(prepared[0].trace_id, "77")
+        self.assertFalse(hasattr(handler.prepare(_record("outside")), "trace_id"))
+
+
+class SamplingFilterTests(unittest.TestCase):
+    def test_refills_at_the_configured_rate(self):
+        sampler = SamplingFilter({"hot": (1000.0, 1.0)})
+        self.assertTrue(sampler.filter(_record("hot %s", 1)))
+        self.assertFalse(sampler.filter(_record("hot %s", 2)))
+        sampler._buckets["hot"][1] -= 0.01
+        self.assertTrue(sampler.filter(_record("hot %s", 3)))
+        self.assertTrue(sampler.filter(_record("cold")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import asyncio
+import unittest
+
+import metrics
+from metrics import Counter, Histogram, counter, gauge, histogram
+
+
+class HistogramTests(unittest.TestCase):
+    def test_buckets_are_cumulative(self):
+        h = Histogram("t", buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            h.observe(value)
+        self.assertEqual(h.cumulative(), [2, 3, 4])
+        self.assertEqual(h.count, 4)
+        self.assertAlmostEqual(h.sum, 3.65)
+
+    def test_percentile_interpolates_within_bucket(self):
+        h = Histogram("t", buckets=(1.0, 2.0))
+        self.assertIsNone(h.percentile(0.5))
+        for _ in range(10):
+            h.observe(1.5)
+        self.assertAlmostEqual(h.percentile(0.5), 1.5)
+        self.assertAlmostEqual(h.percentile(1.0), 2.0)
+        h.observe(99)
+        self.assertEqual(h.percentile(1.0), 2.0)
+
+    def test_registry_returns_same_histogram(self):
+        self.assertIs(histogram("test_registry_seconds"), histogram("test_registry_seconds"))
+
+
+class ExpositionTests(unittest.TestCase):
+    def test_histogram_with_labels_renders_buckets(self):
+        h = Histogram("stage_seconds", "Stage latency", buckets=(0.1, 1.0), labelnames=("stage",))
+        h.labels(stage="rules").observe(0.05)
+        h.labels(stage="rules").observe(2)
+        lines = h.render()
+        self.assertIn("# TYPE stage_seconds histogram", lines)
+        self.assertIn('stage_seconds_bucket{stage="rules",le="0.1"} 1', lines)
+        self.assertIn('stage_seconds_bucket{stage="rules",le="+Inf"} 2', lines)
+        self.assertIn('stage_seconds_count{stage="rules"} 2', lines)
+
+    def test_counter_escapes_label_values(self):
+        c = Counter("verdicts_total", "Verdicts", labelnames=("reason",))
+        c.inc(reason='say "hi"')
+        c.inc(2, reason='say "hi"')
+        self.assertEqual(c.render()[-1], 'verdicts_total{reason="say \\"hi\\""} 3')
+
+    def test_render_includes_registered_metrics_and_survives_broken_gauge(self):
+        counter("test_render_total", "Test counter").inc()
+        gauge("test_render_size", "Test gauge", lambda: {("a",): 3}, labelnames=("index",))
+        gauge("test_render_broken", "Broken gauge", lambda: 1 / 0)
+        text = metrics.render()
+        self.assertIn("test_render_total 1\n", text)
+        self.assertIn('test_render_size{index="a"} 3\n', text)
+        self.assertNotIn("test_render_broken ", text)
+
+    def test_event_loop_lag_is_sampled(self):
+        async def scenario():
+            task = asyncio.create_task(metrics.monitor_event_loop_lag(interval=0.01))
+            await asyncio.sleep(0.05)
+            task.cancel()
+
+        asyncio.run(scenario())
+        self.assertGreater(histogram("event_loop_lag_seconds").count, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
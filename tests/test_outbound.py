@@ -0,0 +1,204 @@
+import asyncio
+import datetime as dt
+import time
+import unittest
+
+from telegram.error import RetryAfter
+
+from outbound import (
+    PRIORITY_BULK,
+    PRIORITY_CRITICAL,
+    PRIORITY_NOTICE,
+    OutboundScheduler,
+    TokenBucket,
+    endpoint_priority,
+)
+
+
+def _call(scheduler, endpoint, data, log, name=None, rate_limit_args=None):
+    async def callback():
+        log.append(name or endpoint)
+        return True
+
+    return scheduler.process_request(callback, (), {}, endpoint, data, rate_limit_args)
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        now = bucket.updated
+        self.assertEqual(bucket.wait_time(now), 0)
+        bucket.take()
+        bucket.take()
+        self.assertAlmostEqual(bucket.wait_time(now), 0.1)
+        self.assertAlmostEqual(bucket.wait_time(now + 0.1), 0)
+
+
+class OutboundSchedulerTests(unittest.TestCase):
+    def test_endpoint_priorities(self):
+        self.assertEqual(endpoint_priority("restrictChatMember"), PRIORITY_CRITICAL)
+        self.assertEqual(endpoint_priority("deleteMessage"), PRIORITY_CRITICAL)
+        self.assertEqual(endpoint_priority("sendMessage"), PRIORITY_NOTICE)
+        self.assertEqual(endpoint_priority("editMessageText"), PRIORITY_BULK)
+
+    def test_restrict_overtakes_queued_welcomes(self):
+        async def scenario():
+            scheduler = OutboundScheduler(global_rate=20)
+            log = []
+            # 先塞滿全域桶，讓後續呼叫都得排隊
+            scheduler.global_bucket.tokens = 0
+            welcomes = [
+                asyncio.create_task(_call(scheduler, "sendMessage", {"chat_id": -100}, log,
+                                          f"welcome{i}", PRIORITY_BULK))
+                for i in range(5)
+            ]
+            await asyncio.sleep(0)
+            restrict = asyncio.create_task(_call(scheduler, "restrictChatMember", {"chat_id": -100}, log))
+            await asyncio.gather(restrict, *welcomes)
+            await scheduler.shutdown()
+            return scheduler, log
+
+        scheduler, log = asyncio.run(scenario())
+        self.assertEqual(log[0], "restrictChatMember")
+        self.assertEqual(scheduler.wait_stats[PRIORITY_CRITICAL][0], 1)
+        self.assertEqual(scheduler.wait_stats[PRIORITY_BULK][0], 5)
+
+    def test_group_message_bucket_does_not_hold_moderation(self):
+        async def scenario():
+            scheduler = OutboundScheduler(group_rate=0.5, group_burst=1)
+            log = []
+            await _call(scheduler, "sendMessage", {"chat_id": -100}, log)
+            pending = asyncio.create_task(_call(scheduler, "sendMessage", {"chat_id": -100}, log, "second"))
+            await asyncio.sleep(0.05)
+            await _call(scheduler, "deleteMessage", {"chat_id": -100}, log)
+            await _call(scheduler, "sendMessage", {"chat_id": -200}, log, "other chat")
+            pending.cancel()
+            await scheduler.shutdown()
+            return log
+
+        log = asyncio.run(scenario())
+        self.assertEqual(log, ["sendMessage", "deleteMessage", "other chat"])
+
+    def test_reads_bypass_the_queue(self):
+        async def scenario():
+            scheduler = OutboundScheduler()
+            scheduler.global_bucket.tokens = -1000
+            log = []
+            await asyncio.wait_for(_call(scheduler, "getChatMember", {"chat_id": -100}, log), 1)
+            await scheduler.shutdown()
+            return log
+
+        self.assertEqual(asyncio.run(scenario()), ["getChatMember"])
+
+    def test_retry_after_pauses_chat_and_retries(self):
+        async def scenario():
+            scheduler = OutboundScheduler()
+            attempts = []
+
+            async def callback():
+                attempts.append(time.monotonic())
+                if len(attempts) == 1:
+                    raise RetryAfter(dt.timedelta(seconds=0.1))
+                return "ok"
+
+            result = await scheduler.process_request(
+                callback, (), {}, "sendMessage", {"chat_id": -100}, None
+            )
+            await scheduler.shutdown()
+            return scheduler, attempts, result
+
+        scheduler, attempts, result = asyncio.run(scenario())
+        self.assertEqual(result, "ok")
+        self.assertEqual(len(attempts), 2)
+        self.assertGreaterEqual(attempts[1] - attempts[0], 0.1)
+        self.assertEqual(scheduler.retries, 1)
+
+    def test_retry_after_on_moderation_pauses_only_that_chat(self):
+        async def scenario():
+            scheduler = OutboundScheduler()
+            log = []
+            attempts = []
+
+            async def restrict():
+                attempts.append(time.monotonic())
+                if len(attempts) == 1:
+                    raise RetryAfter(dt.timedelta(seconds=0.3))
+                log.append("restrict -100")
+                return True
+
+            first = asyncio.create_task(scheduler.process_request(
+                restrict, (), {}, "restrictChatMember", {"chat_id": -100}, None
+            ))
+            await asyncio.sleep(0.05)
+            await asyncio.wait_for(_call(scheduler, "deleteMessage", {"chat_id": -200}, log, "delete -200"), 0.2)
+            await first
+            await scheduler.shutdown()
+            return log, scheduler
+
+        log, scheduler = asyncio.run(scenario())
+        self.assertEqual(log, ["delete -200", "restrict -100"])
+        self.assertNotIn(None, scheduler._paused_until)
+
+    def test_burst_is_granted_in_priority_then_arrival_order(self):
+        async def scenario():
+            scheduler = OutboundScheduler(global_rate=1000)
+            scheduler.global_bucket.tokens = 0
+            log = []
+            priorities = [PRIORITY_BULK, PRIORITY_CRITICAL, PRIORITY_NOTICE] * 100
+            tasks = [
+                asyncio.create_task(_call(scheduler, "restrictChatMember", {"chat_id": -i}, log, (p, i), p))
+                for i, p in enumerate(priorities)
+            ]
+            await asyncio.gather(*tasks)
+            await scheduler.shutdown()
+            return log
+
+        log = asyncio.run(scenario())
+        self.assertEqual(log, sorted(log))
+
+    def test_burst_on_an_exhausted_chat_is_not_rescanned_per_wakeup(self):
+        async def scenario():
+            scheduler = OutboundScheduler(group_rate=0.001, group_burst=1)
+            checks = []
+            lane_wait = scheduler._lane_wait
+            scheduler._lane_wait = lambda key, now: checks.append(key) or lane_wait(key, now)
+            log = []
+            await _call(scheduler, "sendMessage", {"chat_id": -100}, log)
+            stuck = [
+                asyncio.create_task(_call(scheduler, "sendMessage", {"chat_id": -100}, log, f"stuck{i}"))
+                for i in range(500)
+            ]
+            await asyncio.sleep(0.01)
+            await _call(scheduler, "sendMessage", {"chat_id": -200}, log, "other chat")
+            depth = scheduler.queue_depth()
+            for task in stuck:
+                task.cancel()
+            await asyncio.gather(*stuck, return_exceptions=True)
+            await scheduler.shutdown()
+            return scheduler, log, checks, depth
+
+        scheduler, log, checks, depth = asyncio.run(scenario())
+        self.assertEqual(log, ["sendMessage", "other chat"])
+        self.assertEqual(depth["notice"], 500)
+        # 500 次排隊各喚醒一次分派器，但卡住的群組只在隊首變動或到期時才重新檢查
+        self.assertLess(len(checks), 10)
+        self.assertLessEqual(len(scheduler._ready) + len(scheduler._blocked), 2)
+
+    def test_retry_after_gives_up_after_max_retries(self):
+        async def scenario():
+            scheduler = OutboundScheduler(max_retries=1)
+
+            async def callback():
+                raise RetryAfter(dt.timedelta(seconds=0))
+
+            try:
+                await scheduler.process_request(callback, (), {}, "banChatMember", {"chat_id": -100}, None)
+            finally:
+                await scheduler.shutdown()
+
+        with self.assertRaises(RetryAfter):
+            asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    unittest.main()
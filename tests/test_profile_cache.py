@@ -0,0 +1,50 @@
+import unittest
+
+from profile_cache import ProfileVerdictCache, profile_fields
+
+
+class CountingDetector:
+    def __init__(self, hit_text=""):
+        self.calls = 0
+        self.hit_text = hit_text
+
+    def __call__(self, text):
+        self.calls += 1
+        if self.hit_text and self.hit_text in text:
+            return True, 0.9, "規則命中: test"
+        return False, 0.0, "正常訊息"
+
+
+class ProfileVerdictCacheTests(unittest.TestCase):
+    def test_unchanged_profile_is_a_lookup(self):
+        cache = ProfileVerdictCache()
+        detector = CountingDetector("代收")
+        fields = profile_fields("seller", "日赚代收", "")
+        first = cache.scan(1, fields, detector)
+        second = cache.scan(1, fields, detector)
+        self.assertEqual(first, [("暱稱", "規則命中: test")])
+        self.assertEqual(first, second)
+        self.assertEqual(detector.calls, 2)  # 空簡介不掃
+        self.assertEqual(cache.hits, 1)
+
+    def test_changed_field_rescans(self):
+        cache = ProfileVerdictCache()
+        detector = CountingDetector("代收")
+        cache.scan(1, profile_fields("alice", "Alice", ""), detector)
+        verdict = cache.scan(1, profile_fields("alice", "Alice", "代收跑分"), detector)
+        self.assertEqual(verdict, [("簡介", "規則命中: test")])
+        self.assertEqual(detector.calls, 5)
+
+    def test_clear_and_size_cap(self):
+        cache = ProfileVerdictCache(max_entries=2)
+        detector = CountingDetector()
+        for user_id in range(3):
+            cache.scan(user_id, profile_fields(None, "name", ""), detector)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(0, "anything"))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
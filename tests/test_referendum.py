@@ -0,0 +1,107 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+_TMP = tempfile.mkdtemp()
+os.environ.setdefault("BOT_DATA_DIR", _TMP)
+os.environ.setdefault("BOT_LOG_FILE", os.path.join(_TMP, "bot.log"))
+
+import main  # noqa: E402
+from outbound import PRIORITY_BULK, PRIORITY_NOTICE  # noqa: E402
+from timers import TimerScheduler  # noqa: E402
+
+CHAT_ID = -100123
+
+
+class _Bot:
+    def __init__(self, fail=0):
+        self.edits = []
+        self.fail = fail
+
+    async def edit_message_text(self, **kwargs):
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError("network down")
+        self.edits.append(kwargs)
+
+
+class _Query:
+    def __init__(self, option, user_id):
+        self.data = f"ref_{option}_{CHAT_ID}"
+        self.from_user = SimpleNamespace(id=user_id)
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, *args, **kwargs):
+        raise AssertionError("CallbackQuery.edit_message_text does not accept rate_limit_args")
+
+
+class ReferendumEditTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        main.active_referendums[CHAT_ID] = {
+            "initiator_id": 9,
+            "initiator_name": "發起人",
+            "yes_votes": set(),
+            "no_votes": set(),
+            "current_target": 5,
+            "state": "voting",
+            "leading_option": None,
+            "observation_job": None,
+            "message_id": 10,
+        }
+        self.bot = _Bot()
+        self.context = SimpleNamespace(bot=self.bot)
+        patcher = mock.patch.object(main, "timer_scheduler", TimerScheduler())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        main._cancel_referendum_edit(main.active_referendums.pop(CHAT_ID, None))
+
+    async def _vote(self, option, user_id):
+        update = SimpleNamespace(callback_query=_Query(option, user_id))
+        await main.on_referendum_vote(update, self.context)
+
+    async def test_vote_edits_through_the_bot_with_priority(self):
+        with mock.patch.object(main, "REFERENDUM_EDIT_INTERVAL", 0):
+            await self._vote("yes", 1)
+        self.assertEqual(len(self.bot.edits), 1)
+        edit = self.bot.edits[0]
+        self.assertEqual((edit["chat_id"], edit["message_id"]), (CHAT_ID, 10))
+        self.assertEqual(edit["rate_limit_args"], PRIORITY_BULK)
+        self.assertIn("<b>1</b>", edit["text"])
+        self.assertEqual(main.active_referendums[CHAT_ID]["rendered_text"], edit["text"])
+
+    async def test_votes_within_the_interval_coalesce_into_one_edit(self):
+        with mock.patch.object(main, "REFERENDUM_EDIT_INTERVAL", 0.05):
+            for user_id in range(1, 5):
+                await self._vote("yes", user_id)
+            self.assertEqual(len(self.bot.edits), 1)
+            await asyncio.sleep(0.1)
+        self.assertEqual(len(self.bot.edits), 2)
+        self.assertIn("✅ 支持：<b>4</b>", self.bot.edits[-1]["text"])
+
+    async def test_failed_edit_is_retried_with_the_same_text(self):
+        self.bot.fail = 1
+        main.active_referendums[CHAT_ID]["yes_votes"].add(1)
+        await main._edit_referendum_message(self.context, CHAT_ID)
+        self.assertNotIn("rendered_text", main.active_referendums[CHAT_ID])
+        await main._edit_referendum_message(self.context, CHAT_ID)
+        self.assertEqual(len(self.bot.edits), 1)
+
+    async def test_tie_during_observation_announces_next_round(self):
+        ref = main.active_referendums[CHAT_ID]
+        ref.update(state="observation", leading_option="yes", current_target=1, yes_votes={1})
+        await self._vote("no", 2)
+        edit = self.bot.edits[-1]
+        self.assertEqual(edit["rate_limit_args"], PRIORITY_NOTICE)
+        self.assertIn("進入延長投票，新目標：3 票", edit["text"])
+        self.assertEqual((ref["state"], ref["current_target"]), ("voting", 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,13 @@
 import unittest
 
-from settings import DEFAULT_FEATURES, get_group_features, set_group_feature
+from settings import (
+    DEFAULT_FEATURES,
+    FEATURE_MASK_KEY,
+    feature_enabled,
+    get_group_features,
+    persistable_group,
+    set_group_feature,
+)
 
 
 class SettingsTests(unittest.TestCase):
@@ -31,6 +38,19 @@ class SettingsTests(unittest.TestCase):
         self.assertTrue(features["ad_delete"])
         self.assertTrue(features["ad_mute"])
 
+    def test_feature_mask_is_cached_and_rebuilt_by_set_group_feature(self):
+        groups = {-100: {"features": {"welcome": False}}}
+        self.assertFalse(feature_enabled(groups[-100], "welcome"))
+        self.assertIn(FEATURE_MASK_KEY, groups[-100])
+        set_group_feature(groups, -100, "welcome", True)
+        self.assertTrue(feature_enabled(groups[-100], "welcome"))
+        self.assertFalse(feature_enabled(groups[-100], "no_such_feature"))
+
+    def test_persistable_group_drops_feature_mask(self):
+        group = {"title": "t"}
+        feature_enabled(group, "welcome")
+        self.assertEqual(persistable_group(group), {"title": "t"})
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,113 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from state_store import StateStore, StoredDict
+
+
+class StateStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "state.sqlite3")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_writes_coalesce_and_survive_reopen(self):
+        store = StateStore(self.path)
+        for value in range(5):
+            store.put("groups", -100, {"title": "t", "n": value})
+        store.put("groups", -200, {"title": "gone"})
+        store.delete("groups", -200)
+        self.assertEqual(store.load("groups"), {"-100": {"title": "t", "n": 4}})
+        self.assertEqual(store.flush(), 2)
+        self.assertEqual((store.rows_written, store.rows_deleted), (1, 1))
+        store.close()
+
+        reopened = StateStore(self.path)
+        self.assertEqual(reopened.load("groups"), {"-100": {"title": "t", "n": 4}})
+        reopened.close()
+
+    def test_background_writer_flushes(self):
+        store = StateStore(self.path, flush_interval=0.01)
+        store.start()
+        store.put("groups", 1, {"title": "a"})
+        store.close()
+        reopened = StateStore(self.path)
+        self.assertEqual(reopened.count("groups"), 1)
+        reopened.close()
+
+    def test_json_migration_runs_once(self):
+        legacy = os.path.join(self.tmp.name, "known_groups.json")
+        with open(legacy, "w", encoding="utf-8") as f:
+            json.dump({"-100": {"title": "old"}}, f)
+        store = StateStore(self.path)
+        self.assertEqual(store.migrate_json("groups", legacy), 1)
+        self.assertFalse(os.path.exists(legacy))
+        self.assertTrue(os.path.exists(legacy + ".migrated"))
+        self.assertEqual(store.migrate_json("groups", legacy), 0)
+        self.assertEqual(store.load("groups"), {"-100": {"title": "old"}})
+        store.close()
+
+    def test_expired_records_are_hidden_and_purged(self):
+        store = StateStore(self.path)
+        store.put("sessions", "old", {"n": 1}, expires_at=time.time() - 1)
+        store.put("sessions", "live", {"n": 2}, expires_at=time.time() + 60)
+        self.assertIsNone(store.get("sessions", "old"))
+        store.flush()
+        self.assertEqual(store.load("sessions"), {"live": {"n": 2}})
+        self.assertEqual(store.get("sessions", "live"), {"n": 2})
+        self.assertIsNone(store.get("sessions", "missing"))
+        # 尚未清掉的過期列不算在內
+        self.assertEqual(store.count("sessions"), 1)
+        self.assertEqual(store.purge_expired(), 1)
+        self.assertEqual(store.count("sessions"), 1)
+        store.close()
+
+    def test_adds_expiry_column_to_old_databases(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE records (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+        )
+        conn.execute("INSERT INTO records VALUES ('groups', '-100', '{\"title\": \"t\"}')")
+        conn.commit()
+        conn.close()
+        store = StateStore(self.path)
+        self.assertEqual(store.load("groups"), {"-100": {"title": "t"}})
+        store.put("groups", -200, {"title": "u"}, expires_at=time.time() + 60)
+        store.flush()
+        self.assertEqual(store.count("groups"), 2)
+        store.close()
+
+    def test_stored_dict_loads_lazily_and_persists_in_place_changes(self):
+        store = StateStore(self.path)
+        pending = StoredDict(lambda: store, "verifications", key_type=int, ttl=60)
+        pending[7] = {"chat_id": -100, "attempts": 0}
+        pending[7]["attempts"] = 2
+        pending.save(7)
+        pending[8] = {"chat_id": -100}
+        del pending[8]
+        store.close()
+
+        calls = []
+        reopened = StateStore(self.path)
+
+        def factory():
+            calls.append(1)
+            return reopened
+
+        restored = StoredDict(factory, "verifications", key_type=int)
+        self.assertEqual(calls, [])
+        restored.preload()
+        self.assertEqual(calls, [1])
+        self.assertEqual(dict(restored), {7: {"chat_id": -100, "attempts": 2}})
+        self.assertIn(7, restored)
+        reopened.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
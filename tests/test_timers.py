@@ -0,0 +1,138 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from state_store import StateStore
+from timers import TimerScheduler
+
+
+class TimerSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "state.sqlite3")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_jobs_fire_in_due_order(self):
+        async def scenario():
+            timers = TimerScheduler()
+            fired = []
+
+            async def handler(payload):
+                fired.append(payload["n"])
+
+            timers.register("note", handler)
+            timers.start()
+            for n, delay in ((3, 0.06), (1, 0.02), (2, 0.04)):
+                timers.schedule("note", delay, {"n": n})
+            self.assertEqual(timers.pending(), 3)
+            await asyncio.sleep(0.12)
+            await timers.stop()
+            return timers, fired
+
+        timers, fired = asyncio.run(scenario())
+        self.assertEqual(fired, [1, 2, 3])
+        self.assertEqual(timers.pending(), 0)
+        self.assertEqual(timers.fired, 3)
+
+    def test_cancel_and_replace_by_job_id(self):
+        async def scenario():
+            timers = TimerScheduler()
+            fired = []
+
+            async def handler(payload):
+                fired.append(payload["v"])
+
+            timers.register("note", handler)
+            timers.start()
+            timers.schedule("note", 0.02, {"v": "old"}, "same")
+            timers.schedule("note", 0.04, {"v": "new"}, "same")
+            job = timers.schedule("note", 0.02, {"v": "cancelled"})
+            self.assertTrue(timers.cancel(job))
+            await asyncio.sleep(0.08)
+            await timers.stop()
+            return fired
+
+        self.assertEqual(asyncio.run(scenario()), ["new"])
+
+    def test_jobs_survive_restart_and_overdue_fire_on_boot(self):
+        store = StateStore(self.path)
+        timers = TimerScheduler(store)
+        timers.schedule("group_unmute", 0.01, {"chat_id": -100}, "group_unmute:-100")
+        timers.schedule("unmute", 3600, {"chat_id": -100, "user_id": 7})
+        store.close()
+        time.sleep(0.02)
+
+        async def boot():
+            store = StateStore(self.path)
+            timers = TimerScheduler(store)
+            fired = []
+
+            async def handler(payload):
+                fired.append(payload)
+
+            timers.register("group_unmute", handler)
+            timers.start()
+            self.assertEqual(timers.pending(), 2)
+            await asyncio.sleep(0.02)
+            await timers.stop()
+            store.flush()
+            remaining = store.load("timers")
+            store.close()
+            return timers, fired, remaining
+
+        timers, fired, remaining = asyncio.run(boot())
+        self.assertEqual(fired, [{"chat_id": -100}])
+        self.assertEqual(timers.pending(), 1)
+        self.assertEqual([job["kind"] for job in remaining.values()], ["unmute"])
+
+    def test_job_scheduled_before_start_fires_once(self):
+        async def scenario():
+            store = StateStore(self.path)
+            timers = TimerScheduler(store)
+            fired = []
+
+            async def handler(payload):
+                fired.append(payload["n"])
+
+            timers.register("note", handler)
+            timers.schedule("note", 0.02, {"n": 1}, "early")
+            store.flush()
+            timers.start()
+            self.assertEqual(timers.pending(), 1)
+            self.assertEqual(len(timers._heap), 1)
+            await asyncio.sleep(0.06)
+            await timers.stop()
+            store.close()
+            return fired
+
+        self.assertEqual(asyncio.run(scenario()), [1])
+
+    def test_thousands_of_jobs_share_one_task(self):
+        async def scenario():
+            timers = TimerScheduler()
+            fired = []
+
+            async def handler(payload):
+                fired.append(payload["i"])
+
+            timers.register("delete_message", handler)
+            timers.start()
+            before = len(asyncio.all_tasks())
+            for i in range(5000):
+                timers.schedule("delete_message", 0.05 + i * 1e-6, {"i": i})
+            during = len(asyncio.all_tasks())
+            await asyncio.sleep(0.15)
+            await timers.stop()
+            return before, during, fired
+
+        before, during, fired = asyncio.run(scenario())
+        self.assertEqual(before, during)
+        self.assertEqual(fired, list(range(5000)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+
+import tracing
+from ad_detector import detect_ad
+from tracing import Tracer, instrument_handlers, span
+
+
+class TracingTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "slow.jsonl")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def test_spans_nest_across_awaits_and_tasks(self):
+        tracer = Tracer(self.path, slow_threshold=0.0)
+
+        async def call(name):
+            with span(name):
+                await asyncio.sleep(0.01)
+
+        async def handler(update, context):
+            with span("lookup", chat_id=-100):
+                await call("api.getChatMember")
+            await asyncio.gather(call("api.deleteMessage"), call("api.restrictChatMember"))
+            detect_ad("五大联赛足球红单推荐👗天天收米🦆日赚6千 @xhdkm8121bot")
+
+        traced = tracer.wrap("handle_message", handler)
+        await traced(SimpleNamespace(update_id=42), None)
+        tracer.flush()
+
+        with open(self.path, encoding="utf-8") as f:
+            entry = json.loads(f.readline())
+        self.assertEqual(entry["trace_id"], "42")
+        self.assertEqual(entry["name"], "handle_message")
+        names = [child["name"] for child in entry["children"]]
+        self.assertEqual(names, ["lookup", "api.deleteMessage", "api.restrictChatMember", "detect_ad"])
+        self.assertEqual(entry["children"][0]["attrs"], {"chat_id": -100})
+        self.assertEqual(entry["children"][0]["children"][0]["name"], "api.getChatMember")
+        self.assertGreaterEqual(entry["children"][0]["ms"], 10)
+        stages = [child["name"] for child in entry["children"][3]["children"]]
+        self.assertEqual(stages, ["clean", "rules"])
+        self.assertIs(entry["children"][3]["attrs"]["ad"], True)
+
+    async def test_fast_traces_only_feed_the_summary(self):
+        tracer = Tracer(self.path, slow_threshold=10.0)
+
+        async def handler(update, context):
+            with span("work"):
+                pass
+
+        traced = tracer.wrap("fast_handler", handler)
+        for update_id in range(20):
+            await traced(SimpleNamespace(update_id=update_id), None)
+        tracer.flush()
+        self.assertFalse(os.path.exists(self.path))
+        row = next(row for row in tracer.summary() if row["handler"] == "fast_handler")
+        self.assertGreaterEqual(row["count"], 20)
+        self.assertLessEqual(row["p50"], row["p99"])
+
+    async def test_slow_traces_are_written_off_the_calling_thread(self):
+        tracer = Tracer(self.path, slow_threshold=0.0)
+        writers = []
+        real_write = tracer._write
+
+        def write(lines):
+            writers.append(threading.get_ident())
+            real_write(lines)
+
+        tracer._write = write
+        for update_id in range(3):
+            await tracer.run("slow", str(update_id), lambda: asyncio.sleep(0))
+        tracer.close()
+        self.assertNotIn(threading.get_ident(), writers)
+        with open(self.path, encoding="utf-8") as f:
+            self.assertEqual([json.loads(line)["trace_id"] for line in f], ["0", "1", "2"])
+
+    async def test_full_write_queue_drops_instead_of_blocking(self):
+        tracer = Tracer(self.path, slow_threshold=0.0, queue_size=1)
+        # 佔住寫入執行緒的位置，讓佇列不被消化
+        tracer._writer = threading.current_thread()
+        for update_id in range(3):
+            await tracer.run("slow", str(update_id), lambda: asyncio.sleep(0))
+        self.assertEqual((tracer.dropped, len(tracer.recent_slow)), (2, 3))
+
+    async def test_errors_are_recorded_and_reraised(self):
+        tracer = Tracer(None, slow_threshold=0.0)
+
+        async def handler(update, context):
+            with span("api.sendMessage"):
+                raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            await tracer.wrap("failing", handler)(SimpleNamespace(update_id=1), None)
+        entry = tracer.recent_slow[-1]
+        self.assertEqual(entry["error"], "ValueError")
+        self.assertEqual(entry["children"][0]["error"], "ValueError")
+
+    async def test_bound_jobs_keep_the_trace_id(self):
+        tracer = Tracer(None, slow_threshold=0.0)
+        jobs = []
+
+        async def handler(update, context):
+            jobs.append(tracer.bind("join_scan", lambda: asyncio.sleep(0)))
+
+        await tracer.wrap("handle_chat_member", handler)(SimpleNamespace(update_id=7), None)
+        await jobs[0]()
+        entry = tracer.recent_slow[-1]
+        self.assertEqual((entry["name"], entry["trace_id"]), ("join_scan", "7"))
+        self.assertIn("queued_ms", entry["attrs"])
+
+    async def test_span_is_noop_outside_a_trace_and_bounded_inside(self):
+        with span("orphan") as current:
+            self.assertIsNone(current)
+        tracer = Tracer(None, slow_threshold=0.0)
+
+        async def handler(update, context):
+            for _ in range(tracing.MAX_SPANS + 50):
+                with span("api.getChat"):
+                    pass
+
+        await tracer.wrap("busy", handler)(SimpleNamespace(update_id=3), None)
+        self.assertEqual(len(tracer.recent_slow[-1]["children"]), tracing.MAX_SPANS - 1)
+
+    def test_instrument_wraps_every_handler_once(self):
+        async def start(update, context):
+            return "ok"
+
+        application = SimpleNamespace(handlers={
+            -1: [SimpleNamespace(callback=start)],
+            0: [SimpleNamespace(callback=start), SimpleNamespace(callback=start)],
+        })
+        tracer = Tracer(None)
+        self.assertEqual(instrument_handlers(application, tracer), 3)
+        self.assertEqual(instrument_handlers(application, tracer), 0)
+        result = asyncio.run(application.handlers[0][0].callback(SimpleNamespace(update_id=1), None))
+        self.assertEqual(result, "ok")
+        self.assertEqual(tracer.traces, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import asyncio
+import time
+import unittest
+import urllib.parse
+
+from fake_siteverify import FakeSiteverifyServer
+from tests.web_client import Client, init_data
+from turnstile import TurnstileClient
+from web_verification import WebVerificationServer, _hash
+
+
+class TurnstileClientTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.fake = FakeSiteverifyServer()
+        await self.fake.start()
+
+    async def asyncTearDown(self):
+        await self.fake.stop()
+
+    def _client(self, **kwargs):
+        client = TurnstileClient("secret", endpoint=self.fake.url, **kwargs)
+        self.addAsyncCleanup(client.aclose)
+        return client
+
+    async def test_pass_and_reject(self):
+        client = self._client()
+        self.assertTrue(await client.verify("good"))
+        self.assertFalse(await client.verify("fail-token"))
+        self.assertFalse(await client.verify(""))
+        stats = client.stats()
+        self.assertEqual((stats["passed"], stats["rejected"], stats["requests"]), (1, 1, 2))
+        self.assertEqual(stats["breaker"], "closed")
+        # 被拒絕的 token 不代表服務異常
+        self.assertEqual(client._failures, 0)
+
+    async def test_connections_are_reused(self):
+        client = self._client()
+        for i in range(20):
+            await client.verify(f"t{i}")
+        self.assertEqual(self.fake.requests, 20)
+        self.assertEqual(self.fake.connections, 1)
+
+    async def test_concurrency_is_bounded(self):
+        self.fake.latency = 0.05
+        client = self._client(max_concurrency=2)
+        started = time.perf_counter()
+        results = await asyncio.gather(*(client.verify(f"t{i}") for i in range(6)))
+        self.assertTrue(all(results))
+        # 6 個請求、每次最多 2 個同時進行 -> 至少三輪延遲
+        self.assertGreaterEqual(time.perf_counter() - started, 0.15)
+
+    async def test_breaker_opens_after_errors_and_fails_fast(self):
+        client = TurnstileClient("secret", endpoint="http://127.0.0.1:1/siteverify", breaker_threshold=2)
+        self.addAsyncCleanup(client.aclose)
+        self.assertFalse(await client.verify("a"))
+        self.assertFalse(await client.verify("b"))
+        self.assertEqual(client.breaker_state, "open")
+        self.assertFalse(await client.verify("c"))
+        self.assertEqual(client.counters["short_circuited"], 1)
+        self.assertEqual(client.counters["errors"], 2)
+
+    async def test_slow_replies_open_breaker_and_half_open_probe_recovers(self):
+        self.fake.latency = 0.15
+        client = self._client(slow_threshold=0.1, breaker_threshold=2, breaker_cooldown=0.1)
+        await client.verify("a")
+        await client.verify("b")
+        self.assertEqual(client.breaker_state, "open")
+        self.assertEqual(client.counters["slow"], 2)
+        before = self.fake.requests
+        self.assertFalse(await client.verify("c"))
+        self.assertEqual(self.fake.requests, before)
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(client.breaker_state, "half_open")
+        self.fake.latency = 0
+        probe, blocked = await asyncio.gather(client.verify("d"), client.verify("e"))
+        self.assertTrue(probe)
+        self.assertFalse(blocked)
+        self.assertEqual(client.breaker_state, "closed")
+
+    async def test_failed_probe_reopens_breaker(self):
+        client = self._client(slow_threshold=0.1, breaker_threshold=1, breaker_cooldown=0.05)
+        self.fake.latency = 0.15
+        await client.verify("a")
+        await asyncio.sleep(0.05)
+        await client.verify("probe")
+        self.assertEqual(client.breaker_state, "open")
+
+    async def test_cancelled_probe_does_not_wedge_the_breaker(self):
+        client = self._client(slow_threshold=0.1, breaker_threshold=1, breaker_cooldown=0.05)
+        self.fake.latency = 0.15
+        await client.verify("a")
+        await asyncio.sleep(0.05)
+        self.fake.latency = 1.0
+        probe = asyncio.ensure_future(client.verify("probe"))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await probe
+        self.fake.latency = 0
+        self.assertTrue(await client.verify("retry"))
+        self.assertEqual(client.breaker_state, "closed")
+
+
+class VerificationFlowTests(unittest.IsolatedAsyncioTestCase):
+    async def test_full_flow_against_fake_siteverify(self):
+        fake = FakeSiteverifyServer()
+        await fake.start()
+        completed = []
+
+        async def on_success(token, user_id):
+            completed.append(user_id)
+
+        server = WebVerificationServer(on_success, host="127.0.0.1", port=0)
+        server.bot_token = "123:abc"
+        server.turnstile = TurnstileClient("secret", endpoint=fake.url)
+        await server.start()
+        try:
+            tokens = [server.create_session(user_id, -100) for user_id in (1, 2)]
+            for token in tokens:
+                server.sessions.get(token)["answer"] = _hash("424242")
+
+            async def submit(token, user_id, turnstile):
+                body = urllib.parse.urlencode({
+                    "captcha": "424242", "cf-turnstile-response": turnstile,
+                    "tg_init_data": init_data("123:abc", user_id),
+                }).encode()
+                async with Client(server.port) as client:
+                    status, _headers, _body = await client.request("POST", f"/verify/{token}", body=body)
+                return status
+
+            self.assertEqual(await submit(tokens[0], 1, "ok"), 200)
+            self.assertEqual(await submit(tokens[1], 2, "fail"), 400)
+            self.assertEqual(completed, [1])
+            self.assertEqual(server.turnstile.stats()["passed"], 1)
+        finally:
+            await server.stop()
+            await fake.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
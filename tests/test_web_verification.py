@@ -1,13 +1,37 @@
+import asyncio
+import gzip
+import json
 import os
+import tempfile
+import threading
+import time
 import unittest
+import urllib.parse
+from unittest import mock
 
-from web_verification import WebVerificationServer, _captcha_image, is_configured
+import metrics
+import web_verification
+from state_store import StateStore
+from tests.web_client import Client, init_data, read_response
+from web_verification import (
+    AdminSessionTokens,
+    SessionStore,
+    WebVerificationServer,
+    _Request,
+    _accepted_encodings,
+    _captcha_image,
+    _webapp_secret,
+    is_configured,
+)
 
 
 class WebVerificationTests(unittest.TestCase):
     def test_captcha_image_is_png(self):
         self.assertTrue(_captcha_image("123456").startswith(b"\x89PNG"))
 
+    def test_accepted_encodings_skip_q_zero(self):
+        self.assertEqual(_accepted_encodings("gzip;q=0, br;q=0.5, identity"), {"br", "identity"})
+
     def test_session_url_contains_opaque_token(self):
         old = {name: os.environ.get(name) for name in (
             "WEB_VERIFY_BASE_URL", "CF_TURNSTILE_SITE_KEY", "CF_TURNSTILE_SECRET_KEY", "TELEGRAM_BOT_USERNAME"
@@ -45,5 +69,317 @@ class WebVerificationTests(unittest.TestCase):
                     os.environ[name] = value
 
 
+class SessionStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "state.sqlite3")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_attempts_claim_and_rotation(self):
+        sessions = SessionStore()
+        token = sessions.create(1, -100)
+        before = sessions.get(token)
+        self.assertEqual(sessions.add_attempt(token), 1)
+        sessions.rotate_captcha(token)
+        # 已取得的紀錄是快照，換題不會改到它
+        self.assertEqual(before["attempts"], 0)
+        self.assertNotEqual(sessions.get(token)["answer"], before["answer"])
+        self.assertTrue(sessions.claim(token))
+        self.assertFalse(sessions.claim(token))
+        self.assertEqual(len(sessions), 0)
+        self.assertIsNone(sessions.get(token))
+        self.assertIsNone(sessions.add_attempt(token))
+
+    def test_expired_sessions_are_swept(self):
+        sessions = SessionStore(ttl=60)
+        old = sessions.create(1, -100)
+        live = sessions.create(2, -100)
+        sessions.sweep(now=time.time() + 61)
+        self.assertEqual(len(sessions), 0)
+        self.assertEqual(sessions.stats()["expired"], 2)
+        self.assertIsNone(sessions.get(live))
+
+    def test_global_cap_evicts_oldest_first(self):
+        sessions = SessionStore(max_sessions=3, max_per_user=10)
+        tokens = [sessions.create(user_id, -100) for user_id in range(5)]
+        self.assertEqual(len(sessions), 3)
+        self.assertIsNone(sessions.get(tokens[0]))
+        self.assertIsNone(sessions.get(tokens[1]))
+        self.assertIsNotNone(sessions.get(tokens[4]))
+        self.assertEqual(sessions.stats()["evicted"], 2)
+
+    def test_per_user_cap_keeps_newest_sessions(self):
+        sessions = SessionStore(max_per_user=2)
+        tokens = [sessions.create(7, -100) for _ in range(4)]
+        other = sessions.create(8, -100)
+        self.assertEqual([sessions.get(t) is not None for t in tokens], [False, False, True, True])
+        self.assertIsNotNone(sessions.get(other))
+        stats = sessions.stats()
+        self.assertEqual((stats["live"], stats["users"], stats["evicted_per_user"]), (3, 2, 2))
+
+    def test_unknown_tokens_hit_the_store_once(self):
+        store = StateStore(self.path)
+        sessions = SessionStore(store)
+        used = sessions.create(1, -100)
+        sessions.claim(used)
+        store.flush()
+        recovered = SessionStore(store)
+        calls = []
+        real_get = store.get
+
+        def get(*args):
+            calls.append(args[1])
+            return real_get(*args)
+
+        store.get = get
+        for token in ("random-token", used):
+            self.assertTrue(recovered.needs_store(token))
+            self.assertIsNone(recovered.get(token))
+            self.assertFalse(recovered.needs_store(token))
+            self.assertIsNone(recovered.add_attempt(token))
+            self.assertFalse(recovered.claim(token))
+        self.assertEqual(calls, ["random-token", used])
+        store.close()
+
+    def test_restart_recovery_with_10k_sessions(self):
+        store = StateStore(self.path)
+        sessions = SessionStore(store)
+        tokens = [sessions.create(user_id, -100) for user_id in range(10000)]
+        expired = sessions.create(99999, -100)
+        sessions._replace(expired, created_at=time.time() - 3600)
+        store.close()
+
+        start = time.perf_counter()
+        reopened = StateStore(self.path)
+        recovered = SessionStore(reopened)
+        first = recovered.get(tokens[5000])
+        recovery = time.perf_counter() - start
+        found = sum(recovered.get(token) is not None for token in tokens)
+        self.assertEqual(first["user_id"], 5000)
+        self.assertEqual(found, 10000)
+        self.assertIsNone(recovered.get(expired))
+        self.assertLess(recovery, 1.0)
+        reopened.close()
+
+
+class AdminSessionTokenTests(unittest.TestCase):
+    def test_issue_and_verify(self):
+        tokens = AdminSessionTokens(ttl=60)
+        token = tokens.issue(42, now=1000)
+        self.assertEqual(tokens.verify(token, now=1059), 42)
+        self.assertIsNone(tokens.verify(token, now=1061))
+        self.assertIsNone(AdminSessionTokens().verify(token, now=1000))
+        forged = token.replace("42.", "43.", 1)
+        self.assertIsNone(tokens.verify(forged, now=1000))
+        self.assertIsNone(tokens.verify("garbage", now=1000))
+
+    def test_webapp_secret_is_cached(self):
+        self.assertIs(_webapp_secret("123:abc"), _webapp_secret("123:abc"))
+
+
+class AsyncServerTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.completed = []
+        self.admin_calls = []
+
+        async def on_success(token, user_id):
+            self.completed.append((token, user_id))
+
+        async def admin_callback(user_id, action, payload):
+            self.admin_calls.append((user_id, action, payload))
+            return {"ok": True}
+
+        self.server = WebVerificationServer(
+            on_success, admin_callback=admin_callback, host="127.0.0.1", port=0, max_connections=4
+        )
+        self.server.bot_token = "123:abc"
+        await self.server.start()
+
+    async def asyncTearDown(self):
+        await self.server.stop()
+
+    async def test_page_links_image_instead_of_inlining_it(self):
+        token = self.server.create_session(1, -100)
+        async with Client(self.server.port) as client:
+            status, _headers, body = await client.request("GET", f"/verify/{token}")
+        self.assertEqual(status, 200)
+        self.assertIn(f'src="/verify/{token}/captcha.png"'.encode(), body)
+        self.assertNotIn(b"base64", body)
+
+    async def test_captcha_image_etag_and_rotation_on_one_connection(self):
+        token = self.server.create_session(1, -100)
+        path = f"/verify/{token}/captcha.png"
+        async with Client(self.server.port) as client:
+            status, headers, image = await client.request("GET", path)
+            self.assertEqual((status, headers["content-type"]), (200, "image/png"))
+            self.assertEqual(headers["connection"], "keep-alive")
+            self.assertTrue(image.startswith(b"\x89PNG"))
+            etag = headers["etag"]
+            status, _headers, body = await client.request("GET", path, {"If-None-Match": etag})
+            self.assertEqual((status, body), (304, b""))
+
+            self.server.sessions.rotate_captcha(token)
+            status, headers, rotated = await client.request("GET", path, {"If-None-Match": etag})
+            self.assertEqual(status, 200)
+            self.assertNotEqual(headers["etag"], etag)
+            self.assertNotEqual(rotated, image)
+
+            self.server.sessions.claim(token)
+            status, _headers, _body = await client.request("GET", path)
+            self.assertEqual(status, 410)
+        self.assertEqual(self.server.counters["connections"], 1)
+
+    async def test_overload_returns_503_with_retry_after(self):
+        clients = [await Client(self.server.port).__aenter__() for _ in range(4)]
+        for client in clients:
+            await client.request("GET", "/healthz")
+        async with Client(self.server.port) as extra:
+            extra.writer.write(b"GET /healthz HTTP/1.1\r\n\r\n")
+            status, headers, _body = await read_response(extra.reader)
+        self.assertEqual(status, 503)
+        self.assertIn("retry-after", headers)
+        self.assertEqual(self.server.counters["rejected"], 1)
+        for client in clients:
+            await client.__aexit__()
+
+    async def test_cache_misses_read_and_render_off_the_event_loop(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = StateStore(os.path.join(tmp, "state.sqlite3"))
+            token = SessionStore(store).create(1, -100)
+            store.flush()
+            # 模擬重啟：記憶體索引是空的，只能從狀態庫取回
+            self.server.sessions = SessionStore(store)
+            threads = []
+            real_get, real_render = store.get, web_verification._captcha_image
+
+            def get(*args):
+                threads.append(("get", threading.get_ident()))
+                return real_get(*args)
+
+            def render(answer):
+                threads.append(("render", threading.get_ident()))
+                return real_render(answer)
+
+            store.get = get
+            with mock.patch.object(web_verification, "_captcha_image", render):
+                async with Client(self.server.port) as client:
+                    status, _headers, image = await client.request("GET", f"/verify/{token}/captcha.png")
+            store.close()
+        self.assertEqual(status, 200)
+        self.assertTrue(image.startswith(b"\x89PNG"))
+        self.assertEqual([kind for kind, _ in threads], ["get", "render"])
+        self.assertNotIn(threading.get_ident(), [ident for _, ident in threads])
+
+    async def test_wrong_answer_rotates_and_counts_attempt(self):
+        token = self.server.create_session(1, -100)
+        before = self.server.sessions.get(token)["answer"]
+        body = urllib.parse.urlencode({"captcha": "nope"}).encode()
+        async with Client(self.server.port) as client:
+            status, _headers, page = await client.request("POST", f"/verify/{token}", body=body)
+        self.assertEqual(status, 400)
+        self.assertIn("數字驗證碼錯誤".encode(), page)
+        self.assertNotEqual(self.server.sessions.get(token)["answer"], before)
+        self.assertEqual(self.server.sessions.get(token)["attempts"], 1)
+
+    async def test_slow_unmute_finishes_after_the_response_times_out(self):
+        token = self.server.create_session(42, -100)
+        answer = self.server.sessions.get(token)["captcha"]
+        finished = asyncio.Event()
+
+        async def slow_unmute(token, user_id):
+            await asyncio.sleep(0.2)
+            finished.set()
+
+        async def passed(token, remote_ip=None):
+            return True
+
+        self.server.on_success = slow_unmute
+        self.server.turnstile.verify = passed
+        body = urllib.parse.urlencode({
+            "captcha": answer, "cf-turnstile-response": "ok", "tg_init_data": init_data("123:abc", 42),
+        }).encode()
+        with mock.patch.object(web_verification, "CALLBACK_TIMEOUT", 0.05):
+            async with Client(self.server.port) as client:
+                status, _headers, _body = await client.request("POST", f"/verify/{token}", body=body)
+        self.assertEqual(status, 202)
+        await asyncio.wait_for(finished.wait(), 1)
+
+    async def test_admin_api_awaits_callback_directly(self):
+        body = urllib.parse.urlencode({
+            "init_data": init_data("123:abc", 42), "action": "bootstrap", "payload": "{}",
+        }).encode()
+        async with Client(self.server.port) as client:
+            status, _headers, response = await client.request("POST", "/api/admin", body=body)
+            forbidden, _headers, _ = await client.request(
+                "POST", "/api/admin", body=b"init_data=bad&action=bootstrap"
+            )
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(response)["ok"], True)
+        self.assertEqual(self.admin_calls, [(42, "bootstrap", {})])
+        self.assertEqual(forbidden, 403)
+
+    async def test_admin_api_issues_session_afterinit_data(self):
+        body = urllib.parse.urlencode({"init_data": init_data("123:abc", 42), "action": "bootstrap"}).encode()
+        async with Client(self.server.port) as client:
+            _status, _headers, response = await client.request("POST", "/api/admin", body=body)
+            session = json.loads(response)["session"]
+            body = urllib.parse.urlencode({"session": session, "action": "set_feature", "payload": "{}"}).encode()
+            status, _headers, response = await client.request("POST", "/api/admin", body=body)
+            expired, _headers, _ = await client.request(
+                "POST", "/api/admin", body=b"session=42.1.bad&action=bootstrap"
+            )
+        self.assertEqual(status, 200)
+        self.assertNotIn("session", json.loads(response))
+        self.assertEqual(self.admin_calls[-1], (42, "set_feature", {}))
+        self.assertEqual(expired, 401)
+
+    async def test_static_pages_are_precompressed_with_etags(self):
+        async with Client(self.server.port) as client:
+            status, headers, body = await client.request("GET", "/admin", {"Accept-Encoding": "gzip, deflate"})
+            self.assertEqual((status, headers["content-encoding"]), (200, "gzip"))
+            self.assertEqual(headers["vary"], "Accept-Encoding")
+            page = gzip.decompress(body)
+            self.assertIn(b"<title>", page)
+            gzip_etag = headers["etag"]
+
+            status, headers, plain = await client.request("GET", "/admin", {"Accept-Encoding": "gzip;q=0"})
+            self.assertEqual((status, plain), (200, page))
+            self.assertNotIn("content-encoding", headers)
+            self.assertNotEqual(headers["etag"], gzip_etag)
+
+            status, _headers, body = await client.request(
+                "GET", "/admin", {"Accept-Encoding": "gzip", "If-None-Match": gzip_etag}
+            )
+            self.assertEqual((status, body), (304, b""))
+
+    async def test_metrics_endpoint_exposes_prometheus_text(self):
+        metrics.counter("web_metrics_test_total", "Registered so the scrape is never empty").inc()
+        async with Client(self.server.port) as client:
+            status, headers, body = await client.request("GET", "/metrics")
+            self.assertEqual(status, 200)
+            self.assertTrue(headers["content-type"].startswith("text/plain; version=0.0.4"))
+            self.server.metrics_token = "s3cret"
+            denied, _headers, _ = await client.request("GET", "/metrics")
+            allowed, _headers, _ = await client.request("GET", "/metrics", {"Authorization": "Bearer s3cret"})
+        self.assertIn(b"# TYPE", body)
+        self.assertEqual((denied, allowed), (401, 200))
+
+    async def test_metrics_without_token_are_served_only_to_direct_local_requests(self):
+        async with Client(self.server.port) as client:
+            tunneled, _headers, _ = await client.request("GET", "/metrics", {"Cf-Connecting-Ip": "203.0.113.9"})
+        request = _Request("GET", "/metrics", "HTTP/1.1", {})
+        request.peer = "203.0.113.9"
+        remote = self.server._metrics(request)[0]
+        self.assertEqual((tunneled, remote), (403, 403))
+
+    async def test_oversized_body_is_rejected(self):
+        async with Client(self.server.port) as client:
+            status, headers, _body = await client.request("POST", "/verify/x", body=b"a" * 20000)
+        self.assertEqual(status, 413)
+        self.assertEqual(headers["connection"], "close")
+
+
 if __name__ == "__main__":
     unittest.main()
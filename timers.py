@@ -0,0 +1,151 @@
+"""Persistent delayed-job scheduler.
+
+Delayed unmutes, verification expiries, message cleanup and referendum
+observation windows used to be separate ``asyncio.sleep`` coroutines, which
+were lost on restart or ``/update``. Jobs now live in one min-heap keyed by
+wall-clock due time, served by a single asyncio task, and every job is mirrored
+into the state store so a restarted bot reloads them and fires whatever became
+overdue while it was down.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from state_store import StateStore
+
+TIMERS_NAMESPACE = "timers"
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class TimerScheduler:
+    def __init__(self, store: Optional[StateStore] = None, namespace: str = TIMERS_NAMESPACE):
+        self.store = store
+        self.namespace = namespace
+        self._handlers: Dict[str, Handler] = {}
+        # job_id -> {"kind", "due", "payload"}；heap 內已取消的項目在彈出時略過
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running: set = set()
+        self.fired = 0
+        self.failed = 0
+
+    def register(self, kind: str, handler: Handler) -> None:
+        """Bind a job kind to ``async handler(payload)``."""
+        self._handlers[kind] = handler
+
+    def pending(self) -> int:
+        return len(self._jobs)
+
+    def schedule(self, kind: str, delay: float, payload: Dict[str, Any], job_id: Optional[str] = None) -> str:
+        """Schedule ``kind`` to fire after ``delay`` seconds; reusing a job_id replaces that job."""
+        job_id = job_id or uuid.uuid4().hex
+        job = {"kind": kind, "due": time.time() + max(0.0, delay), "payload": payload}
+        self._add(job_id, job)
+        if self.store:
+            self.store.put(self.namespace, job_id, job)
+        return job_id
+
+    def cancel(self, job_id: Optional[str]) -> bool:
+        if not job_id or self._jobs.pop(job_id, None) is None:
+            return False
+        if self.store:
+            self.store.delete(self.namespace, job_id)
+        return True
+
+    def _add(self, job_id: str, job: Dict[str, Any]) -> None:
+        self._jobs[job_id] = job
+        heapq.heappush(self._heap, (job["due"], next(self._seq), job_id))
+        if self._wake:
+            self._wake.set()
+
+    def load(self) -> int:
+        """Restore persisted jobs not already scheduled in memory; returns how many are overdue."""
+        if not self.store:
+            return 0
+        now = time.time()
+        overdue = 0
+        for job_id, job in self.store.load(self.namespace).items():
+            if job_id in self._jobs:
+                # 啟動前已經排入（記憶體裡是最新版本），再加一次會觸發兩次
+                continue
+            if not isinstance(job, dict) or "kind" not in job or "due" not in job:
+                self.store.delete(self.namespace, job_id)
+                continue
+            job.setdefault("payload", {})
+            self._add(job_id, job)
+            overdue += job["due"] <= now
+        return overdue
+
+    def start(self) -> None:
+        """Load persisted jobs and start the dispatch task on the running loop."""
+        if self._task and not self._task.done():
+            return
+        self._wake = asyncio.Event()
+        overdue = self.load()
+        if self._jobs:
+            logger.info("已載入 %d 個排程工作（%d 個已逾時，立即執行）", len(self._jobs), overdue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            delay = None
+            while self._heap:
+                due, _seq, job_id = self._heap[0]
+                job = self._jobs.get(job_id)
+                if job is None or job["due"] != due:
+                    heapq.heappop(self._heap)  # 已取消或已被重新排程
+                    continue
+                delay = due - time.time()
+                if delay > 0:
+                    break
+                heapq.heappop(self._heap)
+                del self._jobs[job_id]
+                self._fire(job_id, job)
+                delay = None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, job_id: str, job: Dict[str, Any]) -> None:
+        task = asyncio.create_task(self._execute(job_id, job))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _execute(self, job_id: str, job: Dict[str, Any]) -> None:
+        handler = self._handlers.get(job["kind"])
+        try:
+            if handler is None:
+                logger.error("未知的排程工作類型: %s", job["kind"])
+            else:
+                await handler(job["payload"])
+            self.fired += 1
+        except Exception as exc:
+            self.failed += 1
+            logger.error("排程工作失敗 %s (%s): %s", job["kind"], job_id, exc)
+        finally:
+            # 執行完（成功或失敗）才從狀態庫移除：執行中重啟會在下次開機時補跑
+            if self.store and job_id not in self._jobs:
+                self.store.delete(self.namespace, job_id)
@@ -0,0 +1,282 @@
+"""Lightweight per-update tracing.
+
+Every registered handler runs inside a root span; code below it opens child
+spans with ``span(name)`` (Bot API calls in the rate limiter, detection stages
+in ``detect_ad``, helpers in ``main``). The active span lives in a context
+variable, so spans follow the update through awaits and into tasks started
+from it, and ``span`` is a no-op when no trace is active. Work that outlives
+its handler (the join pipeline) is wrapped with ``bind`` and becomes its own
+root span under the same trace id.
+
+Finished roots feed a per-handler latency histogram; roots slower than the
+threshold are appended, with their span tree, to a JSONL file. The file is
+written by a background thread fed through a bounded queue, so a slow disk
+never stalls the event loop; when the queue is full the entry is dropped
+from the file (it is still in ``recent_slow``).
+"""
+
+from __future__ import annotations
+
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, List, Optional
+
+from metrics import histogram
+
+SLOW_THRESHOLD = 1.0
+MAX_SPANS = 256
+MAX_LOG_BYTES = 5 * 1024 * 1024
+RECENT_SLOW = 20
+WRITE_QUEUE = 1000
+logger = logging.getLogger(__name__)
+
+_HANDLER_LATENCY = histogram(
+    "handler_seconds", "Wall time of each handler invocation",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+    labelnames=("handler",),
+)
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "attrs", "start", "duration", "error", "children", "root", "_spans")
+
+    def __init__(self, name: str, trace_id: str, attrs: Dict[str, Any], root: Optional["Span"] = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self.children: List[Span] = []
+        self.root = root or self
+        # 只在根 span 上計數，限制單一 trace 的大小
+        self._spans = 1
+
+    def child(self, name: str, attrs: Dict[str, Any]) -> Optional["Span"]:
+        root = self.root
+        if root.duration is not None or root._spans >= MAX_SPANS:
+            return None
+        root._spans += 1
+        span = Span(name, self.trace_id, attrs, root)
+        self.children.append(span)
+        return span
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.duration = time.perf_counter() - self.start
+        if error is not None:
+            self.error = type(error).__name__
+
+    def to_dict(self, origin: Optional[float] = None) -> Dict[str, Any]:
+        origin = self.start if origin is None else origin
+        out: Dict[str, Any] = {
+            "name": self.name,
+            "offset_ms": round((self.start - origin) * 1000, 3),
+            "ms": None if self.duration is None else round(self.duration * 1000, 3),
+        }
+        if self.attrs:
+            out["attrs"] = self.attrs
+        if self.error:
+            out["error"] = self.error
+        if self.children:
+            out["children"] = [child.to_dict(origin) for child in self.children]
+        return out
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("trace_span", default=None)
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Optional[Span]]:
+    """Child span of the active span; does nothing outside a trace."""
+    parent = _current.get()
+    current = parent.child(name, attrs) if parent is not None else None
+    if current is None:
+        yield None
+        return
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as exc:
+        current.finish(exc)
+        raise
+    else:
+        current.finish()
+    finally:
+        _current.reset(token)
+
+
+def record(name: str, started: float, ended: float, **attrs) -> None:
+    """Attach an already-measured interval (``perf_counter`` values) under the active span."""
+    parent = _current.get()
+    current = parent.child(name, attrs) if parent is not None else None
+    if current is not None:
+        current.start = started
+        current.duration = ended - started
+
+
+def current_trace_id() -> Optional[str]:
+    active = _current.get()
+    return active.trace_id if active is not None else None
+
+
+class Tracer:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        slow_threshold: float = SLOW_THRESHOLD,
+        max_bytes: int = MAX_LOG_BYTES,
+        queue_size: int = WRITE_QUEUE,
+    ):
+        self.path = path
+        self.slow_threshold = slow_threshold
+        self.max_bytes = max_bytes
+        self.recent_slow: Deque[Dict[str, Any]] = deque(maxlen=RECENT_SLOW)
+        self.traces = 0
+        self.slow = 0
+        self.dropped = 0
+        self._handlers: set = set()
+        # None 是結束寫入執行緒的哨兵
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue(queue_size)
+        self._writer: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    async def run(self, name: str, trace_id: str, fn: Callable[[], Awaitable[Any]], **attrs) -> Any:
+        """Run ``fn`` under a new root span named ``name``."""
+        root = Span(name, trace_id, attrs)
+        token = _current.set(root)
+        error: Optional[BaseException] = None
+        try:
+            return await fn()
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            _current.reset(token)
+            root.finish(error)
+            self._finish(root)
+
+    def wrap(self, name: str, callback: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        """Wrap a handler callback ``(update, context)`` so each invocation is a trace."""
+        self._handlers.add(name)
+
+        @functools.wraps(callback)
+        async def traced(update, context):
+            update_id = getattr(update, "update_id", None)
+            trace_id = str(update_id) if update_id is not None else os.urandom(6).hex()
+            return await self.run(name, trace_id, lambda: callback(update, context))
+
+        traced.traced = True
+        return traced
+
+    def bind(self, name: str, fn: Callable[[], Awaitable[Any]]) -> Callable[[], Awaitable[Any]]:
+        """Deferred job that runs as its own root span, linked to the current trace id."""
+        trace_id = current_trace_id() or os.urandom(6).hex()
+        queued_at = time.perf_counter()
+        self._handlers.add(name)
+
+        async def traced():
+            queued_ms = round((time.perf_counter() - queued_at) * 1000, 3)
+            return await self.run(name, trace_id, fn, queued_ms=queued_ms)
+
+        return traced
+
+    def _finish(self, root: Span) -> None:
+        self.traces += 1
+        _HANDLER_LATENCY.labels(handler=root.name).observe(root.duration)
+        if root.duration < self.slow_threshold:
+            return
+        self.slow += 1
+        entry = {"ts": round(time.time(), 3), "trace_id": root.trace_id, **root.to_dict()}
+        self.recent_slow.append(entry)
+        if self.path:
+            self._append(entry)
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        """Queue ``entry`` for the writer thread; never touches the disk on the caller."""
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, name="slow-trace-writer", daemon=True)
+                self._writer.start()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self) -> None:
+        while True:
+            lines = [self._queue.get()]
+            # 一次寫完已排隊的所有紀錄，減少開檔次數
+            while lines[-1] is not None:
+                try:
+                    lines.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = lines[-1] is None
+            try:
+                self._write([line for line in lines if line is not None])
+            finally:
+                for _ in lines:
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _write(self, lines: List[str]) -> None:
+        if not lines:
+            return
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+        except OSError as exc:
+            logger.warning("寫入慢 trace 失敗: %s", exc)
+
+    def flush(self) -> None:
+        """Block until every queued slow trace is on disk."""
+        self._queue.join()
+
+    def close(self, timeout: Optional[float] = 5.0) -> None:
+        """Write what is queued and stop the writer thread."""
+        with self._lock:
+            writer = self._writer
+            if writer is None or not writer.is_alive():
+                return
+            self._queue.put(None)
+            self._writer = None
+        writer.join(timeout)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Per-handler count, p50 and p99 in seconds, slowest p99 first."""
+        rows = []
+        for name in self._handlers:
+            child = _HANDLER_LATENCY.labels(handler=name)
+            if child.count:
+                rows.append({
+                    "handler": name,
+                    "count": child.count,
+                    "p50": child.percentile(0.5),
+                    "p99": child.percentile(0.99),
+                })
+        return sorted(rows, key=lambda row: row["p99"], reverse=True)
+
+
+def instrument_handlers(application, tracer: Tracer) -> int:
+    """Wrap the callback of every handler registered on ``application``; returns how many."""
+    wrapped = 0
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            callback = handler.callback
+            if getattr(callback, "traced", False):
+                continue
+            handler.callback = tracer.wrap(getattr(callback, "__name__", type(handler).__name__), callback)
+            wrapped += 1
+    return wrapped
@@ -0,0 +1,157 @@
+"""Pooled asynchronous Cloudflare Turnstile siteverify client.
+
+One ``httpx.AsyncClient`` (already installed with python-telegram-bot) keeps
+connections to the siteverify endpoint alive across submissions. A semaphore
+bounds in-flight checks, and a small circuit breaker stops calling Cloudflare
+for a cooldown after consecutive failures or slow replies. While it is open,
+submissions fail closed immediately instead of each waiting out a timeout.
+Latencies of recent calls are kept for the health endpoint.
+
+The endpoint can be pointed elsewhere with ``CF_TURNSTILE_VERIFY_URL``, e.g.
+at ``fake_siteverify.py`` for offline load tests.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+import os
+import time
+from typing import Any, Deque, Dict, Optional
+
+import httpx
+
+TURNSTILE_VERIFY_URL = "https://challenges.cloudflare.com/turnstile/v0/siteverify"
+MAX_CONCURRENCY = 32
+REQUEST_TIMEOUT = 5.0
+SLOW_THRESHOLD = 3.0
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+LATENCY_SAMPLES = 512
+logger = logging.getLogger(__name__)
+
+
+class TurnstileClient:
+    def __init__(
+        self,
+        secret: str,
+        endpoint: Optional[str] = None,
+        max_concurrency: int = MAX_CONCURRENCY,
+        timeout: float = REQUEST_TIMEOUT,
+        slow_threshold: float = SLOW_THRESHOLD,
+        breaker_threshold: int = BREAKER_THRESHOLD,
+        breaker_cooldown: float = BREAKER_COOLDOWN,
+    ):
+        self.secret = secret
+        self.endpoint = endpoint or os.getenv("CF_TURNSTILE_VERIFY_URL", TURNSTILE_VERIFY_URL)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.slow_threshold = slow_threshold
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._latencies: Deque[float] = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.counters = {"requests": 0, "passed": 0, "rejected": 0, "errors": 0, "slow": 0, "short_circuited": 0}
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    @property
+    def breaker_state(self) -> str:
+        if self._open_until and time.monotonic() < self._open_until:
+            return "open"
+        return "half_open" if self._open_until else "closed"
+
+    def _allow(self) -> bool:
+        state = self.breaker_state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            # 冷卻結束後只放一個請求試探
+            self._probing = True
+            return True
+        return False
+
+    def _record(self, ok: bool, latency: float) -> None:
+        self._latencies.append(latency)
+        if latency > self.slow_threshold:
+            self.counters["slow"] += 1
+            ok = False
+        if ok:
+            self._failures = 0
+            self._open_until = 0.0
+        else:
+            self._failures += 1
+            if self._probing or self._failures >= self.breaker_threshold:
+                self._open_until = time.monotonic() + self.breaker_cooldown
+                logger.warning("Turnstile 驗證服務異常，暫停呼叫 %.0f 秒", self.breaker_cooldown)
+        self._probing = False
+
+    async def verify(self, token: str, remote_ip: Optional[str] = None) -> bool:
+        """Return True only when siteverify accepts ``token``; failures and open breaker return False."""
+        if not self.secret or not token:
+            return False
+        if not self._allow():
+            self.counters["short_circuited"] += 1
+            return False
+        # _allow 剛放行的半開試探
+        probe = self._probing
+        client = self._http()
+        data = {"secret": self.secret, "response": token}
+        if remote_ip:
+            data["remoteip"] = remote_ip
+        self.counters["requests"] += 1
+        try:
+            async with self._semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(self.endpoint, data=data)
+                    result = response.json()
+                except Exception as exc:
+                    self.counters["errors"] += 1
+                    self._record(False, time.perf_counter() - started)
+                    logger.warning("Turnstile validation request failed: %s", type(exc).__name__)
+                    return False
+                # 能拿到回應就代表服務正常，token 不通過不算服務失敗
+                self._record(True, time.perf_counter() - started)
+        finally:
+            if probe:
+                # 試探被取消（訪客斷線、CancelledError）時 _record 沒跑到，不重置的話斷路器永遠不會再關
+                self._probing = False
+        if not result.get("success"):
+            self.counters["rejected"] += 1
+            logger.warning("Turnstile validation failed: %s", result.get("error-codes", []))
+            return False
+        self.counters["passed"] += 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        samples = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 1) if samples else 0.0
+
+        return {
+            **self.counters,
+            "breaker": self.breaker_state,
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "max": percentile(1.0)},
+        }
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
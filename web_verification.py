@@ -1,15 +1,21 @@
 """Web verification flow: numeric image CAPTCHA + Cloudflare Turnstile.
 
-The server is intentionally small and dependency-free. It runs beside the
-Telegram polling loop and hands successful challenges back to that loop.
+The server is intentionally small and dependency-free. It runs on the
+Telegram polling loop itself and awaits the bot's callbacks directly.
 """
 
 from __future__ import annotations
 
+import asyncio
+import collections
+import functools
+import gzip
 import hashlib
+import heapq
 import html
 import hmac
 import io
+import ipaddress
 import json
 import logging
 import os
@@ -17,18 +23,40 @@ import secrets
 import threading
 import time
 import urllib.parse
-import urllib.request
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from typing import Any, Awaitable, Callable, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 from PIL import Image, ImageDraw, ImageFont
 
+try:
+    import brotli
+except ImportError:
+    # 未安裝 brotli 時只提供 gzip
+    brotli = None
+
+import metrics
+from captcha_pool import CaptchaPool, RenderExecutor
+from turnstile import TurnstileClient
+
 
-TURNSTILE_VERIFY_URL = "https://challenges.cloudflare.com/turnstile/v0/siteverify"
 SESSION_TTL = 300
 MAX_ATTEMPTS = 5
 TELEGRAM_AUTH_TTL = 86400
+ADMIN_SESSION_TTL = 900
+WEB_SESSIONS_NAMESPACE = "web_sessions"
+CAPTCHA_PATH_SUFFIX = "/captcha.png"
+MAX_CONNECTIONS = int(os.getenv("WEB_VERIFY_MAX_CONNECTIONS", "256"))
+OVERLOAD_RETRY_AFTER = 2
+KEEPALIVE_TIMEOUT = 15.0
+CALLBACK_TIMEOUT = 15.0
+MAX_HEADER_BYTES = 16384
+MAX_BODY_BYTES = {"/api/admin": 50000, "*": 10000}
+_PAGE_TOKEN = "\x00token\x00"
+_PAGE_ERROR = "\x00error\x00"
+MAX_SESSIONS = 20000
+MAX_SESSIONS_PER_USER = 3
+MAX_MISSING_TOKENS = 4096
+PROXY_HEADERS = ("cf-connecting-ip", "x-forwarded-for", "x-real-ip", "forwarded")
 logger = logging.getLogger(__name__)
 
 
@@ -44,6 +72,7 @@ def is_configured() -> bool:
     )
 
 
+@functools.lru_cache(maxsize=None)
 def _font(size: int):
     for path in (
         "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
@@ -82,200 +111,642 @@ def _hash(value: str) -> str:
     return hashlib.sha256(value.encode("utf-8")).hexdigest()
 
 
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match check; weak validators compare equal for GET revalidation."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def _new_answer() -> str:
+    return "".join(str(secrets.randbelow(10)) for _ in range(6))
+
+
+def _render_challenge() -> Tuple[str, bytes]:
+    answer = _new_answer()
+    return answer, _captcha_image(answer)
+
+
+class SessionStore:
+    """Token-indexed verification sessions, optionally mirrored to the state store.
+
+    Lookups hit the in-memory index first and fall back to a primary-key read
+    from the store, so after a restart existing links keep working without
+    loading every session up front. Records are replaced rather than mutated,
+    so a record handed to a request thread is a stable snapshot and readers
+    never copy under the lock.
+
+    Memory is bounded: a min-heap on ``created_at + ttl`` drives expiry, used
+    sessions are dropped at once, the index never holds more than
+    ``max_sessions`` entries (oldest evicted first) and each user keeps at
+    most ``max_per_user`` live sessions.
+
+    Challenge images come from a pre-rendered pool and are kept next to the
+    index, so serving a session's image is a dictionary lookup. Creating a
+    session never renders: on a pool miss only the answer is drawn and the
+    image is rendered on first request.
+    """
+
+    def __init__(
+        self,
+        store=None,
+        namespace: str = WEB_SESSIONS_NAMESPACE,
+        ttl: float = SESSION_TTL,
+        max_sessions: int = MAX_SESSIONS,
+        max_per_user: int = MAX_SESSIONS_PER_USER,
+        pool: Optional[CaptchaPool] = None,
+    ):
+        self.store = store
+        self.pool = pool
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_per_user = max_per_user
+        self._index: Dict[str, dict] = {}
+        self._images: Dict[str, bytes] = {}
+        # (到期時間, token)；session 被移除後留下的舊項目在彈出時略過
+        self._expiry: List[Tuple[float, str]] = []
+        self._by_user: Dict[int, List[str]] = {}
+        # 狀態庫裡查無（或已用過）的 token，避免亂送的 token 每次都打到 SQLite
+        self._missing: "collections.OrderedDict[str, None]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"created": 0, "expired": 0, "evicted": 0, "evicted_per_user": 0, "completed": 0, "invalidated": 0}
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __getitem__(self, token: str) -> dict:
+        record = self._lookup(token)
+        if record is None:
+            raise KeyError(token)
+        return record
+
+    def __contains__(self, token: str) -> bool:
+        return self._lookup(token) is not None
+
+    def _challenge(self) -> Tuple[str, Optional[bytes]]:
+        # 沒有預產生池或池已用完時只出答案，圖片等第一次被請求才由 render_executor 畫
+        challenge = self.pool.take_ready() if self.pool is not None else None
+        return challenge if challenge is not None else (_new_answer(), None)
+
+    def create(self, user_id: int, chat_id: int) -> str:
+        token = secrets.token_urlsafe(32)
+        answer, image = self._challenge()
+        record = {
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "answer": _hash(answer),
+            "captcha": answer,
+            "created_at": time.time(),
+            "attempts": 0,
+            "used": False,
+        }
+        with self._lock:
+            self._sweep_locked(record["created_at"])
+            tokens = self._by_user.get(user_id, [])
+            while len(tokens) >= self.max_per_user:
+                self._drop_locked(tokens[0], "evicted_per_user")
+            self._track_locked(token, record)
+            if image is not None:
+                self._images[token] = image
+            while len(self._index) > self.max_sessions and self._expiry:
+                expires_at, oldest = heapq.heappop(self._expiry)
+                if self._is_current(oldest, expires_at):
+                    self._drop_locked(oldest, "evicted")
+            self.counters["created"] += 1
+        self._persist(token, record)
+        return token
+
+    def _is_current(self, token: str, expires_at: float) -> bool:
+        record = self._index.get(token)
+        return record is not None and record["created_at"] + self.ttl == expires_at
+
+    def _track_locked(self, token: str, record: dict) -> None:
+        self._index[token] = record
+        heapq.heappush(self._expiry, (record["created_at"] + self.ttl, token))
+        self._by_user.setdefault(record["user_id"], []).append(token)
+
+    def _drop_locked(self, token: str, reason: str) -> None:
+        record = self._index.pop(token, None)
+        self._images.pop(token, None)
+        if record is None:
+            return
+        tokens = self._by_user.get(record["user_id"])
+        if tokens:
+            try:
+                tokens.remove(token)
+            except ValueError:
+                pass
+            if not tokens:
+                del self._by_user[record["user_id"]]
+        self.counters[reason] += 1
+        if self.store is not None:
+            self.store.delete(self.namespace, token)
+
+    def _sweep_locked(self, now: float) -> None:
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, token = heapq.heappop(self._expiry)
+            if self._is_current(token, expires_at):
+                self._drop_locked(token, "expired")
+
+    def sweep(self, now: Optional[float] = None) -> None:
+        """Drop every session whose TTL has passed."""
+        with self._lock:
+            self._sweep_locked(time.time() if now is None else now)
+
+    def stats(self) -> Dict[str, int]:
+        self.sweep()
+        with self._lock:
+            return {"live": len(self._index), "users": len(self._by_user), **self.counters}
+
+    def _lookup(self, token: str) -> Optional[dict]:
+        record = self._index.get(token)
+        if record is None and self.store is not None and token and token not in self._missing:
+            # 重啟後第一次存取：按主鍵從狀態庫取回單筆
+            stored = self.store.get(self.namespace, token)
+            with self._lock:
+                if stored is not None and not stored.get("used"):
+                    record = self._index.get(token)
+                    if record is None:
+                        record = stored
+                        self._track_locked(token, record)
+                else:
+                    self._missing[token] = None
+                    if len(self._missing) > MAX_MISSING_TOKENS:
+                        self._missing.popitem(last=False)
+        return record
+
+    def needs_store(self, token: str) -> bool:
+        """Whether looking ``token`` up would read the state store (not in memory, not known missing)."""
+        return (
+            self.store is not None and bool(token)
+            and token not in self._index and token not in self._missing
+        )
+
+    def _persist(self, token: str, record: dict) -> None:
+        if self.store is not None:
+            self.store.put(self.namespace, token, record, record["created_at"] + self.ttl)
+
+    def get(self, token: str) -> Optional[dict]:
+        """Return the live (unused, unexpired) session for ``token``."""
+        record = self._lookup(token)
+        if not record or record["used"] or time.time() - record["created_at"] > self.ttl:
+            return None
+        return record
+
+    def _replace(self, token: str, **changes) -> Optional[dict]:
+        if self._lookup(token) is None:
+            return None
+        with self._lock:
+            current = self._index.get(token)
+            if current is None:
+                return None
+            record = {**current, **changes}
+            self._index[token] = record
+        self._persist(token, record)
+        return record
+
+    def add_attempt(self, token: str) -> Optional[int]:
+        """Count one submission; returns the new total, or None if the session is gone or used."""
+        if self._lookup(token) is None:
+            return None
+        with self._lock:
+            current = self._index.get(token)
+            if current is None or current["used"]:
+                return None
+            record = {**current, "attempts": current["attempts"] + 1}
+            self._index[token] = record
+        self._persist(token, record)
+        return record["attempts"]
+
+    def claim(self, token: str) -> bool:
+        """Consume the session; True only for the caller that removed it."""
+        if self._lookup(token) is None:
+            return False
+        with self._lock:
+            current = self._index.get(token)
+            if current is None or current["used"]:
+                return False
+            self._drop_locked(token, "completed")
+        return True
+
+    def invalidate(self, token: str) -> None:
+        if self._lookup(token) is None:
+            return
+        with self._lock:
+            self._drop_locked(token, "invalidated")
+
+    def cached(self, token: str) -> Optional[dict]:
+        """In-memory record for ``token``, without touching the state store."""
+        return self._index.get(token)
+
+    def cached_image(self, token: str) -> Optional[bytes]:
+        """Image already held for ``token``; None means ``image`` would have to read or render."""
+        return self._images.get(token)
+
+    def image(self, token: str) -> Optional[bytes]:
+        """PNG bytes of the session's current challenge."""
+        image = self._images.get(token)
+        if image is None:
+            record = self.get(token)
+            if record is None:
+                return None
+            # 重啟後或沒有預產生池時：依保存的答案畫一次
+            image = _captcha_image(record["captcha"])
+            with self._lock:
+                if token in self._index:
+                    self._images.setdefault(token, image)
+        return image
+
+    def rotate_captcha(self, token: str) -> Optional[bytes]:
+        """Swap in a fresh challenge; returns its image."""
+        answer, image = self._challenge()
+        if self._lookup(token) is None:
+            return None
+        with self._lock:
+            current = self._index.get(token)
+            if current is None:
+                return None
+            # 答案與圖片一起換，避免並行換題時兩者對不上
+            record = {**current, "captcha": answer, "answer": _hash(answer)}
+            self._index[token] = record
+            self._images.pop(token, None)
+            if image is not None:
+                self._images[token] = image
+        self._persist(token, record)
+        return self.image(token)
+
+
+class _Request:
+    __slots__ = ("method", "path", "version", "headers", "body", "peer")
+
+    def __init__(self, method: str, path: str, version: str, headers: Dict[str, str], body: bytes = b""):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+        # 連線對端 IP，由 _serve_connection 填入
+        self.peer = ""
+
+    def form(self) -> Dict[str, List[str]]:
+        return urllib.parse.parse_qs(self.body.decode("utf-8", "replace"))
+
+    @property
+    def is_local(self) -> bool:
+        """Sent straight from this host: loopback peer and no proxy forwarding headers."""
+        # Cloudflare Tunnel 等反向代理也從本機連進來，帶轉發標頭的一律視為外部請求
+        if any(name in self.headers for name in PROXY_HEADERS):
+            return False
+        try:
+            return ipaddress.ip_address(self.peer).is_loopback
+        except ValueError:
+            return False
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+
+class _HTTPError(Exception):
+    def __init__(self, status: HTTPStatus):
+        super().__init__(status.phrase)
+        self.status = status
+
+
+Response = Tuple[HTTPStatus, str, bytes, Dict[str, str]]
+
+
+def _response(status: HTTPStatus, content_type: str, body, headers: Optional[Dict[str, str]] = None) -> Response:
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return status, content_type, body, headers or {"Cache-Control": "no-store"}
+
+
+def _json_response(status: HTTPStatus, data: Any) -> Response:
+    return _response(status, "application/json; charset=utf-8", json.dumps(data, ensure_ascii=False))
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[_Request]:
+    """Read one HTTP/1.x request; None when the client closed an idle connection."""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as exc:
+        if not exc.partial.strip():
+            return None
+        raise _HTTPError(HTTPStatus.BAD_REQUEST)
+    except asyncio.LimitOverrunError:
+        raise _HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ", 2)
+    except ValueError:
+        raise _HTTPError(HTTPStatus.BAD_REQUEST)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    path = urllib.parse.urlparse(target).path
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise _HTTPError(HTTPStatus.BAD_REQUEST)
+    if length > MAX_BODY_BYTES.get(path, MAX_BODY_BYTES["*"]):
+        raise _HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(length) if length > 0 else b""
+    return _Request(method.upper(), path, version, headers, body)
+
+
+def _log_late_failure(task: asyncio.Future) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Callback failed after the response timed out: %s", type(task.exception()).__name__)
+
+
 class WebVerificationServer:
+    """Verification pages and the admin API, served on the bot's own event loop.
+
+    Connections are HTTP/1.1 keep-alive. Past ``max_connections`` open
+    connections, new ones get ``503`` with ``Retry-After`` and are closed.
+    Bot-side callbacks are awaited directly.
+    """
+
     def __init__(
         self,
-        loop,
         on_success: Callable[[str, int], Awaitable[None]],
         admin_callback: Optional[Callable[[int, str, dict], Awaitable[dict]]] = None,
         host: str = "0.0.0.0",
         port: Optional[int] = None,
+        store=None,
+        max_connections: int = MAX_CONNECTIONS,
     ):
-        self.loop = loop
         self.on_success = on_success
         self.admin_callback = admin_callback
         self.host = host
-        self.port = port or int(os.getenv("WEB_VERIFY_PORT", "8080"))
+        self.port = port if port is not None else int(os.getenv("WEB_VERIFY_PORT", "8080"))
         self.base_url = os.getenv("WEB_VERIFY_BASE_URL", "").rstrip("/")
         self.site_key = os.getenv("CF_TURNSTILE_SITE_KEY", "")
         self.secret_key = os.getenv("CF_TURNSTILE_SECRET_KEY", "")
+        self.turnstile = TurnstileClient(self.secret_key)
         self.bot_username = os.getenv("TELEGRAM_BOT_USERNAME", "").lstrip("@")
         self.bot_token = os.getenv("BOT_TOKEN", "")
-        self.sessions = {}
-        self.lock = threading.Lock()
-        self.httpd = None
-        self.thread = None
+        # 設定後 /metrics 需帶 Authorization: Bearer <token>；未設定時只回應本機直連的請求
+        self.metrics_token = os.getenv("METRICS_TOKEN", "")
+        self.max_connections = max_connections
+        self.captchas = CaptchaPool(_render_challenge, name="web-captcha-pool")
+        # 快取沒命中時的狀態庫讀取與重畫、換題都在這裡跑，不佔用事件迴圈
+        self.render_executor = RenderExecutor(name="web-captcha-render")
+        self.sessions = SessionStore(store, pool=self.captchas)
+        self.page = _PageTemplate(self.site_key)
+        # 靜態頁面外殼只在啟動時建一次；只有驗證頁依 session 動態產生
+        self.static_pages = {"/miniapp": _StaticPage(_miniapp_page()), "/admin": _StaticPage(_admin_page())}
+        self.admin_tokens = AdminSessionTokens()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: set = set()
+        # 逾時後仍在背景跑完的 Bot 回呼；保留參照以免任務被回收
+        self._callbacks: set = set()
+        self.counters = {"connections": 0, "rejected": 0, "requests": 0}
 
     def create_session(self, user_id: int, chat_id: int) -> str:
-        token = secrets.token_urlsafe(32)
-        answer = "".join(str(secrets.randbelow(10)) for _ in range(6))
-        with self.lock:
-            self.sessions[token] = {
-                "user_id": user_id,
-                "chat_id": chat_id,
-                "answer": _hash(answer),
-                "captcha": answer,
-                "created_at": time.time(),
-                "attempts": 0,
-                "used": False,
-            }
-        return token
+        return self.sessions.create(user_id, chat_id)
 
-    def start(self):
-        server = self
-
-        class Handler(BaseHTTPRequestHandler):
-            def log_message(self, format, *args):
-                return
-
-            def _send(self, status, content_type, body):
-                if isinstance(body, str):
-                    body = body.encode("utf-8")
-                self.send_response(status)
-                self.send_header("Content-Type", content_type)
-                self.send_header("Content-Length", str(len(body)))
-                self.send_header("Cache-Control", "no-store")
-                self.end_headers()
-                self.wfile.write(body)
-
-            def _json(self, status, data):
-                self._send(status, "application/json; charset=utf-8", json.dumps(data, ensure_ascii=False))
-
-            def _session(self, token):
-                with server.lock:
-                    session = server.sessions.get(token)
-                    if not session or session["used"] or time.time() - session["created_at"] > SESSION_TTL:
-                        return None
-                    return dict(session)
-
-            def _invalidate(self, token):
-                with server.lock:
-                    session = server.sessions.get(token)
-                    if session:
-                        session["used"] = True
-
-            def _rotate_captcha(self, token):
-                answer = "".join(str(secrets.randbelow(10)) for _ in range(6))
-                with server.lock:
-                    session = server.sessions.get(token)
-                    if session:
-                        session["captcha"] = answer
-                        session["answer"] = _hash(answer)
-                return answer
-
-            def do_GET(self):
-                path = urllib.parse.urlparse(self.path).path
-                if path == "/healthz":
-                    self._send(HTTPStatus.OK, "text/plain; charset=utf-8", "ok")
-                    return
-                if path == "/miniapp":
-                    self._send(HTTPStatus.OK, "text/html; charset=utf-8", _miniapp_page())
-                    return
-                if path == "/admin":
-                    self._send(HTTPStatus.OK, "text/html; charset=utf-8", _admin_page())
-                    return
-                prefix = "/verify/"
-                if path.startswith(prefix):
-                    token = path[len(prefix):]
-                    session = self._session(token)
-                    if not session:
-                        self._send(HTTPStatus.GONE, "text/html; charset=utf-8", "驗證連結已失效。")
-                        return
-                    body = _page(token, server.site_key, session["captcha"], server.bot_username)
-                    self._send(HTTPStatus.OK, "text/html; charset=utf-8", body)
-                    return
-                self._send(HTTPStatus.NOT_FOUND, "text/plain; charset=utf-8", "Not found")
-
-            def do_POST(self):
-                path = urllib.parse.urlparse(self.path).path
-                if path == "/api/admin":
-                    if not server.admin_callback:
-                        self._json(HTTPStatus.NOT_FOUND, {"error": "管理面板未啟用"})
-                        return
-                    length = min(int(self.headers.get("Content-Length", "0")), 50000)
-                    raw = self.rfile.read(length)
-                    form = urllib.parse.parse_qs(raw.decode("utf-8", "replace"))
-                    init_data = form.get("init_data", [""])[0]
-                    user_id = _telegram_webapp_user_id(server.bot_token, init_data)
-                    if not user_id:
-                        self._json(HTTPStatus.FORBIDDEN, {"error": "Telegram 身份驗證失敗"})
-                        return
-                    try:
-                        payload = json.loads(form.get("payload", ["{}"]) [0])
-                    except (TypeError, json.JSONDecodeError):
-                        payload = {}
-                    action = form.get("action", [""])[0]
-                    future = __import__("asyncio").run_coroutine_threadsafe(
-                        server.admin_callback(user_id, action, payload), server.loop
-                    )
-                    try:
-                        self._json(HTTPStatus.OK, future.result(timeout=15))
-                    except PermissionError as exc:
-                        self._json(HTTPStatus.FORBIDDEN, {"error": str(exc)})
-                    except ValueError as exc:
-                        self._json(HTTPStatus.BAD_REQUEST, {"error": str(exc)})
-                    except Exception as exc:
-                        logger.exception("Admin API failed: %s", type(exc).__name__)
-                        self._json(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "管理操作失敗"})
-                    return
-                prefix = "/verify/"
-                if not path.startswith(prefix):
-                    self._send(HTTPStatus.NOT_FOUND, "text/plain; charset=utf-8", "Not found")
-                    return
-                token = path[len(prefix):]
-                session = self._session(token)
-                if not session:
-                    self._send(HTTPStatus.GONE, "text/html; charset=utf-8", "驗證連結已失效。")
-                    return
-                length = min(int(self.headers.get("Content-Length", "0")), 10000)
-                raw = self.rfile.read(length)
-                form = urllib.parse.parse_qs(raw.decode("utf-8", "replace"))
-                answer = form.get("captcha", [""])[0].strip()
-                turnstile = form.get("cf-turnstile-response", [""])[0]
-                telegram_init_data = form.get("tg_init_data", [""])[0]
-                with server.lock:
-                    current = server.sessions.get(token)
-                    if not current or current["used"]:
-                        self._send(HTTPStatus.GONE, "text/html; charset=utf-8", "驗證連結已失效。")
-                        return
-                    current["attempts"] += 1
-                    attempts = current["attempts"]
-                captcha_matches = hmac.compare_digest(_hash(answer), session["answer"])
-                if attempts > MAX_ATTEMPTS:
-                    self._invalidate(token)
-                    self._send(HTTPStatus.GONE, "text/html; charset=utf-8", "驗證嘗試次數已用完，請回 Telegram 重新取得驗證連結。")
-                    return
-                if not captcha_matches:
-                    new_captcha = self._rotate_captcha(token)
-                    self._send(HTTPStatus.BAD_REQUEST, "text/html; charset=utf-8", _page(token, server.site_key, new_captcha, server.bot_username, "數字驗證碼錯誤，已換發新的驗證碼。"))
-                    return
-                if not _verify_telegram_webapp(server.bot_token, telegram_init_data, session["user_id"]):
-                    new_captcha = self._rotate_captcha(token)
-                    self._send(HTTPStatus.BAD_REQUEST, "text/html; charset=utf-8", _page(token, server.site_key, new_captcha, server.bot_username, "Telegram 帳號不符或登入已失效，已換發新的驗證碼。"))
-                    return
-                if not _verify_turnstile(server.secret_key, turnstile):
-                    new_captcha = self._rotate_captcha(token)
-                    self._send(HTTPStatus.BAD_REQUEST, "text/html; charset=utf-8", _page(token, server.site_key, new_captcha, server.bot_username, "Cloudflare 驗證未通過，已換發新的驗證碼。"))
-                    return
-                with server.lock:
-                    current = server.sessions.get(token)
-                    if not current or current["used"]:
-                        self._send(HTTPStatus.GONE, "text/html; charset=utf-8", "驗證已完成或失效。")
-                        return
-                    current["used"] = True
-                future = __import__("asyncio").run_coroutine_threadsafe(
-                    server.on_success(token, session["user_id"]), server.loop
-                )
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._serve_connection, self.host, self.port, limit=MAX_HEADER_BYTES
+        )
+        # port=0 時取回系統分配的埠
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._callbacks:
+            await asyncio.wait(list(self._callbacks), timeout=CALLBACK_TIMEOUT)
+        self.captchas.stop()
+        self.render_executor.shutdown()
+        await self.turnstile.aclose()
+
+    async def _run_callback(self, coro: Awaitable[Any]) -> Any:
+        """Await a bot callback for at most ``CALLBACK_TIMEOUT``; on timeout it keeps running.
+
+        Only the HTTP response gives up: cancelling the callback could leave a
+        user muted halfway through an unmute whose token is already used.
+        """
+        task = asyncio.ensure_future(coro)
+        self._callbacks.add(task)
+        task.add_done_callback(self._callbacks.discard)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), CALLBACK_TIMEOUT)
+        except asyncio.TimeoutError:
+            task.add_done_callback(_log_late_failure)
+            raise
+
+    def stats(self) -> Dict[str, int]:
+        return {"open": len(self._connections), "max": self.max_connections, **self.counters}
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if len(self._connections) >= self.max_connections:
+            self.counters["rejected"] += 1
+            await self._write(
+                writer,
+                _response(HTTPStatus.SERVICE_UNAVAILABLE, "text/plain; charset=utf-8", "busy",
+                          {"Cache-Control": "no-store", "Retry-After": str(OVERLOAD_RETRY_AFTER)}),
+                keep_alive=False,
+            )
+            writer.close()
+            return
+        self._connections.add(writer)
+        self.counters["connections"] += 1
+        peername = writer.get_extra_info("peername")
+        peer = peername[0] if isinstance(peername, tuple) else ""
+        try:
+            while True:
                 try:
-                    future.result(timeout=15)
-                except Exception:
-                    self._send(HTTPStatus.INTERNAL_SERVER_ERROR, "text/html; charset=utf-8", "驗證完成，但 Bot 尚未完成解除限制，請聯絡管理員。")
-                    return
-                self._send(HTTPStatus.OK, "text/html; charset=utf-8", "<h2>驗證成功</h2><p>你可以回到 Telegram 群組了。</p>")
-
-        self.httpd = ThreadingHTTPServer((self.host, self.port), Handler)
-        self.thread = threading.Thread(target=self.httpd.serve_forever, name="web-verification", daemon=True)
-        self.thread.start()
+                    request = await asyncio.wait_for(_read_request(reader), timeout=KEEPALIVE_TIMEOUT)
+                except _HTTPError as exc:
+                    await self._write(writer, _response(exc.status, "text/plain; charset=utf-8", exc.status.phrase), False)
+                    break
+                if request is None:
+                    break
+                request.peer = peer
+                self.counters["requests"] += 1
+                try:
+                    response = await self._dispatch(request)
+                except Exception as exc:
+                    logger.exception("Web request failed: %s", type(exc).__name__)
+                    response = _response(HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain; charset=utf-8", "error")
+                await self._write(writer, response, request.keep_alive)
+                if not request.keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _write(self, writer: asyncio.StreamWriter, response: Response, keep_alive: bool):
+        status, content_type, body, headers = response
+        lines = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def _dispatch(self, request: _Request) -> Response:
+        if request.method == "GET":
+            return await self._get(request)
+        if request.method == "POST":
+            if request.path == "/api/admin":
+                return await self._admin_api(request)
+            return await self._submit(request)
+        return _response(HTTPStatus.METHOD_NOT_ALLOWED, "text/plain; charset=utf-8", "Method not allowed")
+
+    async def _session(self, token: str) -> Optional[dict]:
+        """Live session for ``token``; a miss in memory reads the state store on a worker thread."""
+        if self.sessions.needs_store(token):
+            return await asyncio.to_thread(self.sessions.get, token)
+        return self.sessions.get(token)
+
+    async def _rotate(self, token: str) -> None:
+        # 預產生池用完時換題要當場畫圖
+        await self.render_executor.run(self.sessions.rotate_captcha, token)
+
+    async def _get(self, request: _Request) -> Response:
+        path = request.path
+        if path == "/healthz":
+            return _json_response(HTTPStatus.OK, {
+                "status": "ok", "sessions": self.sessions.stats(), "connections": self.stats(),
+                "turnstile": self.turnstile.stats(),
+            })
+        if path == "/metrics":
+            return self._metrics(request)
+        static = self.static_pages.get(path)
+        if static is not None:
+            return static.respond(request)
+        prefix = "/verify/"
+        if path.startswith(prefix) and path.endswith(CAPTCHA_PATH_SUFFIX):
+            return await self._captcha(request, path[len(prefix):-len(CAPTCHA_PATH_SUFFIX)])
+        if path.startswith(prefix):
+            token = path[len(prefix):]
+            if not await self._session(token):
+                return _response(HTTPStatus.GONE, "text/html; charset=utf-8", "驗證連結已失效。")
+            return _response(HTTPStatus.OK, "text/html; charset=utf-8", self.page.render(token))
+        return _response(HTTPStatus.NOT_FOUND, "text/plain; charset=utf-8", "Not found")
+
+    def _metrics(self, request: _Request) -> Response:
+        if self.metrics_token:
+            supplied = request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+            if not hmac.compare_digest(supplied.encode(), self.metrics_token.encode()):
+                return _response(HTTPStatus.UNAUTHORIZED, "text/plain; charset=utf-8", "unauthorized")
+        elif not request.is_local:
+            return _response(HTTPStatus.FORBIDDEN, "text/plain; charset=utf-8", "set METRICS_TOKEN to scrape remotely")
+        return _response(HTTPStatus.OK, "text/plain; version=0.0.4; charset=utf-8", metrics.render())
+
+    async def _captcha(self, request: _Request, token: str) -> Response:
+        image = self.sessions.cached_image(token)
+        if image is None:
+            # 重啟後或沒有預產生池：要查狀態庫並重畫
+            image = await self.render_executor.run(self.sessions.image, token)
+        if image is None:
+            return _response(HTTPStatus.GONE, "text/plain; charset=utf-8", "gone")
+        etag = _etag(image)
+        # 圖片會在答錯時換新：允許瀏覽器快取，但每次都要用 ETag 重新確認
+        headers = {"Cache-Control": "private, no-cache", "ETag": etag}
+        if _etag_matches(request.headers.get("if-none-match", ""), etag):
+            return _response(HTTPStatus.NOT_MODIFIED, "image/png", b"", headers)
+        return _response(HTTPStatus.OK, "image/png", image, headers)
+
+    async def _admin_api(self, request: _Request) -> Response:
+        if not self.admin_callback:
+            return _json_response(HTTPStatus.NOT_FOUND, {"error": "管理面板未啟用"})
+        form = request.form()
+        session = form.get("session", [""])[0]
+        issued = None
+        if session:
+            user_id = self.admin_tokens.verify(session)
+            if not user_id:
+                # 面板會用 initData 重新登入
+                return _json_response(HTTPStatus.UNAUTHORIZED, {"error": "登入已過期"})
+        else:
+            user_id = _telegram_webapp_user_id(self.bot_token, form.get("init_data", [""])[0])
+            if not user_id:
+                return _json_response(HTTPStatus.FORBIDDEN, {"error": "Telegram 身份驗證失敗"})
+            issued = self.admin_tokens.issue(user_id)
+        try:
+            payload = json.loads(form.get("payload", ["{}"])[0])
+        except (TypeError, json.JSONDecodeError):
+            payload = {}
+        action = form.get("action", [""])[0]
+        try:
+            result = await self._run_callback(self.admin_callback(user_id, action, payload))
+            if issued:
+                result = {**result, "session": issued}
+            return _json_response(HTTPStatus.OK, result)
+        except PermissionError as exc:
+            return _json_response(HTTPStatus.FORBIDDEN, {"error": str(exc)})
+        except ValueError as exc:
+            return _json_response(HTTPStatus.BAD_REQUEST, {"error": str(exc)})
+        except asyncio.TimeoutError:
+            return _json_response(HTTPStatus.GATEWAY_TIMEOUT, {"error": "操作仍在處理中，請稍後重新整理確認結果"})
+        except Exception as exc:
+            logger.exception("Admin API failed: %s", type(exc).__name__)
+            return _json_response(HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "管理操作失敗"})
+
+    async def _submit(self, request: _Request) -> Response:
+        prefix = "/verify/"
+        if not request.path.startswith(prefix):
+            return _response(HTTPStatus.NOT_FOUND, "text/plain; charset=utf-8", "Not found")
+        token = request.path[len(prefix):]
+        session = await self._session(token)
+        if not session:
+            return _response(HTTPStatus.GONE, "text/html; charset=utf-8", "驗證連結已失效。")
+        form = request.form()
+        answer = form.get("captcha", [""])[0].strip()
+        turnstile = form.get("cf-turnstile-response", [""])[0]
+        telegram_init_data = form.get("tg_init_data", [""])[0]
+        attempts = self.sessions.add_attempt(token)
+        if attempts is None:
+            return _response(HTTPStatus.GONE, "text/html; charset=utf-8", "驗證連結已失效。")
+        captcha_matches = hmac.compare_digest(_hash(answer), session["answer"])
+        if attempts > MAX_ATTEMPTS:
+            self.sessions.invalidate(token)
+            return _response(HTTPStatus.GONE, "text/html; charset=utf-8", "驗證嘗試次數已用完，請回 Telegram 重新取得驗證連結。")
+        if not captcha_matches:
+            await self._rotate(token)
+            return _response(HTTPStatus.BAD_REQUEST, "text/html; charset=utf-8", self.page.render(token, "數字驗證碼錯誤，已換發新的驗證碼。"))
+        if not _verify_telegram_webapp(self.bot_token, telegram_init_data, session["user_id"]):
+            await self._rotate(token)
+            return _response(HTTPStatus.BAD_REQUEST, "text/html; charset=utf-8", self.page.render(token, "Telegram 帳號不符或登入已失效，已換發新的驗證碼。"))
+        passed = await self.turnstile.verify(turnstile)
+        if not passed:
+            await self._rotate(token)
+            return _response(HTTPStatus.BAD_REQUEST, "text/html; charset=utf-8", self.page.render(token, "Cloudflare 驗證未通過，已換發新的驗證碼。"))
+        if not self.sessions.claim(token):
+            return _response(HTTPStatus.GONE, "text/html; charset=utf-8", "驗證已完成或失效。")
+        try:
+            await self._run_callback(self.on_success(token, session["user_id"]))
+        except asyncio.TimeoutError:
+            return _response(HTTPStatus.ACCEPTED, "text/html; charset=utf-8", "<h2>驗證成功</h2><p>Bot 正在解除限制，請稍候片刻再回到 Telegram 群組。</p>")
+        except Exception:
+            return _response(HTTPStatus.INTERNAL_SERVER_ERROR, "text/html; charset=utf-8", "驗證完成，但 Bot 尚未完成解除限制，請聯絡管理員。")
+        return _response(HTTPStatus.OK, "text/html; charset=utf-8", "<h2>驗證成功</h2><p>你可以回到 Telegram 群組了。</p>")
 
     def url(self, token: str) -> str:
         return (
@@ -286,39 +757,18 @@ class WebVerificationServer:
     def admin_url(self) -> str:
         return f"https://t.me/{urllib.parse.quote(self.bot_username, safe='')}?startapp=admin"
 
-    def stop(self):
-        if self.httpd:
-            self.httpd.shutdown()
-            self.httpd.server_close()
-
-
-def _verify_turnstile(secret: str, token: str) -> bool:
-    if not secret or not token:
-        return False
-    # Behind Cloudflare Tunnel, the socket peer is a proxy address, not the visitor.
-    payload = urllib.parse.urlencode({"secret": secret, "response": token}).encode("utf-8")
-    request = urllib.request.Request(
-        TURNSTILE_VERIFY_URL,
-        data=payload,
-        headers={"Content-Type": "application/x-www-form-urlencoded"},
-        method="POST",
-    )
-    try:
-        with urllib.request.urlopen(request, timeout=8) as response:
-            result = json.loads(response.read().decode("utf-8"))
-        if not result.get("success"):
-            logger.warning("Turnstile validation failed: %s", result.get("error-codes", []))
-        return bool(result.get("success"))
-    except Exception as exc:
-        logger.warning("Turnstile validation request failed: %s", type(exc).__name__)
-        return False
-
 
 def _verify_telegram_webapp(bot_token: str, init_data: str, expected_user_id: int) -> bool:
     """Verify Telegram Mini App initData and bind it to the challenged user."""
     return _telegram_webapp_user_id(bot_token, init_data) == int(expected_user_id)
 
 
+@functools.lru_cache(maxsize=8)
+def _webapp_secret(bot_token: str) -> bytes:
+    """WebAppData key for ``bot_token``; derived once instead of on every request."""
+    return hmac.new(b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256).digest()
+
+
 def _telegram_webapp_user_id(bot_token: str, init_data: str) -> Optional[int]:
     """Return the authenticated Mini App user ID, or None for invalid data."""
     if not bot_token or not init_data:
@@ -335,24 +785,107 @@ def _telegram_webapp_user_id(bot_token: str, init_data: str) -> Optional[int]:
     except (TypeError, ValueError, json.JSONDecodeError):
         return None
     data_check_string = "\n".join(f"{key}={fields[key]}" for key in sorted(fields))
-    secret_key = hmac.new(b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256).digest()
-    expected_hash = hmac.new(secret_key, data_check_string.encode("utf-8"), hashlib.sha256).hexdigest()
+    expected_hash = hmac.new(_webapp_secret(bot_token), data_check_string.encode("utf-8"), hashlib.sha256).hexdigest()
     return user_id if hmac.compare_digest(expected_hash, received_hash) else None
 
 
+class AdminSessionTokens:
+    """Short-lived signed tokens for the admin panel.
+
+    initData is verified once when the panel loads; later API calls present a
+    ``<user_id>.<expires>.<signature>`` token checked with one HMAC. The key is
+    random per process, so a restart only forces the panel to sign in again.
+    """
+
+    def __init__(self, ttl: float = ADMIN_SESSION_TTL, key: Optional[bytes] = None):
+        self.ttl = ttl
+        self._key = key or secrets.token_bytes(32)
+
+    def _sign(self, payload: str) -> str:
+        return hmac.new(self._key, payload.encode("ascii"), hashlib.sha256).hexdigest()
+
+    def issue(self, user_id: int, now: Optional[float] = None) -> str:
+        payload = f"{int(user_id)}.{int((now or time.time()) + self.ttl)}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token: str, now: Optional[float] = None) -> Optional[int]:
+        """Return the user ID for a valid, unexpired token, otherwise None."""
+        payload, _, signature = token.rpartition(".")
+        if not payload or not hmac.compare_digest(self._sign(payload), signature):
+            return None
+        user_id, _, expires = payload.partition(".")
+        try:
+            if int(expires) < (now or time.time()):
+                return None
+            return int(user_id)
+        except ValueError:
+            return None
+
+
 def _miniapp_page() -> str:
     return """<!doctype html><html lang="zh-Hant"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>Telegram</title></head><body><p>正在開啟…</p><script src="https://telegram.org/js/telegram-web-app.js"></script><script>if(window.Telegram&&Telegram.WebApp){Telegram.WebApp.ready();const param=Telegram.WebApp.initDataUnsafe&&Telegram.WebApp.initDataUnsafe.start_param;if(param&&param!=='admin'){location.replace('/verify/'+encodeURIComponent(param));}else{location.replace('/admin');}}else{document.body.innerHTML='<p>請從 Telegram 內開啟。</p>';}</script></body></html>"""
 
 
-def _admin_page() -> str:
-    return """<!doctype html><html lang="zh-Hant"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>群組管理</title><script src="https://telegram.org/js/telegram-web-app.js"></script><style>body{font-family:system-ui,sans-serif;background:#101827;color:#eef4ff;margin:0;padding:16px}main{max-width:720px;margin:auto}.card{background:#17243a;border-radius:14px;padding:16px;margin:12px 0}select,input,textarea,button{box-sizing:border-box;width:100%;padding:10px;border-radius:8px;border:1px solid #58708f;background:#0e1726;color:#fff;margin-top:8px}button{background:#4fa3ff;color:#07111f;font-weight:700;border:0}.feature{display:flex;align-items:center;justify-content:space-between;padding:10px 0;border-bottom:1px solid #30445f}.feature button{width:auto;margin:0;padding:7px 12px}.sample{display:flex;gap:8px;align-items:center;border-bottom:1px solid #30445f;padding:8px 0}.sample span{flex:1;white-space:pre-wrap;word-break:break-word}.sample button{width:auto;margin:0;background:#d85c6b;color:white}.muted{color:#a9bdd8}.error{color:#ff9a9a}</style></head><body><main><h1>群組管理</h1><p id="status" class="muted">正在載入…</p><section class="card"><h2>群組設定</h2><select id="groups"></select><div id="features"></div></section><section class="card"><h2>廣告樣本</h2><p class="muted">僅 Bot 擁有者可管理樣本。</p><textarea id="sample" rows="4" placeholder="輸入完整廣告樣本"></textarea><button onclick="addSample()">加入廣告樣本</button><div id="samples"></div></section></main><script>Telegram.WebApp.ready();Telegram.WebApp.expand();const initData=Telegram.WebApp.initData;let state={};async function api(action,payload={}){const body=new URLSearchParams({init_data:initData,action,payload:JSON.stringify(payload)});const r=await fetch('/api/admin',{method:'POST',headers:{'Content-Type':'application/x-www-form-urlencoded'},body});const d=await r.json();if(!r.ok)throw Error(d.error||'操作失敗');return d;}function esc(s){return String(s).replace(/[&<>"']/g,c=>({"&":"&amp;","<":"&lt;",">":"&gt;","\"":"&quot;","'":"&#39;"}[c]));}function showError(e){document.getElementById('status').textContent=e.message;document.getElementById('status').className='error';}async function load(){try{state=await api('bootstrap');document.getElementById('status').textContent='已登入，可管理你有權限的群組';const sel=document.getElementById('groups');sel.innerHTML=state.groups.map(g=>`<option value="${g.id}">${esc(g.title)}</option>`).join('');sel.onchange=renderFeatures;renderFeatures();renderSamples();}catch(e){showError(e);}}async function renderFeatures(){const id=document.getElementById('groups').value;const g=state.groups.find(x=>String(x.id)===String(id));document.getElementById('features').innerHTML=g?Object.entries(g.features).map(([k,v])=>`<div class="feature"><span>${esc(g.labels[k]||k)}</span><button onclick="toggle('${k}',${!v})">${v?'✅ 開啟':'⛔ 關閉'}</button></div>`).join(''):'沒有可管理的群組';}async function toggle(name,value){try{const id=Number(document.getElementById('groups').value);const d=await api('set_feature',{chat_id:id,feature:name,enabled:value});const g=state.groups.find(x=>x.id===id);g.features=d.features;renderFeatures();}catch(e){showError(e);}}function renderSamples(){document.getElementById('samples').innerHTML=(state.samples||[]).map((s,i)=>`<div class="sample"><span>${esc(s)}</span><button onclick="removeSample(${i})">刪除</button></div>`).join('')||'<p class="muted">尚無廣告樣本</p>';}async function addSample(){try{const text=document.getElementById('sample').value.trim();if(!text)return;state.samples=await api('add_sample',{text}).then(d=>d.samples);document.getElementById('sample').value='';renderSamples();}catch(e){showError(e);}}async function removeSample(index){try{state.samples=await api('remove_sample',{index}).then(d=>d.samples);renderSamples();}catch(e){showError(e);}}load();</script></body></html>"""
+def _accepted_encodings(header: str) -> set:
+    """Content codings the client accepts (q=0 entries excluded)."""
+    accepted = set()
+    for part in header.lower().split(","):
+        name, *params = [item.strip() for item in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if name and quality > 0:
+            accepted.add(name)
+    return accepted
+
+
+class _StaticPage:
+    """Static HTML shell encoded and compressed once, served with strong ETags."""
+
+    def __init__(self, text: str, content_type: str = "text/html; charset=utf-8"):
+        self.content_type = content_type
+        body = text.encode("utf-8")
+        tag = hashlib.blake2b(body, digest_size=12).hexdigest()
+        # 每種編碼是不同的表示，各自帶不同的強 ETag
+        self.variants: Dict[str, Tuple[bytes, str]] = {"identity": (body, f'"{tag}"')}
+        compressed = {"gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(body)
+        for coding, data in compressed.items():
+            if len(data) < len(body):
+                self.variants[coding] = (data, f'"{tag}-{coding}"')
+
+    def respond(self, request: _Request) -> Response:
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        coding = next((c for c in ("br", "gzip") if c in accepted and c in self.variants), "identity")
+        body, etag = self.variants[coding]
+        headers = {"Cache-Control": "no-cache", "ETag": etag, "Vary": "Accept-Encoding"}
+        if _etag_matches(request.headers.get("if-none-match", ""), etag):
+            return _response(HTTPStatus.NOT_MODIFIED, self.content_type, b"", headers)
+        if coding != "identity":
+            headers["Content-Encoding"] = coding
+        return _response(HTTPStatus.OK, self.content_type, body, headers)
+
+
+class _PageTemplate:
+    """Verification page built once per server; only the token and error vary."""
+
+    def __init__(self, site_key: str):
+        safe_key = html.escape(site_key, quote=True)
+        text = f"""<!doctype html><html lang="zh-Hant"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>Telegram 入群驗證</title><script src="https://telegram.org/js/telegram-web-app.js"></script><script src="https://challenges.cloudflare.com/turnstile/v0/api.js" async defer></script><style>body{{font-family:system-ui,sans-serif;background:#101827;color:#eef4ff;display:grid;place-items:center;min-height:100vh;margin:0}}main{{width:min(420px,calc(100% - 32px));background:#17243a;padding:28px;border-radius:16px;box-shadow:0 12px 40px #0005}}h1{{font-size:22px}}img{{display:block;width:240px;height:88px;margin:20px auto;border-radius:8px}}input{{width:100%;box-sizing:border-box;padding:12px;border:1px solid #58708f;border-radius:8px;background:#0e1726;color:white;font-size:18px;letter-spacing:6px;text-align:center}}button{{width:100%;margin-top:16px;padding:12px;border:0;border-radius:8px;background:#4fa3ff;color:#07111f;font-weight:700;font-size:16px}}.error{{color:#ff9a9a}}.notice{{padding:10px 12px;background:#3a2d16;color:#ffd98a;border-radius:8px;font-size:14px}}.cf{{margin-top:16px}}#account{{color:#a9bdd8}}</style></head><body><main><h1>Telegram 入群驗證</h1><p class="notice">精簡版 Telegram 客戶端或 Telegram X 可能無法使用此驗證，請改用官方 Telegram 客戶端。</p><p>已在 Telegram Mini App 中開啟，請完成圖片與 Cloudflare 驗證。</p>{_PAGE_ERROR}<p id="account">正在確認 Telegram 帳號…</p><img src="/verify/{_PAGE_TOKEN}/captcha.png" alt="數字驗證碼"><form method="post"><input type="hidden" name="tg_init_data" id="tg-init-data"><input name="captcha" inputmode="numeric" pattern="[0-9]{{6}}" maxlength="6" autocomplete="off" required><div class="cf"><div class="cf-turnstile" data-sitekey="{safe_key}"></div></div><button type="submit">完成驗證</button></form><script>if(window.Telegram&&Telegram.WebApp){{Telegram.WebApp.ready();Telegram.WebApp.expand();document.getElementById('tg-init-data').value=Telegram.WebApp.initData;document.getElementById('account').textContent='已綁定目前 Telegram 帳號';}}</script></main></body></html>"""
+        head, rest = text.split(_PAGE_ERROR)
+        middle, tail = rest.split(_PAGE_TOKEN)
+        self._parts = (head, middle, tail)
+
+    def render(self, token: str, error: str = "") -> str:
+        head, middle, tail = self._parts
+        safe_error = f'<p class="error">{html.escape(error)}</p>' if error else ""
+        return "".join((head, safe_error, middle, html.escape(token, quote=True), tail))
 
 
-def _page(token: str, site_key: str, captcha: str, bot_username: str, error: str = "") -> str:
-    safe_token = html.escape(token, quote=True)
-    safe_key = html.escape(site_key, quote=True)
-    safe_captcha = html.escape(captcha)
-    safe_error = f'<p class="error">{html.escape(error)}</p>' if error else ""
-    return f"""<!doctype html><html lang="zh-Hant"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>Telegram 入群驗證</title><script src="https://telegram.org/js/telegram-web-app.js"></script><script src="https://challenges.cloudflare.com/turnstile/v0/api.js" async defer></script><style>body{{font-family:system-ui,sans-serif;background:#101827;color:#eef4ff;display:grid;place-items:center;min-height:100vh;margin:0}}main{{width:min(420px,calc(100% - 32px));background:#17243a;padding:28px;border-radius:16px;box-shadow:0 12px 40px #0005}}h1{{font-size:22px}}img{{display:block;width:240px;height:88px;margin:20px auto;border-radius:8px}}input{{width:100%;box-sizing:border-box;padding:12px;border:1px solid #58708f;border-radius:8px;background:#0e1726;color:white;font-size:18px;letter-spacing:6px;text-align:center}}button{{width:100%;margin-top:16px;padding:12px;border:0;border-radius:8px;background:#4fa3ff;color:#07111f;font-weight:700;font-size:16px}}.error{{color:#ff9a9a}}.notice{{padding:10px 12px;background:#3a2d16;color:#ffd98a;border-radius:8px;font-size:14px}}.cf{{margin-top:16px}}#account{{color:#a9bdd8}}</style></head><body><main><h1>Telegram 入群驗證</h1><p class="notice">精簡版 Telegram 客戶端或 Telegram X 可能無法使用此驗證，請改用官方 Telegram 客戶端。</p><p>已在 Telegram Mini App 中開啟，請完成圖片與 Cloudflare 驗證。</p>{safe_error}<p id="account">正在確認 Telegram 帳號…</p><img src="data:image/png;base64,{__import__('base64').b64encode(_captcha_image(captcha)).decode()}" alt="數字驗證碼"><form method="post"><input type="hidden" name="tg_init_data" id="tg-init-data"><input name="captcha" inputmode="numeric" pattern="[0-9]{{6}}" maxlength="6" autocomplete="off" required><div class="cf"><div class="cf-turnstile" data-sitekey="{safe_key}"></div></div><button type="submit">完成驗證</button></form><script>if(window.Telegram&&Telegram.WebApp){{Telegram.WebApp.ready();Telegram.WebApp.expand();document.getElementById('tg-init-data').value=Telegram.WebApp.initData;document.getElementById('account').textContent='已綁定目前 Telegram 帳號';}}</script></main></body></html>"""
 def _admin_page() -> str:
-    return '''<!doctype html><html lang="zh-Hant"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>群組管理</title><script src="https://telegram.org/js/telegram-web-app.js"></script><style>body{font-family:system-ui,sans-serif;background:#101827;color:#eef4ff;margin:0;padding:16px}main{max-width:720px;margin:auto}.card{background:#17243a;border-radius:14px;padding:16px;margin:12px 0}select,textarea,button{box-sizing:border-box;width:100%;padding:10px;border-radius:8px;border:1px solid #58708f;background:#0e1726;color:#fff;margin-top:8px}button{background:#4fa3ff;color:#07111f;font-weight:700;border:0}.feature{display:flex;align-items:center;justify-content:space-between;padding:10px 0;border-bottom:1px solid #30445f}.feature button{width:auto;margin:0;padding:7px 12px}.sample{display:flex;gap:8px;align-items:center;border-bottom:1px solid #30445f;padding:8px 0}.sample span{flex:1;white-space:pre-wrap;word-break:break-word}.sample button{width:auto;margin:0;background:#d85c6b;color:white}.muted{color:#a9bdd8}.error{color:#ff9a9a}</style></head><body><main><h1>群組管理</h1><p id="status" class="muted">正在載入…</p><section class="card"><h2>群組設定</h2><select id="groups"></select><div id="features"></div></section><section class="card"><h2>廣告樣本</h2><p class="muted">僅 Bot 擁有者可管理樣本。</p><textarea id="sample" rows="4" placeholder="輸入完整廣告樣本"></textarea><button onclick="addSample()">加入廣告樣本</button><div id="samples"></div></section></main><script>Telegram.WebApp.ready();Telegram.WebApp.expand();const initData=Telegram.WebApp.initData;let state={};async function api(action,payload={}){const body=new URLSearchParams({init_data:initData,action,payload:JSON.stringify(payload)});const r=await fetch('/api/admin',{method:'POST',headers:{'Content-Type':'application/x-www-form-urlencoded'},body});const d=await r.json();if(!r.ok)throw Error(d.error||'操作失敗');return d;}function esc(s){return String(s).replace(/[&<>"']/g,function(c){if(c==='&')return '&amp;';if(c==='<')return '&lt;';if(c==='>')return '&gt;';if(c===String.fromCharCode(34))return '&quot;';return '&#39;';});}function showError(e){document.getElementById('status').textContent=e.message;document.getElementById('status').className='error';}async function load(){try{state=await api('bootstrap');document.getElementById('status').textContent='已登入，可管理你有權限的群組';const sel=document.getElementById('groups');sel.innerHTML=state.groups.map(g=>`<option value="${g.id}">${esc(g.title)}</option>`).join('');sel.onchange=renderFeatures;renderFeatures();renderSamples();}catch(e){showError(e);}}async function renderFeatures(){const id=document.getElementById('groups').value;const g=state.groups.find(x=>String(x.id)===String(id));document.getElementById('features').innerHTML=g?Object.entries(g.features).map(([k,v])=>`<div class="feature"><span>${esc(g.labels[k]||k)}</span><button onclick="toggle('${k}',${!v})">${v?'✅ 開啟':'⛔ 關閉'}</button></div>`).join(''):'沒有可管理的群組';}async function toggle(name,value){try{const id=Number(document.getElementById('groups').value);const d=await api('set_feature',{chat_id:id,feature:name,enabled:value});const g=state.groups.find(x=>x.id===id);g.features=d.features;renderFeatures();}catch(e){showError(e);}}function renderSamples(){document.getElementById('samples').innerHTML=(state.samples||[]).map((s,i)=>`<div class="sample"><span>${esc(s)}</span><button onclick="removeSample(${i})">刪除</button></div>`).join('')||'<p class="muted">尚無廣告樣本</p>';}async function addSample(){try{const text=document.getElementById('sample').value.trim();if(!text)return;state.samples=await api('add_sample',{text}).then(d=>d.samples);document.getElementById('sample').value='';renderSamples();}catch(e){showError(e);}}async function removeSample(index){try{state.samples=await api('remove_sample',{index}).then(d=>d.samples);renderSamples();}catch(e){showError(e);}}load();</script></body></html>'''
+    return '''<!doctype html><html lang="zh-Hant"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>群組管理</title><script src="https://telegram.org/js/telegram-web-app.js"></script><style>body{font-family:system-ui,sans-serif;background:#101827;color:#eef4ff;margin:0;padding:16px}main{max-width:720px;margin:auto}.card{background:#17243a;border-radius:14px;padding:16px;margin:12px 0}select,input,textarea,button{box-sizing:border-box;width:100%;padding:10px;border-radius:8px;border:1px solid #58708f;background:#0e1726;color:#fff;margin-top:8px}button{background:#4fa3ff;color:#07111f;font-weight:700;border:0}.feature{display:flex;align-items:center;justify-content:space-between;padding:10px 0;border-bottom:1px solid #30445f}.feature button{width:auto;margin:0;padding:7px 12px}.sample{display:flex;gap:8px;align-items:center;border-bottom:1px solid #30445f;padding:8px 0}.sample span{flex:1;white-space:pre-wrap;word-break:break-word}.sample button{width:auto;margin:0;background:#d85c6b;color:white}.muted{color:#a9bdd8}.error{color:#ff9a9a}</style></head><body><main><h1>群組管理</h1><p id="status" class="muted">正在載入…</p><section class="card"><h2>群組設定</h2><select id="groups"></select><div id="features"></div></section><section class="card"><h2>廣告樣本</h2><p class="muted">僅 Bot 擁有者可管理樣本。</p><textarea id="sample" rows="4" placeholder="輸入完整廣告樣本"></textarea><button onclick="addSample()">加入廣告樣本</button><input id="query" placeholder="搜尋樣本"><select id="mode"><option value="">包含文字</option><option value="1">相似內容</option></select><button onclick="searchSamples()">搜尋</button><p id="count" class="muted"></p><div id="samples"></div><button id="more" onclick="moreSamples()" hidden>載入更多</button></section></main><script>Telegram.WebApp.ready();Telegram.WebApp.expand();const initData=Telegram.WebApp.initData;let state={};let session='';async function api(action,payload={},retry=true){const auth=session?{session}:{init_data:initData};const body=new URLSearchParams({...auth,action,payload:JSON.stringify(payload)});const r=await fetch('/api/admin',{method:'POST',headers:{'Content-Type':'application/x-www-form-urlencoded'},body});const d=await r.json();if(r.status===401&&retry){session='';return api(action,payload,false);}if(!r.ok)throw Error(d.error||'操作失敗');if(d.session)session=d.session;return d;}function esc(s){return String(s).replace(/[&<>"']/g,function(c){if(c==='&')return '&amp;';if(c==='<')return '&lt;';if(c==='>')return '&gt;';if(c===String.fromCharCode(34))return '&quot;';return '&#39;';});}function showError(e){document.getElementById('status').textContent=e.message;document.getElementById('status').className='error';}async function load(){try{state=await api('bootstrap');document.getElementById('status').textContent='已登入，可管理你有權限的群組';const sel=document.getElementById('groups');sel.innerHTML=state.groups.map(g=>`<option value="${g.id}">${esc(g.title)}</option>`).join('');sel.onchange=renderFeatures;renderFeatures();renderSamples();}catch(e){showError(e);}}async function renderFeatures(){const id=document.getElementById('groups').value;const g=state.groups.find(x=>String(x.id)===String(id));document.getElementById('features').innerHTML=g?Object.entries(g.features).map(([k,v])=>`<div class="feature"><span>${esc(g.labels[k]||k)}</span><button onclick="toggle('${k}',${!v})">${v?'✅ 開啟':'⛔ 關閉'}</button></div>`).join(''):'沒有可管理的群組';}async function toggle(name,value){try{const id=Number(document.getElementById('groups').value);const d=await api('set_feature',{chat_id:id,feature:name,enabled:value});const g=state.groups.find(x=>x.id===id);g.features=d.features;renderFeatures();}catch(e){showError(e);}}function renderSamples(){const p=state.samples||{items:[],next:'',total:0};document.getElementById('samples').innerHTML=p.items.map(s=>`<div class="sample"><span>${esc(s.text)}</span><button onclick="removeSample('${s.id}')">刪除</button></div>`).join('')||'<p class="muted">尚無廣告樣本</p>';document.getElementById('count').textContent=`共 ${p.total} 條，已顯示 ${p.items.length} 條`;document.getElementById('more').hidden=!p.next;}function searchParams(){return{query:document.getElementById('query').value.trim(),similar:!!document.getElementById('mode').value};}async function searchSamples(){try{state.samples=await api('samples',searchParams()).then(d=>d.samples);renderSamples();}catch(e){showError(e);}}async function moreSamples(){try{const p=state.samples;const d=await api('samples',{query:p.query,similar:p.similar,cursor:p.next}).then(d=>d.samples);state.samples={...d,items:p.items.concat(d.items)};renderSamples();}catch(e){showError(e);}}async function addSample(){try{const text=document.getElementById('sample').value.trim();if(!text)return;state.samples=await api('add_sample',{text,...searchParams()}).then(d=>d.samples);document.getElementById('sample').value='';renderSamples();}catch(e){showError(e);}}async function removeSample(id){try{state.samples=await api('remove_sample',{id,...searchParams()}).then(d=>d.samples);renderSamples();}catch(e){showError(e);}}load();</script></body></html>'''